@@ -8,9 +8,13 @@ Hierarchy:
 - cache
   +- cache.sqdb
   +- content
-     +- A
-        +- Axxxx_sysm
-  +- 
+     +- 3f
+        +- 8a
+           +- Axxxx_sysm.xml
+
+The content directories are named according to the cache layout (see 
+layout.py); older caches use a single level named by the first character of
+the short uid.
 
 cache.sqdb is a python Shove persistent dictionary with entries:
 
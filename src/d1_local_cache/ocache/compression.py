@@ -0,0 +1,292 @@
+'''
+Created on Oct 17, 2026
+
+Compression of the documents held by the object cache.
+
+Documents are compressed as they are streamed to storage, with gzip or, if
+the zstandard package is available, zstd. System metadata documents are small
+and share most of their markup, so zstd can use a dictionary trained on
+cached documents, which compresses them far better than a generic compressor.
+Dictionaries are kept in files named by their dictionary id so that documents
+compressed with any of them can be read.
+
+The compression method of a document is recorded in its location, as a file 
+name extension, when it is stored. Readers decompress only the documents whose
+location says so, object content that happens to be compressed itself is read
+as it was retrieved.
+'''
+
+import os
+import zlib
+import threading
+from collections import deque
+try:
+  import zstandard as zstd
+except ImportError:
+  zstd = None
+
+COMPRESSION_NONE = "none"
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_ZSTD_LEVEL = 3
+#Size of the dictionary trained for system metadata documents
+DEFAULT_DICTIONARY_SIZE = 112640
+
+#Extension added to the location of a document stored with each method
+EXTENSIONS = {COMPRESSION_GZIP: ".gz",
+              COMPRESSION_ZSTD: ".zst"}
+#Enough to hold a zstd frame header, which includes the dictionary id
+HEADER_SIZE = 18
+BLOCK_SIZE = 65536
+
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def _requireZstd():
+  if zstd is None:
+    raise ImportError("The zstandard package is required for zstd "
+                      "compression")
+
+
+def locationMethod(location):
+  '''Returns the compression method recorded in location, or None if the 
+  document at location is stored as is.
+  '''
+  for method, extension in EXTENSIONS.iteritems():
+    if location.endswith(extension):
+      return method
+  return None
+
+
+def plainLocation(location):
+  '''Returns location without the extension of its compression method.
+  '''
+  method = locationMethod(location)
+  if method is None:
+    return location
+  return location[:-len(EXTENSIONS[method])]
+
+
+class Dictionaries(object):
+  '''The zstd dictionaries of a cache, stored as zdict_<id>.dat under root.
+  '''
+
+  def __init__(self, root):
+    self.root = root
+    self._loaded = {}
+
+
+  def path(self, dictId):
+    return os.path.join(self.root, "zdict_%d.dat" % dictId)
+
+
+  def get(self, dictId):
+    '''Returns the dictionary with id dictId.
+    '''
+    _requireZstd()
+    res = self._loaded.get(dictId)
+    if res is None:
+      with open(self.path(dictId), "rb") as f:
+        res = zstd.ZstdCompressionDict(f.read())
+      self._loaded[dictId] = res
+    return res
+
+
+  def train(self, samples, size=DEFAULT_DICTIONARY_SIZE):
+    '''Trains a dictionary on the list of documents samples, saves it and
+    returns its id.
+    '''
+    _requireZstd()
+    trained = zstd.train_dictionary(size, samples)
+    dictId = trained.dict_id()
+    if not os.path.exists(self.root):
+      os.makedirs(self.root)
+    with open(self.path(dictId), "wb") as f:
+      f.write(trained.as_bytes())
+    self._loaded[dictId] = trained
+    return dictId
+
+
+class Compressor(object):
+  '''Compresses documents with method, optionally using a zstd dictionary.
+  A compressor may be shared by threads, each compresses with its own zstd
+  context.
+  '''
+
+  def __init__(self, method, level=None, dictionary=None):
+    if method == COMPRESSION_ZSTD:
+      _requireZstd()
+      if level is None:
+        level = DEFAULT_ZSTD_LEVEL
+    elif method == COMPRESSION_GZIP:
+      if level is None:
+        level = DEFAULT_GZIP_LEVEL
+    else:
+      raise ValueError("Unknown compression method: %s" % method)
+    self.method = method
+    self.extension = EXTENSIONS[method]
+    self.level = level
+    self.dictionary = dictionary
+    #ZstdCompressor is not thread safe, each thread has its own
+    self._local = threading.local()
+
+
+  def compressobj(self):
+    if self.method == COMPRESSION_GZIP:
+      return zlib.compressobj(self.level, zlib.DEFLATED, _GZIP_WBITS)
+    cctx = getattr(self._local, "cctx", None)
+    if cctx is None:
+      cctx = zstd.ZstdCompressor(level=self.level, dict_data=self.dictionary)
+      self._local.cctx = cctx
+    return cctx.compressobj()
+
+
+  def copy(self, source, fdest):
+    '''Compresses the stream source into the file fdest.
+    '''
+    c = self.compressobj()
+    while True:
+      data = source.read(BLOCK_SIZE)
+      if not data:
+        break
+      fdest.write(c.compress(data))
+    fdest.write(c.flush())
+
+
+  def compress(self, data):
+    c = self.compressobj()
+    return c.compress(data) + c.flush()
+
+
+class DecompressingReader(object):
+  '''File-like reader of the decompressed content of a stream.
+  '''
+
+  def __init__(self, stream, decompressor):
+    self.stream = stream
+    self._decompressor = decompressor
+    #Decompressed data not read yet, as chunks so that reads do not copy the
+    #whole buffer. _offset is the position read up to in the first chunk.
+    self._chunks = deque()
+    self._offset = 0
+    self._available = 0
+    self._eof = False
+
+
+  def _fill(self, size):
+    while not self._eof and (size < 0 or self._available < size):
+      data = self.stream.read(BLOCK_SIZE)
+      if data:
+        data = self._decompressor.decompress(data)
+      else:
+        self._eof = True
+        flush = getattr(self._decompressor, "flush", None)
+        data = flush() if flush is not None else ""
+      if data:
+        self._chunks.append(data)
+        self._available += len(data)
+
+
+  def read(self, size=-1):
+    self._fill(size)
+    if size < 0 or size > self._available:
+      size = self._available
+    parts = []
+    remaining = size
+    while remaining > 0:
+      chunk = self._chunks[0]
+      end = self._offset + remaining
+      if end < len(chunk):
+        parts.append(chunk[self._offset:end])
+        self._offset = end
+        break
+      parts.append(chunk[self._offset:] if self._offset > 0 else chunk)
+      remaining -= len(chunk) - self._offset
+      self._chunks.popleft()
+      self._offset = 0
+    self._available -= size
+    if len(parts) == 1:
+      return parts[0]
+    return "".join(parts)
+
+
+  def close(self):
+    self.stream.close()
+
+
+def openDocument(stream, method=None, dictionaries=None):
+  '''Returns a reader of the document in the seekable stream decompressed 
+  with method, or stream itself if method is None. dictionaries provides the
+  zstd dictionaries a document may have been compressed with.
+  '''
+  if method is None:
+    return stream
+  if method == COMPRESSION_GZIP:
+    return DecompressingReader(stream, zlib.decompressobj(_GZIP_WBITS))
+  if method != COMPRESSION_ZSTD:
+    raise ValueError("Unknown compression method: %s" % method)
+  _requireZstd()
+  head = stream.read(HEADER_SIZE)
+  stream.seek(0)
+  dictionary = None
+  dictId = zstd.get_frame_parameters(head).dict_id
+  if dictId:
+    if dictionaries is None:
+      raise IOError("zstd dictionary %d is required" % dictId)
+    dictionary = dictionaries.get(dictId)
+  dctx = zstd.ZstdDecompressor(dict_data=dictionary)
+  return DecompressingReader(stream, dctx.decompressobj())
+
+
+
+if __name__ == "__main__":
+  import unittest
+  from cStringIO import StringIO
+
+  DOCUMENT = "<d1:systemMetadata>%s</d1:systemMetadata>" % ("<a>b</a>" * 5000)
+
+  class TestCompression(unittest.TestCase):
+
+    def roundtrip(self, compressor):
+      dest = StringIO()
+      compressor.copy(StringIO(DOCUMENT), dest)
+      self.assertTrue(len(dest.getvalue()) < len(DOCUMENT))
+      method = locationMethod("doc.xml" + compressor.extension)
+      self.assertEqual(compressor.method, method)
+      dest.seek(0)
+      reader = openDocument(dest, method)
+      self.assertEqual(DOCUMENT[:100], reader.read(100))
+      self.assertEqual(DOCUMENT[100:], reader.read())
+      self.assertEqual("", reader.read())
+      dest.seek(0)
+      reader = openDocument(dest, method)
+      parts = []
+      while True:
+        data = reader.read(7)
+        if not data:
+          break
+        parts.append(data)
+      self.assertEqual(DOCUMENT, "".join(parts))
+      packed = StringIO(compressor.compress(DOCUMENT))
+      self.assertEqual(DOCUMENT, openDocument(packed, method).read())
+
+    def test_plain(self):
+      self.assertEqual(DOCUMENT, openDocument(StringIO(DOCUMENT)).read())
+      #Compressed object content is not decompressed unless recorded
+      packed = Compressor(COMPRESSION_GZIP).compress(DOCUMENT)
+      self.assertEqual(packed, openDocument(StringIO(packed)).read())
+      self.assertEqual(None, locationMethod("a/b_content.xml"))
+      self.assertEqual("seg:1:0:10", plainLocation("seg:1:0:10.zst"))
+      self.assertEqual("a.xml", plainLocation("a.xml"))
+
+    def test_gzip(self):
+      self.roundtrip(Compressor(COMPRESSION_GZIP))
+
+    def test_zstd(self):
+      if zstd is None:
+        return
+      self.roundtrip(Compressor(COMPRESSION_ZSTD))
+
+  unittest.main()
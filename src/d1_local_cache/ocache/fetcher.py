@@ -0,0 +1,312 @@
+'''
+Created on Oct 17, 2026
+
+Implements a high concurrency fetcher for DataONE system metadata and objects.
+
+Sync rate is bound by network round trip latency rather than CPU, so the 
+fetcher keeps many requests in flight at once. Requests are issued by a pool of
+lightweight threads, up to the concurrency limit, that share a set of 
+keep-alive HTTP connections to the node instead of each holding its own client.
+Python 2 has no asyncio, and the work done per request is small, so blocking
+threads give the same overlap of round trips.
+
+The fetcher only does network and storage I/O. Response bodies are handed to a
+store callable, normally the store method of a storage backend, and each 
+result is reported as a (pid, stored, status) tuple through a callback, 
+normally a workers.ResultWriter.put, which records it in the cache database. 
+System metadata can be parsed while it is stored, in which case the derived 
+column values are added to the result.
+
+If an instrument is provided the latency of each request, the time taken to
+store its response and the stored size are recorded on it as 
+<name>.request, <name>.store and <name>.bytes, where name defaults to the
+resource.
+'''
+
+import logging
+import threading
+import httplib
+import socket
+import urlparse
+import Queue
+import d1_common.const
+import d1_common.url
+from d1_local_cache.ocache import sysmparse
+from d1_local_cache.util.instrument import span
+
+DEFAULT_CONCURRENCY = 100
+DEFAULT_TIMEOUT = 30.0
+
+RESOURCE_SYSTEMMETADATA = "meta"
+RESOURCE_OBJECT = "object"
+
+#Placed on the work queue to stop a fetch thread
+_STOP = None
+
+
+class ConnectionPool(object):
+  '''A pool of keep-alive HTTP or HTTPS connections to a single node. 
+  Connections are created on demand and returned to the pool after a complete
+  response has been read from them.
+  '''
+  
+  def __init__(self, baseUrl, maxsize=DEFAULT_CONCURRENCY, certificate=None,
+               timeout=DEFAULT_TIMEOUT):
+    parts = urlparse.urlsplit(baseUrl)
+    self.scheme = parts.scheme
+    self.host = parts.hostname
+    self.port = parts.port
+    self.selector = parts.path.rstrip("/")
+    self.maxsize = maxsize
+    self.certificate = certificate
+    self.timeout = timeout
+    self._idle = []
+    self._lock = threading.Lock()
+
+
+  def new(self):
+    '''Returns a new connection, not taken from the idle connections.
+    '''
+    if self.scheme == "https":
+      return httplib.HTTPSConnection(self.host, self.port,
+                                     key_file=self.certificate,
+                                     cert_file=self.certificate,
+                                     timeout=self.timeout)
+    return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+
+  def get(self):
+    with self._lock:
+      if len(self._idle) > 0:
+        return self._idle.pop()
+    return self.new()
+
+
+  def release(self, connection, reusable=True):
+    with self._lock:
+      if reusable and len(self._idle) < self.maxsize:
+        self._idle.append(connection)
+        return
+    connection.close()
+
+
+  def close(self):
+    with self._lock:
+      for connection in self._idle:
+        connection.close()
+      self._idle = []
+
+
+class ConcurrentFetcher(object):
+  '''Retrieves a DataONE REST resource for many PIDs with up to concurrency 
+  requests in flight, passing each response body to a store callable.
+  '''
+
+  def __init__(self, baseUrl, certificate=None, 
+               concurrency=DEFAULT_CONCURRENCY,
+               timeout=DEFAULT_TIMEOUT,
+               version="v1",
+               instrument=None):
+    self._log = logging.getLogger("ConcurrentFetcher")
+    self.concurrency = concurrency
+    self.instrument = instrument
+    self.version = version
+    self.pool = ConnectionPool(baseUrl, maxsize=concurrency,
+                               certificate=certificate, timeout=timeout)
+    self.headers = {'User-Agent': d1_common.const.USER_AGENT,
+                    'Connection': 'keep-alive'}
+
+
+  def _url(self, resource, pid):
+    return "%s/%s/%s/%s" % (self.pool.selector, self.version, resource,
+                            d1_common.url.encodePathElement(pid))
+
+
+  def _get(self, url, suid, store, parse=False, name="fetch"):
+    '''GETs url and stores the response body with store(suid, stream). A 
+    connection that fails before a response is received is retried once on a 
+    new connection, since the server may have closed an idle keep-alive 
+    connection. Returns the storage.Stored returned by store, the HTTP status
+    and, if parse is True, the sysmparse.derivedColumns of a successful system
+    metadata response parsed while it is stored (otherwise None). Timings 
+    are recorded with the prefix name.
+    '''
+    for attempt in (0, 1):
+      #Other idle connections may be just as stale, so the retry does not 
+      #take one from the pool
+      if attempt == 0:
+        connection = self.pool.get()
+      else:
+        connection = self.pool.new()
+      try:
+        with span(self.instrument, name + ".request"):
+          connection.request("GET", url, headers=self.headers)
+          response = connection.getresponse()
+      except (httplib.HTTPException, socket.error) as e:
+        connection.close()
+        if attempt > 0:
+          raise
+        self._log.debug("Retrying %s after %s" % (url, str(e)))
+        continue
+      source = response
+      if parse and response.status == 200:
+        source = sysmparse.ParsingReader(response)
+      try:
+        with span(self.instrument, name + ".store"):
+          stored = store(suid, source)
+      except:
+        connection.close()
+        raise
+      self.pool.release(connection, reusable=not response.will_close)
+      if self.instrument is not None and stored.size is not None:
+        self.instrument.histogram(name + ".bytes", stored.size)
+      columns = None
+      if source is not response:
+        columns = source.columns()
+      return stored, response.status, columns
+
+
+  def fetch(self, work, resource, store, onResult, parse=False, name=None):
+    '''Fetches resource ("meta" or "object") for each (pid, suid) in work. The
+    response body is stored with store(suid, stream), which returns the 
+    storage.Stored of the document, and onResult((pid, stored, status)) is
+    called for each completed request. If parse is True system metadata 
+    responses are parsed as they are stored, and the result is 
+    (pid, stored, status, columns) with the sysmparse.derivedColumns of the
+    document. Returns the number of results reported. Measurements are 
+    recorded with the prefix name, by default resource.
+
+    work is consumed as the fetch proceeds, so it may be a generator reading
+    from the database.
+    '''
+    if name is None:
+      name = resource
+    Q = Queue.Queue(self.concurrency * 2)
+    counter = {'n': 0}
+    lock = threading.Lock()
+
+    def worker():
+      while True:
+        item = Q.get()
+        if item is _STOP:
+          break
+        pid, suid = item
+        try:
+          stored, status, columns = self._get(self._url(resource, pid), 
+                                              suid, store, parse=parse,
+                                              name=name)
+          if parse:
+            onResult((pid, stored, status, columns))
+          else:
+            onResult((pid, stored, status))
+          with lock:
+            counter['n'] += 1
+        except Exception as e:
+          self._log.warn("Fetch of %s failed for pid: %s" % (resource, pid))
+          self._log.error(e)
+
+    threads = []
+    for i in xrange(self.concurrency):
+      wt = threading.Thread(target=worker, name="fetch.%d" % i)
+      wt.daemon = True
+      wt.start()
+      threads.append(wt)
+    try:
+      for item in work:
+        Q.put(item)
+    finally:
+      for wt in threads:
+        Q.put(_STOP)
+      for wt in threads:
+        wt.join()
+      self.pool.close()
+    return counter['n']
+
+
+#===============================================================================
+
+if __name__ == "__main__":
+  import os
+  import tempfile
+  from d1_local_cache.ocache import storage
+  import unittest
+  import BaseHTTPServer
+  import SocketServer
+  
+  class StubCNHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves /cn/v1/meta/<pid> and /cn/v1/object/<pid> with keep-alive.
+    '''
+    protocol_version = "HTTP/1.1"
+    #If True connections are closed after each response without telling the
+    #client, as a server closing idle keep-alive connections does
+    closeIdle = False
+    
+    def do_GET(self):
+      parts = self.path.split("/")
+      status = 200
+      if parts[-1] == "missing":
+        status = 404
+      body = "<%s>%s</%s>" % (parts[-2], parts[-1], parts[-2])
+      self.send_response(status)
+      self.send_header("Content-Type", "text/xml")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+      if self.closeIdle:
+        self.close_connection = 1
+
+    def log_message(self, *args):
+      pass
+
+  class StubCN(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+  class TestConcurrentFetcher(unittest.TestCase):
+
+    def setUp(self):
+      self.server = StubCN(("127.0.0.1", 0), StubCNHandler)
+      t = threading.Thread(target=self.server.serve_forever)
+      t.daemon = True
+      t.start()
+      self.baseUrl = "http://127.0.0.1:%d/cn" % self.server.server_address[1]
+      self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+      StubCNHandler.closeIdle = False
+      self.server.shutdown()
+
+    def test_fetch(self):
+      fetcher = ConcurrentFetcher(self.baseUrl, concurrency=20)
+      work = [("pid_%d" % i, "s%d" % i) for i in xrange(200)]
+      work.append(("missing", "missing"))
+      results = []
+      n = fetcher.fetch(iter(work), RESOURCE_SYSTEMMETADATA,
+                        storage.FileStore(
+                          lambda suid: os.path.join(self.folder, suid)).store,
+                        results.append)
+      self.assertEqual(201, n)
+      statuses = dict([(r[0], r[2]) for r in results])
+      self.assertEqual(200, statuses["pid_7"])
+      self.assertEqual(404, statuses["missing"])
+      self.assertEqual("<meta>pid_7</meta>", 
+                       file(os.path.join(self.folder, "s7")).read())
+
+    def test_staleConnections(self):
+      StubCNHandler.closeIdle = True
+      fetcher = ConcurrentFetcher(self.baseUrl, concurrency=5)
+      store = storage.FileStore(
+                lambda suid: os.path.join(self.folder, suid)).store
+      #Fill the pool with connections the server has since closed
+      connections = [fetcher.pool.get() for i in xrange(3)]
+      for connection in connections:
+        connection.request("GET", fetcher._url(RESOURCE_SYSTEMMETADATA, "a"))
+        connection.getresponse().read()
+      for connection in connections:
+        fetcher.pool.release(connection)
+      stored, status, columns = fetcher._get(
+                          fetcher._url(RESOURCE_SYSTEMMETADATA, "pid_1"), 
+                          "s1", store)
+      self.assertEqual(200, status)
+      self.assertEqual("<meta>pid_1</meta>", open(stored.location).read())
+
+  unittest.main()
@@ -0,0 +1,116 @@
+'''
+Created on Oct 17, 2026
+
+Directory layouts for the files under the cache content folder.
+
+A layout spreads the cached files over a tree of levels directories, each
+named by width characters of a key derived from the short uid. The key is
+either the short uid itself ("suid") or the hex MD5 digest of the short uid
+("md5"), which gives an even spread of 16**width directories per level.
+
+The original cache layout is one level named by the first character of the
+short uid, giving 31 directories under content/.
+'''
+
+import hashlib
+import os
+
+SCHEME_SUID = "suid"
+SCHEME_MD5 = "md5"
+
+
+class ShardLayout(object):
+  '''Maps a short uid to the directory components its files are stored in.
+  '''
+
+  def __init__(self, levels=2, width=2, scheme=SCHEME_MD5):
+    if scheme not in (SCHEME_SUID, SCHEME_MD5):
+      raise ValueError("Unknown layout scheme: %s" % scheme)
+    if levels < 0 or width < 1:
+      raise ValueError("Invalid layout levels=%d width=%d" % (levels, width))
+    self.levels = levels
+    self.width = width
+    self.scheme = scheme
+
+
+  def _key(self, suid):
+    if self.scheme == SCHEME_MD5:
+      return hashlib.md5(suid).hexdigest()
+    return suid
+
+
+  def parts(self, suid):
+    '''Returns the list of directory names for suid.
+    '''
+    key = self._key(suid)
+    res = []
+    for i in xrange(self.levels):
+      part = key[i * self.width:(i + 1) * self.width]
+      if part == "":
+        #short uids of small ids may have fewer characters than the layout
+        part = "_"
+      res.append(part)
+    return res
+
+
+  def directory(self, root, suid):
+    return os.path.join(root, *self.parts(suid))
+
+
+  def toDict(self):
+    return {'levels': self.levels,
+            'width': self.width,
+            'scheme': self.scheme}
+
+
+  @staticmethod
+  def fromDict(d):
+    return ShardLayout(levels=d['levels'], width=d['width'],
+                       scheme=d['scheme'])
+
+
+  def __eq__(self, other):
+    return isinstance(other, ShardLayout) and \
+           self.toDict() == other.toDict()
+
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+
+  def __repr__(self):
+    return "ShardLayout(levels=%d, width=%d, scheme=%r)" % \
+           (self.levels, self.width, self.scheme)
+
+
+#Layout of caches created before layouts were configurable
+LEGACY_LAYOUT = ShardLayout(levels=1, width=1, scheme=SCHEME_SUID)
+#Layout for new caches, 256 x 256 directories
+DEFAULT_LAYOUT = ShardLayout(levels=2, width=2, scheme=SCHEME_MD5)
+
+
+
+if __name__ == "__main__":
+  import unittest
+
+  class TestShardLayout(unittest.TestCase):
+
+    def test_legacy(self):
+      self.assertEqual(["8"], LEGACY_LAYOUT.parts("867nv"))
+
+    def test_md5(self):
+      digest = hashlib.md5("867nv").hexdigest()
+      self.assertEqual([digest[0:2], digest[2:4]],
+                       DEFAULT_LAYOUT.parts("867nv"))
+
+    def test_short(self):
+      layout = ShardLayout(levels=3, width=2, scheme=SCHEME_SUID)
+      self.assertEqual(["86", "7n", "v"], layout.parts("867nv"))
+      self.assertEqual(["b", "_", "_"], layout.parts("b"))
+
+    def test_dict(self):
+      layout = ShardLayout.fromDict(DEFAULT_LAYOUT.toDict())
+      self.assertEqual(DEFAULT_LAYOUT, layout)
+      self.assertNotEqual(LEGACY_LAYOUT, layout)
+
+  unittest.main()
@@ -0,0 +1,404 @@
+'''
+Created on Oct 17, 2026
+
+Implements a pipelined lister for the object list of a DataONE node.
+
+Pages are requested ahead of the consumer by a small pool of threads, so the 
+next pages are being fetched and parsed while the current page is inserted 
+into the cache. The page size adapts to the observed response time. A date 
+range may be split into windows that are listed in parallel and merged into a
+single stream of pages.
+'''
+
+import logging
+import threading
+import time
+import httplib
+import Queue
+from collections import deque
+import d1_common.types.exceptions
+from d1_common import date_time
+from d1_local_cache.util import mjd
+
+#Number of pages requested ahead of the consumer
+DEFAULT_PREFETCH = 4
+DEFAULT_PAGE_SIZE = 1000
+MIN_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 10000
+#Page size is adjusted so that a page takes about this many seconds to fetch
+DEFAULT_TARGET_SECONDS = 5.0
+#Lower bound used when splitting an open ended date range into windows
+DEFAULT_EPOCH = 55927.0 #2012-01-01
+
+
+def xsdDateTime(mjdvalue):
+  '''Returns an xs:dateTime string for an MJD value, None for None.
+  '''
+  if mjdvalue is None:
+    return None
+  return date_time.to_xsd_datetime(mjd.MJD2dateTime(mjdvalue))
+
+
+def splitWindows(fromDate, toDate, nwindows, epoch=DEFAULT_EPOCH):
+  '''Splits the MJD range fromDate to toDate into nwindows contiguous 
+  (fromDate, toDate) windows of equal duration. If fromDate is None the first
+  window is open ended and the others are split from epoch.
+  '''
+  if nwindows <= 1:
+    return [(fromDate, toDate)]
+  lower = fromDate
+  if lower is None:
+    lower = min(epoch, toDate)
+  step = (toDate - lower) / float(nwindows)
+  bounds = [lower + i * step for i in xrange(nwindows)] + [toDate]
+  bounds[0] = fromDate
+  return [(bounds[i], bounds[i+1]) for i in xrange(nwindows)]
+
+
+class _PageRequest(object):
+  
+  def __init__(self, start, count):
+    self.start = start
+    self.count = count
+    self.result = None
+    self.error = None
+    self.elapsed = 0.0
+    self.done = threading.Event()
+
+
+class PipelinedLister(object):
+  '''Yields the pages of the object list between fromDate and toDate (MJD),
+  in order, while up to prefetch further pages are being fetched.
+
+  Pages are requested at contiguous offsets. After each page the page size is
+  scaled towards targetSeconds per page, within minPageSize and maxPageSize. 
+  If the node returns fewer entries than requested, for example because it 
+  caps the page size, the gap is requested before any later page is yielded 
+  and the page size limits are lowered to match.
+
+  If an instrument is provided the time taken by each page request and the
+  number of entries it returned are recorded as list.page and list.entries.
+  '''
+
+  def __init__(self, clientFactory, fromDate=None, toDate=None, start=0,
+               pagesize=DEFAULT_PAGE_SIZE,
+               prefetch=DEFAULT_PREFETCH,
+               minPageSize=MIN_PAGE_SIZE,
+               maxPageSize=MAX_PAGE_SIZE,
+               targetSeconds=DEFAULT_TARGET_SECONDS,
+               trys=3,
+               instrument=None):
+    self._log = logging.getLogger("PipelinedLister")
+    self.instrument = instrument
+    self.clientFactory = clientFactory
+    self.fromDate = xsdDateTime(fromDate)
+    self.toDate = xsdDateTime(toDate)
+    self.start = start
+    self.pagesize = pagesize
+    self.prefetch = max(1, prefetch)
+    self.minPageSize = minPageSize
+    self.maxPageSize = maxPageSize
+    self.targetSeconds = targetSeconds
+    self.trys = trys
+    self.total = None
+
+
+  def _listObjects(self, client, request):
+    attempt = 0
+    while True:
+      try:
+        t0 = time.time()
+        request.result = client.listObjects(start=request.start, 
+                                            count=request.count,
+                                            fromDate=self.fromDate,
+                                            toDate=self.toDate)
+        request.elapsed = time.time() - t0
+        if self.instrument is not None:
+          self.instrument.timing("list.page", request.elapsed * 1000.0)
+          self.instrument.histogram("list.entries", 
+                                    len(request.result.objectInfo))
+        return
+      except (httplib.BadStatusLine, 
+              d1_common.types.exceptions.ServiceFailure) as e:
+        self._log.warn("listObjects failed at %d: %s" % (request.start, 
+                                                          str(e)))
+        attempt += 1
+        if attempt > self.trys:
+          raise
+      finally:
+        client.connection.close()
+
+
+  def _worker(self, requests):
+    client = self.clientFactory()
+    while True:
+      request = requests.get()
+      if request is None:
+        break
+      try:
+        self._listObjects(client, request)
+      except Exception as e:
+        request.error = e
+      request.done.set()
+
+
+  def _adapt(self, request):
+    n = len(request.result.objectInfo)
+    if n < 1 or request.elapsed <= 0:
+      return
+    size = int(self.targetSeconds * n / request.elapsed)
+    #Limit the change per page to damp noisy response times
+    size = max(self.pagesize / 2, min(self.pagesize * 2, size))
+    self.pagesize = max(self.minPageSize, min(self.maxPageSize, size))
+
+
+  def pages(self):
+    '''Yields (start, ObjectList) for each page.
+    '''
+    requests = Queue.Queue()
+    threads = []
+    for i in xrange(self.prefetch):
+      wt = threading.Thread(target=self._worker, args=(requests,),
+                            name="lister.%d" % i)
+      wt.daemon = True
+      wt.start()
+      threads.append(wt)
+    pending = deque()
+    offset = self.start
+    
+    def submit(start, count, front=False):
+      request = _PageRequest(start, count)
+      if front:
+        pending.appendleft(request)
+      else:
+        pending.append(request)
+      requests.put(request)
+
+    try:
+      #The total is not known until the first page is returned
+      submit(offset, self.pagesize)
+      offset += self.pagesize
+      while len(pending) > 0:
+        request = pending.popleft()
+        request.done.wait()
+        if request.error is not None:
+          raise request.error
+        olist = request.result
+        n = len(olist.objectInfo)
+        self.total = olist.total
+        self._log.debug("Page %d+%d of %d in %.2fs" % \
+                        (request.start, n, self.total, request.elapsed))
+        if n == 0:
+          #The list ends before the reported total, e.g. because objects were
+          #deleted while listing. Later pages are empty too.
+          if request.start < self.total:
+            self._log.warn("Empty page at %d of %d, ending the list" % \
+                           (request.start, self.total))
+          self.total = request.start
+          break
+        if n < request.count and request.start + n < self.total:
+          #Short page. Request the remainder before anything later is yielded
+          #and keep later pages within what the node returns
+          self.maxPageSize = n
+          self.minPageSize = min(self.minPageSize, n)
+          self.pagesize = min(self.pagesize, n)
+          submit(request.start + n, request.count - n, front=True)
+        self._adapt(request)
+        yield request.start, olist
+        while len(pending) < self.prefetch and offset < self.total:
+          count = min(self.pagesize, self.total - offset)
+          submit(offset, count)
+          offset += count
+    finally:
+      for wt in threads:
+        requests.put(None)
+
+
+def mergePages(listers, queueSize=None):
+  '''Lists each of listers on its own thread and yields (index, start, 
+  ObjectList) as pages become available, where index is the position of the
+  lister in listers. Pages of the same lister are yielded in order.
+  '''
+  if queueSize is None:
+    queueSize = 2 * len(listers)
+  Q = Queue.Queue(queueSize)
+  stop = threading.Event()
+  
+  def produce(index, lister):
+    try:
+      for start, olist in lister.pages():
+        if stop.is_set():
+          break
+        Q.put((index, start, olist))
+    except Exception as e:
+      Q.put((index, None, e))
+      return
+    Q.put((index, None, None))
+
+  for index, lister in enumerate(listers):
+    wt = threading.Thread(target=produce, args=(index, lister),
+                          name="lister.window.%d" % index)
+    wt.daemon = True
+    wt.start()
+  running = len(listers)
+  try:
+    while running > 0:
+      index, start, olist = Q.get()
+      if start is None:
+        running -= 1
+        if olist is not None:
+          raise olist
+        continue
+      yield index, start, olist
+  finally:
+    stop.set()
+    #Unblock producers waiting on a full queue
+    while running > 0:
+      try:
+        index, start, olist = Q.get(True, 1.0)
+        if start is None:
+          running -= 1
+      except Queue.Empty:
+        break
+
+
+if __name__ == "__main__":
+  import unittest
+
+  class ObjectList(object):
+
+    def __init__(self, start, entries, total):
+      self.start = start
+      self.objectInfo = entries
+      self.total = total
+
+  class FakeClient(object):
+    '''Lists the integers 0 to count - 1, at most cap per page, reporting a
+    total of reported. Pages starting at an offset in fail raise 
+    ServiceFailure once.
+    '''
+
+    def __init__(self, count, cap=None, reported=None, fail=()):
+      self.count = count
+      self.cap = cap
+      self.reported = reported if reported is not None else count
+      self.fail = set(fail)
+      self.requests = []
+      self.connection = self
+
+    def close(self):
+      pass
+
+    def listObjects(self, start=0, count=100, fromDate=None, toDate=None):
+      self.requests.append((start, count))
+      if start in self.fail:
+        self.fail.discard(start)
+        raise d1_common.types.exceptions.ServiceFailure(0, "failed")
+      if self.cap is not None:
+        count = min(count, self.cap)
+      end = min(start + count, self.count)
+      return ObjectList(start, range(start, max(start, end)), self.reported)
+
+  def listAll(lister):
+    res = []
+    for start, olist in lister.pages():
+      #Pages are yielded in order without gaps
+      assert start == len(res), (start, len(res))
+      res.extend(olist.objectInfo)
+    return res
+
+  class TestPipelinedLister(unittest.TestCase):
+
+    def test_pages(self):
+      client = FakeClient(2500)
+      lister = PipelinedLister(lambda: client, pagesize=300)
+      self.assertEqual(range(2500), listAll(lister))
+      self.assertEqual(2500, lister.total)
+
+    def test_shortPages(self):
+      #The node caps pages below the minimum page size
+      client = FakeClient(1000, cap=70)
+      lister = PipelinedLister(lambda: client, pagesize=200, minPageSize=100)
+      self.assertEqual(range(1000), listAll(lister))
+      self.assertEqual(70, lister.maxPageSize)
+      self.assertEqual(70, lister.minPageSize)
+      #Only the pages requested before the cap was seen are short
+      short = [r for r in client.requests if r[1] > 70]
+      self.assertTrue(len(short) <= lister.prefetch + 1, client.requests)
+
+    def test_emptyPage(self):
+      #The node reports more entries than it lists
+      client = FakeClient(250, reported=1000)
+      lister = PipelinedLister(lambda: client, pagesize=100)
+      self.assertEqual(range(250), listAll(lister))
+      self.assertEqual(250, lister.total)
+
+    def test_retry(self):
+      client = FakeClient(500, fail=(200, ))
+      lister = PipelinedLister(lambda: client, pagesize=100, maxPageSize=100)
+      self.assertEqual(range(500), listAll(lister))
+      self.assertEqual(2, client.requests.count((200, 100)))
+      client = FakeClient(500, fail=(200, ))
+      lister = PipelinedLister(lambda: client, pagesize=100, maxPageSize=100,
+                               trys=0)
+      self.assertRaises(d1_common.types.exceptions.ServiceFailure,
+                        listAll, lister)
+
+    def test_adapt(self):
+      lister = PipelinedLister(None, pagesize=1000, targetSeconds=5.0)
+      request = _PageRequest(0, 1000)
+      request.result = ObjectList(0, range(1000), 10000)
+      #Fast pages grow the page size, by at most a factor of two
+      request.elapsed = 0.5
+      lister._adapt(request)
+      self.assertEqual(2000, lister.pagesize)
+      #Slow pages shrink it, by at most a factor of two
+      request.elapsed = 50.0
+      lister._adapt(request)
+      self.assertEqual(1000, lister.pagesize)
+      lister.maxPageSize = 1500
+      request.elapsed = 0.1
+      lister._adapt(request)
+      self.assertEqual(1500, lister.pagesize)
+      lister.pagesize = 150
+      request.elapsed = 100.0
+      lister._adapt(request)
+      self.assertEqual(MIN_PAGE_SIZE, lister.pagesize)
+
+    def test_splitWindows(self):
+      self.assertEqual([(None, 60000.0)], splitWindows(None, 60000.0, 1))
+      self.assertEqual([(56000.0, 56500.0), (56500.0, 57000.0)],
+                       splitWindows(56000.0, 57000.0, 2))
+      windows = splitWindows(None, 56000.0, 3, epoch=55700.0)
+      self.assertEqual([(None, 55800.0), (55800.0, 55900.0), 
+                        (55900.0, 56000.0)], windows)
+
+  class FakeLister(object):
+
+    def __init__(self, pages, error=None):
+      self._pages = pages
+      self.error = error
+
+    def pages(self):
+      for start, olist in self._pages:
+        yield start, olist
+      if self.error is not None:
+        raise self.error
+
+  class TestMergePages(unittest.TestCase):
+
+    def test_merge(self):
+      listers = [FakeLister([(i, "a%d" % i) for i in xrange(5)]),
+                 FakeLister([(i, "b%d" % i) for i in xrange(3)])]
+      res = list(mergePages(listers))
+      self.assertEqual(8, len(res))
+      for index, name in ((0, "a"), (1, "b")):
+        self.assertEqual([start for i, start, olist in res if i == index],
+                         range([5, 3][index]))
+
+    def test_error(self):
+      listers = [FakeLister([(i, "a%d" % i) for i in xrange(5)]),
+                 FakeLister([(0, "b0")], error=ValueError("failed"))]
+      self.assertRaises(ValueError, list, mergePages(listers))
+
+  unittest.main()
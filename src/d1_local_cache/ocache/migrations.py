@@ -0,0 +1,133 @@
+'''
+Created on Oct 17, 2026
+
+Provides versioned schema migrations for the cache database.
+
+models.Base.metadata.create_all() creates tables that are missing, along with 
+their indexes, but leaves tables that already exist untouched. The migrations 
+here bring an existing cache.sqdb up to the current schema in place. Each 
+migration is applied once, in order, and the version reached is recorded in 
+the meta table under SCHEMA_VERSION_KEY.
+
+Migrations must be safe to apply to a database that create_all() has just 
+built with the current models, since a new cache starts at version 0.
+'''
+
+import logging
+from sqlalchemy import text
+from d1_local_cache.ocache import models
+
+SCHEMA_VERSION_KEY = "schema_version"
+
+
+def _createIndex(session, name, table, columns):
+  session.execute(text("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % \
+                       (name, table, ", ".join(columns))))
+
+
+def _migration_001(session):
+  '''Secondary indexes on cacheentry for the count, summary and work selection
+  queries.
+  '''
+  _createIndex(session, "ix_cacheentry_format_sysmstatus", "cacheentry",
+               ["format_id", "sysmstatus"])
+  _createIndex(session, "ix_cacheentry_format_contentstatus", "cacheentry",
+               ["format_id", "contentstatus"])
+  _createIndex(session, "ix_cacheentry_uploaded", "cacheentry", ["uploaded"])
+  _createIndex(session, "ix_cacheentry_modified", "cacheentry", ["modified"])
+  _createIndex(session, "ix_cacheentry_tstamp", "cacheentry", ["tstamp"])
+  session.execute(text("ANALYZE cacheentry"))
+
+
+def _addColumn(session, table, column, coltype):
+  columns = [row[1] for row in 
+             session.execute(text("PRAGMA table_info(%s)" % table))]
+  if column not in columns:
+    session.execute(text("ALTER TABLE %s ADD COLUMN %s %s" % \
+                         (table, column, coltype)))
+
+
+def _migration_002(session):
+  '''Object checksum columns on cacheentry, used to store content by 
+  checksum.
+  '''
+  _addColumn(session, "cacheentry", "checksum", "VARCHAR")
+  _addColumn(session, "cacheentry", "checksum_algorithm", "VARCHAR")
+  _createIndex(session, "ix_cacheentry_checksum", "cacheentry", ["checksum"])
+
+
+def _migration_003(session):
+  '''Digest, size and modification time of the stored system metadata and
+  content, used to verify the cached copies.
+  '''
+  for prefix in ("sysmeta", "content"):
+    _addColumn(session, "cacheentry", prefix + "_md5", "VARCHAR")
+    _addColumn(session, "cacheentry", prefix + "_size", "BIGINT")
+    _addColumn(session, "cacheentry", prefix + "_mtime", "FLOAT")
+
+
+def _migration_004(session):
+  '''Index on cacheentry.suid_id, since short uids are resolved by decoding
+  them to the ShortUid id rather than joining on shortuid.uid.
+  '''
+  _createIndex(session, "ix_cacheentry_suid_id", "cacheentry", ["suid_id"])
+
+
+def _migration_005(session):
+  '''Rewrites the meta table values pickled by PickleType in the compact 
+  form of models.dumpValue, which is JSON for most values.
+  '''
+  rows = session.execute(text("SELECT key, value FROM meta")).fetchall()
+  updates = []
+  for key, data in rows:
+    if data is None or not str(data).startswith(models._PICKLE_PROTO):
+      continue
+    value = models.dumpValue(models.loadValue(data))
+    if value != str(data):
+      updates.append({'key': key, 'value': buffer(value)})
+  if len(updates) > 0:
+    session.execute(text("UPDATE meta SET value=:value WHERE key=:key"), 
+                    updates)
+
+
+#Ordered list of (version, migration). Append new migrations to the end.
+MIGRATIONS = [(1, _migration_001),
+              (2, _migration_002),
+              (3, _migration_003),
+              (4, _migration_004),
+              (5, _migration_005),
+              ]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schemaVersion(session):
+  '''Returns the schema version recorded in the database, 0 if none.
+  '''
+  try:
+    return models.PersistedDictionary(session)[SCHEMA_VERSION_KEY]
+  except KeyError:
+    return 0
+
+
+def migrate(session):
+  '''Applies any migrations newer than the recorded schema version. Each 
+  migration is committed together with the new version number. Returns the
+  schema version of the database.
+  '''
+  log = logging.getLogger("migrate")
+  conf = models.PersistedDictionary(session)
+  version = schemaVersion(session)
+  for mversion, migration in MIGRATIONS:
+    if mversion <= version:
+      continue
+    log.info("Migrating cache schema from version %d to %d" % \
+             (version, mversion))
+    try:
+      migration(session)
+      conf[SCHEMA_VERSION_KEY] = mversion
+    except:
+      session.rollback()
+      raise
+    version = mversion
+  return version
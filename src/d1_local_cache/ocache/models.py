@@ -12,25 +12,111 @@ the actual objects identified by PIDs.
 '''
 
 import logging
+import json
+import time
+import cPickle as pickle
+from collections import OrderedDict
 from UserDict import DictMixin
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, PickleType 
-from sqlalchemy import BigInteger
+from sqlalchemy import Column, Integer, String, ForeignKey, Float, LargeBinary
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy import BigInteger, Index, func
 from sqlalchemy.orm import relationship, backref, exc
+from sqlalchemy.sql import text, bindparam
 from d1_local_cache.util import mjd
 from d1_local_cache.util import shortUidgen
 
 Base = declarative_base()
 
+#Maximum number of values bound in a single "IN (...)" clause
+MAX_IN_PARAMETERS = 500
+
 #===============================================================================
 
+#Protocol 2 pickles, as written by PickleType, start with the PROTO opcode
+_PICKLE_PROTO = "\x80"
+
+
+def _fromJSON(value):
+  '''Returns value as loaded from JSON with ASCII strings as str, which is 
+  what the cache stores in its configuration and state.
+  '''
+  if isinstance(value, unicode):
+    try:
+      return value.encode("ascii")
+    except UnicodeEncodeError:
+      return value
+  if isinstance(value, list):
+    return [_fromJSON(v) for v in value]
+  if isinstance(value, dict):
+    return dict([(_fromJSON(k), _fromJSON(v)) for k, v in value.iteritems()])
+  return value
+
+
+def _sameValue(a, b):
+  '''True if a and b are equal and of the same types, other than int and 
+  long which are not told apart.
+  '''
+  numbers = (int, long)
+  if type(a) in numbers and type(b) in numbers:
+    return a == b
+  if type(a) is not type(b):
+    return False
+  if isinstance(a, list):
+    return len(a) == len(b) and all(map(_sameValue, a, b))
+  if isinstance(a, dict):
+    return len(a) == len(b) and \
+           all(map(_sameValue, sorted(a.items()), sorted(b.items())))
+  if isinstance(a, tuple):
+    return len(a) == len(b) and all(map(_sameValue, a, b))
+  return a == b
+
+
+def dumpValue(value):
+  '''Serializes a meta table value as compact JSON, or as a pickle if the 
+  value would not be read back with the same types from JSON (e.g. tuples,
+  binary strings or ASCII unicode strings).
+  '''
+  try:
+    data = json.dumps(value, separators=(',', ':'))
+    if _sameValue(loadValue(data), value):
+      return data
+  except (TypeError, ValueError, UnicodeDecodeError):
+    pass
+  return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def loadValue(data):
+  '''Returns the value serialized by dumpValue, or by PickleType in caches 
+  written before values were stored as JSON.
+  '''
+  if data is None:
+    return None
+  data = str(data)
+  if data.startswith(_PICKLE_PROTO):
+    return pickle.loads(data)
+  return _fromJSON(json.loads(data))
+
+
+class MetaValue(TypeDecorator):
+  '''Column type of meta table values, see dumpValue.
+  '''
+  impl = LargeBinary
+
+  def process_bind_param(self, value, dialect):
+    return dumpValue(value)
+
+  def process_result_value(self, value, dialect):
+    return loadValue(value)
+
+
 class CacheMeta(Base):
   '''Implements a key value store. Used for maintaining state of the cache.
   '''
   __tablename__ = "meta"
   
   key = Column(String, primary_key=True)
-  value = Column(PickleType)
+  value = Column(MetaValue)
   
   def __init__(self, k, v):
     self.key = k
@@ -86,6 +172,17 @@ class CacheEntry(Base):
   require processing the cached copies of system metadata documents.
   '''
   __tablename__ = "cacheentry"
+  #Existing databases get these indexes through migrations._migration_001
+  #and _migration_002
+  __table_args__ = (
+    Index("ix_cacheentry_format_sysmstatus", "format_id", "sysmstatus"),
+    Index("ix_cacheentry_format_contentstatus", "format_id", "contentstatus"),
+    Index("ix_cacheentry_uploaded", "uploaded"),
+    Index("ix_cacheentry_modified", "modified"),
+    Index("ix_cacheentry_tstamp", "tstamp"),
+    Index("ix_cacheentry_checksum", "checksum"),
+    Index("ix_cacheentry_suid_id", "suid_id"),
+  )
   
   pid = Column(String, primary_key=True)
   suid_id = Column(Integer, ForeignKey("shortuid.id"))
@@ -105,6 +202,17 @@ class CacheEntry(Base):
   origin = Column(String) #origin member node
   obsoletes = Column(String) 
   obsoleted_by = Column(String)
+  #Object checksum from the system metadata, added by migrations._migration_002
+  checksum = Column(String)
+  checksum_algorithm = Column(String)
+  #MD5 digest, size and mtime of the stored copies, used to verify them. Added
+  #by migrations._migration_003
+  sysmeta_md5 = Column(String)
+  sysmeta_size = Column(BigInteger)
+  sysmeta_mtime = Column(Float)
+  content_md5 = Column(String)
+  content_size = Column(BigInteger)
+  content_mtime = Column(Float)
   
   suid = relationship("ShortUid", uselist=False, backref=backref("shortuid"))
   format = relationship("D1ObjectFormat", uselist=False, 
@@ -118,47 +226,140 @@ class CacheEntry(Base):
     self.size = size
     self.modified = modified
   
+  @property
+  def uid(self):
+    '''The short uid of the entry, derived from suid_id without loading the
+    ShortUid row.
+    '''
+    return shortUidgen.encode_id(self.suid_id)
+  
   def __repr__(self):
     return u"<CacheEntry('%s', '%s', %d, %.5f, '%s')>" % \
-           (self.pid, self.suid.uid, self.sysmstatus, self.tstamp, self.format)
+           (self.pid, self.uid, self.sysmstatus, self.tstamp, self.format)
     
 #===============================================================================
 
+class CacheCounter(Base):
+  '''Number of cache entries for each combination of format type, system 
+  metadata status and content status. Allows the cache to be summarized without
+  scanning the cacheentry table. The counters are only maintained while enabled
+  in the cache configuration. Entries without a known format are counted with 
+  an empty formatType.
+  '''
+  __tablename__ = "counter"
+  
+  formatType = Column(String, primary_key=True)
+  sysmstatus = Column(Integer, primary_key=True)
+  contentstatus = Column(Integer, primary_key=True)
+  count = Column(BigInteger, default=0)
+
+  def __init__(self, formatType, sysmstatus, contentstatus, count):
+    self.formatType = formatType
+    self.sysmstatus = sysmstatus
+    self.contentstatus = contentstatus
+    self.count = count
+
+  def __repr__(self):
+    return u"<CacheCounter('%s', %d, %d, %d)>" % (self.formatType, 
+                                                  self.sysmstatus,
+                                                  self.contentstatus,
+                                                  self.count)
+
+#===============================================================================
+
+#Marks a deleted key in PersistedDictionary._changes
+_DELETED = object()
+
+
 class PersistedDictionary(DictMixin):
+  '''Dictionary of the values in the meta table.
+
+  All the values are read with a single query on first access and then served
+  from memory. Assigned and deleted keys are tracked and written by flush() in
+  one transaction, with INSERT OR REPLACE. Keys may be assigned without the
+  values being read. flushInterval is the number of 
+  seconds changes may be held before an assignment flushes them: 0, the 
+  default, flushes every assignment, and None only flushes when flush() is 
+  called. Values written by other sessions after the first access are not 
+  seen.
+  '''
   
-  def __init__(self, session):
+  def __init__(self, session, flushInterval=0):
     #super(PersistedDictionary, self).__init__()
     self.session = session
+    self.flushInterval = flushInterval
+    self._values = None
+    #Values assigned since the last flush, _DELETED for deleted keys
+    self._changes = OrderedDict()
+    self._flushed = time.time()
+
+
+  def _load(self):
+    if self._values is None:
+      table = CacheMeta.__table__
+      rows = self.session.execute(table.select().order_by(text("rowid")))
+      self._values = OrderedDict((row[0], row[1]) for row in rows)
+      #Keys assigned before the first read
+      for k, v in self._changes.iteritems():
+        self._values.pop(k, None)
+        if v is not _DELETED:
+          self._values[k] = v
+    return self._values
   
 
   def __getitem__(self, key):
-    res = self.session.query(CacheMeta).get(key)
-    if res is None:
-      raise KeyError()
-    return res.value
+    return self._load()[key]
 
   
   def __setitem__(self, key, value):
-    try:
-      entry = self.session.query(CacheMeta).get(key)
-      entry.value = value
-    except:
-      entry = CacheMeta(key, value)
-      self.session.add(entry)
-    self.session.commit() 
+    #Assignments do not need the stored values to be read
+    if self._values is not None:
+      self._values[key] = value
+    self._changes[key] = value
+    self._changed()
   
 
   def __delitem__(self, key):
-    item = self.__getitem__(key)
-    self.session.delete(item)
+    del self._load()[key]
+    self._changes[key] = _DELETED
+    self._changed()
+
+
+  def __contains__(self, key):
+    return key in self._load()
+
+
+  def __iter__(self):
+    return iter(self._load())
   
 
   def keys(self):
-    res = self.session.query(CacheMeta.key).all()
-    try:
-      return zip(*res)[0]
-    except IndexError:
-      return []
+    return tuple(self._load().keys())
+
+
+  def _changed(self):
+    if self.flushInterval is not None and \
+       time.time() - self._flushed >= self.flushInterval:
+      self.flush()
+
+
+  def flush(self, commit=True):
+    '''Writes the changed keys with one statement for the assigned and one 
+    for the deleted keys and, if commit is True, commits the session. With 
+    commit False the changes are committed with the session's transaction.
+    '''
+    table = CacheMeta.__table__
+    rows = [{'key': k, 'value': v} for k, v in self._changes.iteritems()
+            if v is not _DELETED]
+    deleted = [k for k, v in self._changes.iteritems() if v is _DELETED]
+    if len(rows) > 0:
+      self.session.execute(table.insert().prefix_with("OR REPLACE"), rows)
+    if len(deleted) > 0:
+      self.session.execute(table.delete().where(table.c.key.in_(deleted)))
+    self._changes = OrderedDict()
+    self._flushed = time.time()
+    if commit:
+      self.session.commit()
 
 #===============================================================================
 
@@ -183,6 +384,177 @@ def createCacheEntry(session, pid, format, size, tmod):
   return centry
 
 
+def allocateShortUids(session, count):
+  '''Reserves count consecutive ShortUid ids without touching the database and
+  returns a list of (id, uid) tuples. The ids continue from the current 
+  maximum, matching what the database would assign row by row, so the caller
+  must be the only writer of the shortuid table while the ids are in use.
+  '''
+  maxid = session.query(func.max(ShortUid.id)).scalar()
+  if maxid is None:
+    maxid = 0
+  ids = range(maxid + 1, maxid + count + 1)
+  return zip(ids, shortUidgen.encode_ids(ids))
+
+
+def addObjectCacheEntries(session, entries, counters=False):
+  '''Adds minimal entries to the cache entry table for a batch of 
+  (pid, formatId, size, tmod) tuples. The shortuid and cacheentry rows are 
+  written with bulk inserts and the batch is committed once. If counters is
+  True the entry counters are updated in the same transaction.
+  
+  PIDs that are already recorded, or repeated within the batch, are skipped.
+  Returns the list of PIDs that were added.
+  '''
+  batch = []
+  pids = set()
+  for entry in entries:
+    if entry[0] not in pids:
+      pids.add(entry[0])
+      batch.append(entry)
+  if len(batch) == 0:
+    return []
+  existing = set()
+  pids = list(pids)
+  #SQLite limits the number of bound parameters in a single statement
+  for i in xrange(0, len(pids), MAX_IN_PARAMETERS):
+    for pid, in session.query(CacheEntry.pid)\
+                    .filter(CacheEntry.pid.in_(pids[i:i+MAX_IN_PARAMETERS])):
+      existing.add(pid)
+  batch = [entry for entry in batch if entry[0] not in existing]
+  if len(batch) == 0:
+    return []
+  formats = {}
+  for formatId, formatType in session.query(D1ObjectFormat.formatId,
+                                            D1ObjectFormat.formatType):
+    formats[formatId] = formatType
+  suids = allocateShortUids(session, len(batch))
+  tstamp = mjd.now()
+  suidrows = []
+  entryrows = []
+  typecounts = {}
+  for (pid, formatId, size, tmod), (suid_id, uid) in zip(batch, suids):
+    suidrows.append({'id': suid_id, 'uid': uid})
+    format_id = None
+    if formatId in formats:
+      format_id = formatId
+    formatType = formats.get(format_id)
+    typecounts[formatType] = typecounts.get(formatType, 0) + 1
+    entryrows.append({'pid': pid,
+                      'suid_id': suid_id,
+                      'format_id': format_id,
+                      'tstamp': tstamp,
+                      'size': size,
+                      'modified': tmod})
+  session.execute(ShortUid.__table__.insert(), suidrows)
+  session.execute(CacheEntry.__table__.insert(), entryrows)
+  if counters:
+    for formatType, n in typecounts.iteritems():
+      adjustCounter(session, formatType, 0, 0, n)
+  session.commit()
+  return [entry[0] for entry in batch]
+
+
+def updateCacheEntries(session, rows):
+  '''Updates cache entries with a single executemany UPDATE. rows is a list of
+  dictionaries of column values, each with the same keys including "pid".
+  Does not commit.
+  '''
+  if len(rows) == 0:
+    return
+  table = CacheEntry.__table__
+  columns = [k for k in rows[0].keys() if k != 'pid']
+  values = {}
+  for k in columns:
+    values[k] = bindparam("v_" + k)
+  stmt = table.update().where(table.c.pid == bindparam("v_pid")).values(values)
+  params = []
+  for row in rows:
+    param = {}
+    for k, v in row.iteritems():
+      param["v_" + k] = v
+    params.append(param)
+  session.execute(stmt, params)
+
+
+def adjustCounter(session, formatType, sysmstatus, contentstatus, delta):
+  '''Adds delta to the entry counter for the given format type and status
+  values. Does not commit.
+  '''
+  if formatType is None:
+    formatType = ""
+  params = {'t': formatType, 's': sysmstatus, 'c': contentstatus, 'd': delta}
+  session.execute(text("INSERT OR IGNORE INTO counter "
+                       "(formatType, sysmstatus, contentstatus, count) "
+                       "VALUES (:t, :s, :c, 0)"), params)
+  session.execute(text("UPDATE counter SET count = count + :d "
+                       "WHERE formatType = :t AND sysmstatus = :s "
+                       "AND contentstatus = :c"), params)
+
+
+def setEntryStatus(session, entry, sysmstatus=None, contentstatus=None,
+                   counters=False):
+  '''Sets the system metadata and / or content status of a cache entry. If
+  counters is True the entry counters are moved to the new status in the same
+  transaction. Does not commit.
+  '''
+  oldsysm = entry.sysmstatus
+  oldcontent = entry.contentstatus
+  if sysmstatus is not None:
+    entry.sysmstatus = sysmstatus
+  if contentstatus is not None:
+    entry.contentstatus = contentstatus
+  if counters and (oldsysm != entry.sysmstatus or 
+                   oldcontent != entry.contentstatus):
+    formatType = None
+    if entry.format is not None:
+      formatType = entry.format.formatType
+    adjustCounter(session, formatType, oldsysm, oldcontent, -1)
+    adjustCounter(session, formatType, entry.sysmstatus, entry.contentstatus, 1)
+
+
+def summarizeCacheEntries(session):
+  '''Returns a list of (formatType, sysmstatus, contentstatus, count) tuples
+  covering all cache entries, computed with a single grouped query. formatType
+  is None for entries without a known format.
+  '''
+  res = session.query(D1ObjectFormat.formatType, 
+                      CacheEntry.sysmstatus,
+                      CacheEntry.contentstatus,
+                      func.count(CacheEntry.pid))\
+               .select_from(CacheEntry)\
+               .outerjoin(CacheEntry.format)\
+               .group_by(D1ObjectFormat.formatType,
+                         CacheEntry.sysmstatus,
+                         CacheEntry.contentstatus)
+  return [tuple(row) for row in res]
+
+
+def readCounters(session):
+  '''Returns the maintained entry counters in the same form as 
+  summarizeCacheEntries.
+  '''
+  res = []
+  for counter in session.query(CacheCounter).filter(CacheCounter.count != 0):
+    formatType = counter.formatType
+    if formatType == "":
+      formatType = None
+    res.append((formatType, counter.sysmstatus, counter.contentstatus,
+                counter.count))
+  return res
+
+
+def rebuildCounters(session):
+  '''Replaces the entry counters with values computed from the cacheentry 
+  table and commits.
+  '''
+  session.query(CacheCounter).delete()
+  for formatType, sysmstatus, contentstatus, n in \
+      summarizeCacheEntries(session):
+    adjustCounter(session, formatType, sysmstatus, contentstatus, n)
+  session.commit()
+
+
 def getFormatByFormatId(session, formatId):
   '''Return a format entry given a formatId. The formatId values are identical
   to what is used by the CN from which the cache was generated. 
@@ -224,11 +596,27 @@ def getEntryByPID(session, pid):
   return None
 
 
+def suidToId(suid):
+  '''Returns the ShortUid id that suid is the short uid of, or None if suid is
+  not a short uid.
+  '''
+  try:
+    res = shortUidgen.decode_id(suid)
+  except ValueError:
+    return None
+  #Only the canonical encoding of an id was ever stored
+  if shortUidgen.encode_id(res) != suid:
+    return None
+  return res
+
+
 def getEntryBySUID(session, suid):
   '''Return a cache entry given a short ID (i.e. a local proxy for the PID)
   '''
-  res = session.query(CacheEntry).join(ShortUid).\
-        filter(ShortUid.uid==suid).one()
+  suid_id = suidToId(suid)
+  if suid_id is None:
+    raise exc.NoResultFound("Not a short uid: %s" % suid)
+  res = session.query(CacheEntry).filter(CacheEntry.suid_id==suid_id).one()
   return res
 
 
@@ -281,6 +669,7 @@ if __name__ == "__main__":
       suid = "n242n"
       res = getEntryBySUID(session, suid)
       self.assertEqual(suid, res.suid.uid)
+      self.assertEqual(suid, res.uid)
       self.assertEqual("A_07", res.pid)
       print res
       
@@ -290,7 +679,20 @@ if __name__ == "__main__":
       print res
       
       session.close()
-  
+
+    def test_bulkentries(self):
+      session = self.sessionmaker()
+      entries = []
+      for i in xrange(0,10):
+        entries.append(("B_%.2d" % i, "FGDC-STD-001.1-1999", 1, mjd.now()))
+      added = addObjectCacheEntries(session, entries + entries[0:3])
+      self.assertEqual(10, len(added))
+      self.assertEqual([], addObjectCacheEntries(session, entries))
+      res = getEntryByPID(session, "B_07")
+      self.assertEqual(shortUidgen.encode_id(res.suid.id), res.suid.uid)
+      self.assertEqual("FGDC-STD-001.1-1999", res.format.formatId)
+      session.close()
+
     def test_dict(self):
       session = self.sessionmaker()
       d = PersistedDictionary(session)
@@ -301,7 +703,25 @@ if __name__ == "__main__":
       self.assertEqual(1234, d["2"])
       d["2"] = 5678
       self.assertEqual(5678, d["2"])
+      d["t"] = (1, 2)
+      del d["test"]
+      d = PersistedDictionary(session)
+      self.assertEqual(d.keys(), ("2", "t"))
+      self.assertEqual((1, 2), d["t"])
       session.close()
+
+
+  class TestMetaValue(unittest.TestCase):
+
+    def test_roundtrip(self):
+      for value in ["x", u"x", u"\xe9", "\xe9", 1, 2L**70, 1.5, True, None, 
+                    (1, "a"), [1, "a", u"b"], {"a": {"b": [1, 2]}}, 
+                    {u"a": 1}, {1: "a"}]:
+        res = loadValue(dumpValue(value))
+        self.assertTrue(_sameValue(value, res), (value, res))
+      self.assertEqual('{"baseUrl":"https://cn.dataone.org/cn"}',
+                       dumpValue({"baseUrl": "https://cn.dataone.org/cn"}))
+      self.assertTrue(dumpValue(u"x").startswith(_PICKLE_PROTO))
   
   #logging.basicConfig(level=logging.DEBUG)
   unittest.main()
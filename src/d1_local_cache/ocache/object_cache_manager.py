@@ -17,30 +17,72 @@ operation:
 '''
 
 import os
+import errno
+import hashlib
 import logging
 import datetime
 import time
 import yaml
-import shutil
+import copy
+import multiprocessing
 import threading
-import Queue
+import bisect
+from array import array
 from collections import deque
-from sqlalchemy import create_engine, func, or_
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import create_engine, event, func, or_, not_
+from sqlalchemy.orm import scoped_session, sessionmaker, aliased
 from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.sql import text
 import d1_common.const
 import d1_common.types
 import d1_common.types.generated.dataoneTypes_1_1 as dataoneTypes
-from d1_common import date_time
 from d1_client import d1baseclient
 from d1_client import cnclient
-from d1_client import objectlistiterator
 from d1_local_cache.util import mjd
+from d1_local_cache.util import shortUidgen
+from d1_local_cache.util.instrument import span
 from d1_local_cache.ocache import models
+from d1_local_cache.ocache import migrations
+from d1_local_cache.ocache import workers
+from d1_local_cache.ocache import fetcher
+from d1_local_cache.ocache import lister
+from d1_local_cache.ocache import sysmparse
+from d1_local_cache.ocache import layout as shardlayout
+from d1_local_cache.ocache import storage
+from d1_local_cache.ocache import compression as docompression
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 DEFAULT_CACHE_PATH = "dataone_content"
 DEFAULT_CACHE_DATABASE = "cache.sqdb"
 MAX_WORKER_THREADS = 6
+#Default number of fetch worker threads
+DEFAULT_WORKERS = MAX_WORKER_THREADS - 1
+#Number of new identifiers written to the database in a single transaction
+DEFAULT_INGEST_CHUNK_SIZE = 1000
+#Sealed segments modified more recently than this many seconds are not
+#compacted
+DEFAULT_COMPACT_MIN_AGE = 3600
+#Number of entries read per keyset query when selecting work for the fetchers
+DEFAULT_WORK_BATCH_SIZE = 1000
+#A new sync lists objects modified up to this many seconds before the newest
+#modification date in the cache, to pick up objects that were listed late
+DEFAULT_SYNC_OVERLAP = 3600
+#Outcomes of verifying a stored copy. Recorded copies were intact, or could not
+#be checked against a digest, and had their digest, size and mtime recorded.
+VERIFY_OK = "ok"
+VERIFY_RECORDED = "recorded"
+VERIFY_MISSING = "missing"
+VERIFY_CORRUPT = "corrupt"
+#Applied to every connection to the cache database. WAL lets readers proceed
+#while the result writer commits.
+DEFAULT_SQLITE_PRAGMAS = [("journal_mode", "WAL"),
+                          ("synchronous", "NORMAL"),
+                          ("cache_size", "-65536"),
+                          ("temp_store", "MEMORY"),
+                          ]
 
 class ObjectCache():
   '''
@@ -52,7 +94,17 @@ class ObjectCache():
                baseUrl=None,
                loadData=False,
                instrument=None,
-               certificate=None):
+               certificate=None,
+               nworkers=DEFAULT_WORKERS,
+               ingestChunkSize=DEFAULT_INGEST_CHUNK_SIZE,
+               workBatchSize=DEFAULT_WORK_BATCH_SIZE,
+               writeBatchSize=workers.DEFAULT_WRITE_BATCH_SIZE,
+               writeInterval=workers.DEFAULT_WRITE_INTERVAL,
+               sqlitePragmas=DEFAULT_SQLITE_PRAGMAS,
+               layout=None,
+               sysmetaStorage=None,
+               compression=None,
+               contentAddressed=None):
     self._log = logging.getLogger("ObjectCache")
     self.instrument = instrument
     self.cachePath = cachePath
@@ -61,10 +113,23 @@ class ObjectCache():
     self.sessionmaker = None
     self.engine = None
     self.config = {}
-    self._pidlist = []
-    self._maxthreads = MAX_WORKER_THREADS
+    self._pidlist = set()
+    self.nworkers = nworkers
+    self._maxthreads = max(MAX_WORKER_THREADS, nworkers + 1)
     self._certificate = certificate
+    self.ingestChunkSize = ingestChunkSize
+    self.workBatchSize = workBatchSize
+    self.writeBatchSize = writeBatchSize
+    self.writeInterval = writeInterval
+    self.sqlitePragmas = sqlitePragmas
+    #Content directories known to exist, shared by the worker threads
+    self._knownDirs = set()
+    self._dirLock = threading.Lock()
+    self._layout = None
+    self._previousLayout = None
     self.setUp()
+    self._setUpLayout(layout)
+    self._setUpStorage(sysmetaStorage, compression, contentAddressed)
     if not baseUrl is None:
       self.config["baseUrl"] = baseUrl
 
@@ -83,15 +148,27 @@ class ObjectCache():
     if not os.path.exists(contentpath):
       os.makedirs(contentpath)
     #populate with object formats if necessary
+    #Pool size allows for the main thread and the result writer
     self.engine = create_engine(self._cacheDataBaseName(),
                                 poolclass=SingletonThreadPool, 
-                                pool_size=self._maxthreads)
+                                pool_size=self._maxthreads + 2)
+    event.listen(self.engine, "connect", self._setSqlitePragmas)
     self.sessionmaker = scoped_session(sessionmaker(bind=self.engine))
     models.Base.metadata.bind = self.engine
     models.Base.metadata.create_all() 
+    session = self.sessionmaker()
+    migrations.migrate(session)
+    session.close()
     self.loadState()
 
 
+  def _setSqlitePragmas(self, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in self.sqlitePragmas:
+      cursor.execute("PRAGMA %s=%s" % (name, value))
+    cursor.close()
+
+
   def loadState(self):
     conf = models.PersistedDictionary(self.sessionmaker())
     for k in conf.keys():
@@ -99,9 +176,12 @@ class ObjectCache():
     
 
   def storeState(self):
-    conf = models.PersistedDictionary(self.sessionmaker())
+    #Only changed values are written, in a single transaction
+    conf = models.PersistedDictionary(self.sessionmaker(), flushInterval=None)
     for k in self.config.keys():
-      conf[k] = self.config[k]
+      if not k in conf or conf[k] != self.config[k]:
+        conf[k] = self.config[k]
+    conf.flush()
 
 
   @property
@@ -121,12 +201,14 @@ class ObjectCache():
     
     
   def populatePidList(self):
-    '''Loads all pids from the cache database into a list
+    '''Loads all pids from the cache database into a set. This is no longer 
+    needed for loading object lists, which dedup against the database.
     '''
     session = self.sessionmaker()
-    self._pidlist = []
+    self._pidlist = set()
     for pid, in session.query(models.CacheEntry.pid):
-      self._pidlist.append(pid)
+      self._pidlist.add(pid)
+    session.close()
     
 
   @property
@@ -148,6 +230,8 @@ class ObjectCache():
     session.commit()
     session.query(models.D1ObjectFormat).delete()
     session.commit()
+    session.query(models.CacheCounter).delete()
+    session.commit()
     
 
   @property
@@ -181,20 +265,408 @@ class ObjectCache():
     self.config['lastLoaded'] = v
     
 
-  def getObjectPath(self, suid, isSystemMetadata=True):
-    subf = suid[0:1]
+  def _setUpLayout(self, requested):
+    '''Loads the content directory layout from the cache configuration. A 
+    cache without a recorded layout keeps the legacy layout if it has cached 
+    files, otherwise it uses the requested layout (default DEFAULT_LAYOUT). 
+    Use relayout() to change the layout of an existing cache.
+    '''
+    if self.config.get('layout') is not None:
+      self._layout = shardlayout.ShardLayout.fromDict(self.config['layout'])
+      if requested is not None and requested != self._layout:
+        self._log.warn("Cache uses %s, ignoring requested %s. Use relayout() "
+                       "to change the layout.", self._layout, requested)
+    else:
+      session = self.sessionmaker()
+      cached = session.query(models.CacheEntry.pid)\
+                      .filter(or_(models.CacheEntry.sysmeta != None,
+                                  models.CacheEntry.content != None))\
+                      .first()
+      session.close()
+      if cached is not None:
+        self._layout = shardlayout.LEGACY_LAYOUT
+      elif requested is not None:
+        self._layout = requested
+      else:
+        self._layout = shardlayout.DEFAULT_LAYOUT
+      self.config['layout'] = self._layout.toDict()
+      self.storeState()
+    if self.config.get('layoutPrevious') is not None:
+      self._previousLayout = shardlayout.ShardLayout.fromDict(
+                                                 self.config['layoutPrevious'])
+
+
+  @property
+  def layout(self):
+    return self._layout
+
+
+  def _setUpStorage(self, sysmetaStorage, compression, contentAddressed):
+    '''Sets up the storage backends. System metadata is stored in files 
+    (storage.STORAGE_FILE, the default) or packed in segments 
+    (storage.STORAGE_SEGMENT). Documents may be compressed as they are stored
+    (compression.COMPRESSION_GZIP or COMPRESSION_ZSTD, default 
+    COMPRESSION_NONE). If contentAddressed is True, content is stored once per
+    checksum and shared by the entries with that checksum. The choices are 
+    recorded in the cache configuration and may be changed at any time, since
+    documents written in any of these ways remain readable.
+    '''
+    if sysmetaStorage is not None:
+      if sysmetaStorage not in (storage.STORAGE_FILE, storage.STORAGE_SEGMENT):
+        raise ValueError("Unknown storage backend: %s" % sysmetaStorage)
+      if self.config.get('sysmetaStorage') != sysmetaStorage:
+        self.config['sysmetaStorage'] = sysmetaStorage
+        self.storeState()
+    if compression is not None:
+      if compression not in (docompression.COMPRESSION_NONE, 
+                             docompression.COMPRESSION_GZIP,
+                             docompression.COMPRESSION_ZSTD):
+        raise ValueError("Unknown compression method: %s" % compression)
+      if self.config.get('compression') != compression:
+        self.config['compression'] = compression
+        self.storeState()
+    if contentAddressed is not None:
+      if self.config.get('contentAddressed', False) != contentAddressed:
+        self.config['contentAddressed'] = contentAddressed
+        self.storeState()
+    segmentRoot = os.path.abspath(os.path.join(self.cachePath, "segments"))
+    dictionaryRoot = os.path.abspath(os.path.join(self.cachePath, "dictionary"))
+    self.segments = storage.SegmentStore(segmentRoot)
+    self.openLocation = storage.LocationOpener(segmentRoot, self.segments,
+                                               dictionaryRoot=dictionaryRoot)
+    self.blobRoot = os.path.abspath(os.path.join(self.cachePath, "blobs"))
+    contentPath = lambda suid: os.path.abspath(
+                               self.getObjectPath(suid, isSystemMetadata=False))
+    if self.contentAddressed:
+      self.contentStore = storage.ContentAddressedStore(contentPath, 
+                                                        self._blobPath)
+    else:
+      self.contentStore = storage.FileStore(contentPath)
+    if self.config.get('sysmetaStorage') == storage.STORAGE_SEGMENT:
+      self.sysmetaStore = self.segments
+    else:
+      self.sysmetaStore = storage.FileStore(
+        lambda suid: os.path.abspath(self.getObjectPath(suid, 
+                                                        isSystemMetadata=True)))
+    self._setUpCompression()
+
+
+  @property
+  def contentAddressed(self):
+    return self.config.get('contentAddressed', False)
+
+
+  def _blobPath(self, blob):
+    '''Returns the path of the content addressed file named blob, e.g. 
+    blobs/md5/d4/1d/d41d8cd98f00b204e9800998ecf8427e
+    '''
+    algorithm, checksum = blob.split("/")
+    path = os.path.join(self.blobRoot, algorithm, checksum[0:2], 
+                        checksum[2:4])
+    self._ensureDirectory(path)
+    return os.path.join(path, checksum)
+
+
+  def _setUpCompression(self):
+    '''Sets the compressors of the stores from the cache configuration. 
+    System metadata is compressed with the trained zstd dictionary, if any.
+    '''
+    method = self.config.get('compression', docompression.COMPRESSION_NONE)
+    if method is None or method == docompression.COMPRESSION_NONE:
+      self.contentStore.compressor = None
+      self.sysmetaStore.compressor = None
+      return
+    self.contentStore.compressor = docompression.Compressor(method)
+    dictionary = None
+    dictId = self.config.get('sysmetaDictionary')
+    if method == docompression.COMPRESSION_ZSTD and dictId is not None:
+      dictionary = self.openLocation.dictionaries.get(dictId)
+    self.sysmetaStore.compressor = docompression.Compressor(method,
+                                                       dictionary=dictionary)
+
+
+  def trainSysmetaDictionary(self, samples=2000, 
+                             size=docompression.DEFAULT_DICTIONARY_SIZE):
+    '''Trains a zstd dictionary on up to samples randomly chosen cached 
+    system metadata documents and uses it to compress system metadata from 
+    now on. Requires the zstandard package. Returns the dictionary id.
+    '''
+    session = self.sessionmaker()
+    try:
+      rows = session.query(models.CacheEntry.sysmeta)\
+                    .filter(models.CacheEntry.sysmstatus==200)\
+                    .filter(models.CacheEntry.sysmeta != None)\
+                    .order_by(func.random()).limit(samples).all()
+    finally:
+      session.close()
+    documents = []
+    for (location, ) in rows:
+      stream = self.openLocation(location)
+      try:
+        documents.append(stream.read())
+      finally:
+        stream.close()
+    dictId = self.openLocation.dictionaries.train(documents, size=size)
+    self._log.info("Trained dictionary %d on %d documents", dictId, 
+                   len(documents))
+    self.config['sysmetaDictionary'] = dictId
+    self.storeState()
+    self._setUpCompression()
+    return dictId
+
+
+  def openContent(self, suid):
+    '''Returns a stream of the cached content of the object with short uid 
+    suid, decompressed if necessary.
+    '''
+    return self.openLocation(self._objectLocation(suid, 
+                                                  isSystemMetadata=False))
+
+
+  def _ensureDirectory(self, path):
+    '''Creates the directory path unless it is already known to exist.
+    '''
+    if path in self._knownDirs:
+      return
+    with self._dirLock:
+      if path in self._knownDirs:
+        return
+      try:
+        os.makedirs(path)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+      self._knownDirs.add(path)
+
+
+  def getObjectPath(self, suid, isSystemMetadata=True, layout=None, 
+                    create=True):
+    '''Returns the path of the cached system metadata or content file for 
+    suid under layout (default the current layout of the cache), creating the
+    directory if create is True.
+    '''
+    if layout is None:
+      layout = self._layout
     fname = "%s_content.xml" % suid
     if isSystemMetadata:
       fname = "%s_sysm.xml" % suid
-    path = os.path.join(self.cachePath, "content", subf)
-    if not os.path.exists(os.path.abspath(path)):
-      os.makedirs(os.path.abspath(path))
+    path = layout.directory(os.path.join(self.cachePath, "content"), suid)
+    if create:
+      self._ensureDirectory(os.path.abspath(path))
     return os.path.join(path, fname)
 
 
-  def getSystemMetadata(self, suid):
-    fpath = self.getObjectPath(suid, isSystemMetadata=True)
-    xml = file(fpath, 'rb').read()
+  def _locateObjectPath(self, suid, isSystemMetadata=True):
+    '''Returns the path of an existing cached file for suid. While a relayout
+    is in progress the file may still be in the previous layout.
+    '''
+    fpath = self.getObjectPath(suid, isSystemMetadata=isSystemMetadata, 
+                               create=False)
+    if self._previousLayout is None or os.path.exists(fpath):
+      return fpath
+    opath = self.getObjectPath(suid, isSystemMetadata=isSystemMetadata,
+                               layout=self._previousLayout, create=False)
+    if os.path.exists(opath):
+      return opath
+    return fpath
+
+
+  def _objectLocation(self, suid, isSystemMetadata=True):
+    '''Returns the storage location of the system metadata or content for 
+    suid. Files are found from the layout. Otherwise the location recorded 
+    in the cache database is used, which covers segment and content addressed
+    locations and files written in another layout by a process that was 
+    running when the cache was relayed out.
+    '''
+    fpath = self._locateObjectPath(suid, isSystemMetadata=isSystemMetadata)
+    if os.path.exists(fpath):
+      return fpath
+    column = models.CacheEntry.content
+    if isSystemMetadata:
+      column = models.CacheEntry.sysmeta
+    #The thread's session is not closed here, the caller may be using it
+    session = self.sessionmaker()
+    row = session.query(column)\
+                 .filter(models.CacheEntry.suid_id==models.suidToId(suid))\
+                 .first()
+    if row is None or row[0] is None:
+      return fpath
+    if storage.isSegmentLocation(row[0]) or os.path.exists(row[0]):
+      return row[0]
+    return fpath
+
+
+  def compactSegments(self, minGarbage=0.5, batchSize=1000,
+                      minAge=DEFAULT_COMPACT_MIN_AGE):
+    '''Reclaims the space of replaced documents in the sysmeta segments. 
+
+    Each sealed segment in which at least minGarbage of the bytes are no 
+    longer referenced by a cache entry has its remaining documents copied to 
+    the active segment, in transactions of batchSize entries, and is then 
+    removed. An entry is only updated if it still refers to the copied 
+    location, and appends are locked across processes, so an update may run 
+    at the same time. Segments written to in the last minAge seconds are 
+    skipped, since documents appended to them may not have had their 
+    location committed yet. Returns the number of bytes reclaimed.
+    '''
+    segments = self.segments.segments()
+    if len(segments) == 0:
+      return 0
+    active = self.segments.activeSegment()
+    session = self.sessionmaker()
+    reclaimed = 0
+    try:
+      live = {}
+      locations = session.query(models.CacheEntry.sysmeta)\
+                         .filter(models.CacheEntry.sysmeta.like(
+                                                 storage.SEGMENT_PREFIX + "%"))
+      for (location, ) in locations:
+        segment, offset, length = storage.parseSegmentLocation(location)
+        live[segment] = live.get(segment, 0) + length
+      update = text("UPDATE cacheentry SET sysmeta=:new "
+                    "WHERE pid=:pid AND sysmeta=:old")
+      for segment in segments:
+        if segment == active:
+          continue
+        if time.time() - os.path.getmtime(
+                           self.segments.segmentPath(segment)) < minAge:
+          continue
+        size = self.segments.segmentSize(segment)
+        used = live.get(segment, 0)
+        if size > 0 and float(size - used) / size < minGarbage:
+          continue
+        self._log.info("Compacting segment %d, %d of %d bytes in use", 
+                       segment, used, size)
+        prefix = "%s%d:%%" % (storage.SEGMENT_PREFIX, segment)
+        while True:
+          rows = session.query(models.CacheEntry.pid, 
+                               models.CacheEntry.sysmeta)\
+                        .filter(models.CacheEntry.sysmeta.like(prefix))\
+                        .limit(batchSize).all()
+          if len(rows) == 0:
+            break
+          params = []
+          for pid, location in rows:
+            data = str(self.segments.read(location))
+            #Keeps the compression method recorded in the location
+            extension = location[len(docompression.plainLocation(location)):]
+            params.append({'pid': pid, 'old': location, 
+                           'new': self.segments.append(data) + extension})
+          session.execute(update, params)
+          session.commit()
+        self.segments.drop(segment)
+        reclaimed += size - used
+    finally:
+      session.close()
+    return reclaimed
+
+
+  def _moveObjectFile(self, path, npath):
+    '''Moves a cached file to npath. If npath already exists it was written 
+    by a fetch since the file was listed, and the old file is just removed. 
+    Returns True if the file was moved.
+    '''
+    self._ensureDirectory(os.path.abspath(os.path.dirname(npath)))
+    if os.path.exists(npath):
+      if os.path.exists(path):
+        os.remove(path)
+      return False
+    try:
+      os.rename(path, npath)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      return False
+    return True
+
+
+  def relayout(self, layout, batchSize=1000):
+    '''Moves the cached files to a new directory layout and updates the 
+    sysmeta and content paths of the cache entries.
+
+    The cache remains usable from this process while this runs. New files are
+    written in the new layout straight away, and reads of files that have not
+    been moved yet fall back to the previous layout. An interrupted relayout 
+    is completed by calling this again with the same layout.
+
+    Other processes, such as a running update, keep the layout they started 
+    with. Files they write are still found through the path recorded in the 
+    cache database, but they stay in the old layout, and a file they rewrite
+    while it is being moved may be recorded at the wrong path. Stop other 
+    writers before a relayout, or run it again once they have stopped. 
+    Directories of the previous layout are left in place. Documents held in 
+    segments and content addressed files are not affected.
+
+    Returns the number of files moved.
+    '''
+    if isinstance(layout, dict):
+      layout = shardlayout.ShardLayout.fromDict(layout)
+    if layout != self._layout:
+      self._previousLayout = self._layout
+      self._layout = layout
+      self.config['layoutPrevious'] = self._previousLayout.toDict()
+      self.config['layout'] = layout.toDict()
+      self.storeState()
+    session = self.sessionmaker()
+    moved = 0
+    last = None
+    try:
+      while True:
+        q = session.query(models.CacheEntry.pid, models.CacheEntry.suid_id,
+                          models.CacheEntry.sysmeta, 
+                          models.CacheEntry.content)\
+                   .filter(or_(models.CacheEntry.sysmeta != None,
+                               models.CacheEntry.content != None))
+        if last is not None:
+          q = q.filter(models.CacheEntry.pid > last)
+        rows = q.order_by(models.CacheEntry.pid).limit(batchSize).all()
+        if len(rows) == 0:
+          break
+        last = rows[-1][0]
+        updates = []
+        for pid, suid_id, spath, cpath in rows:
+          suid = shortUidgen.encode_id(suid_id)
+          row = {'pid': pid, 'sysmeta': spath, 'content': cpath}
+          for column, isSystemMetadata in (('sysmeta', True), 
+                                           ('content', False)):
+            path = row[column]
+            if path is None or storage.isSegmentLocation(path) or \
+               path.startswith(self.blobRoot):
+              continue
+            npath = self.getObjectPath(suid, isSystemMetadata=isSystemMetadata,
+                                       create=False)
+            npath += path[len(docompression.plainLocation(path)):]
+            if os.path.abspath(path) == os.path.abspath(npath):
+              continue
+            if self._moveObjectFile(path, npath):
+              moved += 1
+            row[column] = npath
+          if row['sysmeta'] != spath or row['content'] != cpath:
+            updates.append(row)
+        models.updateCacheEntries(session, updates)
+        session.commit()
+        self._log.info("Relayout moved %d files, at %s", moved, last)
+    finally:
+      session.close()
+    self._previousLayout = None
+    self.config['layoutPrevious'] = None
+    self.storeState()
+    return moved
+
+
+  def getSystemMetadata(self, suid, full=False):
+    '''Returns the cached system metadata of the object with short uid suid 
+    as sysmparse.SystemMetadataFields, or as the full PyXB object if full is 
+    True.
+    '''
+    location = self._objectLocation(suid, isSystemMetadata=True)
+    stream = self.openLocation(location)
+    try:
+      if not full:
+        return sysmparse.parseStream(stream)
+      xml = stream.read()
+    finally:
+      stream.close()
     xml = xml.replace(u"<accessPolicy/>", u"")
     xml = xml.replace(u"<preferredMemberNode/>", u"")
     xml = xml.replace(u"<blockedMemberNode/>", u"")
@@ -210,30 +682,65 @@ class ObjectCache():
     session.close()
 
 
-  def loadObjectList(self, objectList):
-    self._log.info("Prefetching identifiers...")
-    self.populatePidList()
+  def _addObjectChunk(self, session, chunk):
+    '''Adds a chunk of (pid, formatId, size, tmod) entries to the cache in a 
+    single transaction. Falls back to adding entries one at a time if the bulk
+    insert fails. Returns the number of entries added.
+    '''
+    try:
+      added = models.addObjectCacheEntries(session, chunk,
+                                           counters=self.useCounters)
+    except Exception as e:
+      session.rollback()
+      self._log.warn("Bulk insert failed, adding PIDs individually")
+      self._log.error(e)
+      added = []
+      for entry in chunk:
+        try:
+          added += models.addObjectCacheEntries(session, [entry],
+                                                counters=self.useCounters)
+        except Exception as e:
+          session.rollback()
+          self._log.error("Could not add PID: %s" % entry[0])
+          self._log.error(e)
+    for pid in added:
+      self._log.debug("Added PID: %s" % pid)
+    return len(added)
+
+
+  def loadObjectList(self, objectList, chunkSize=None):
+    '''Adds entries for objects in objectList that are not already in the 
+    cache. New entries are written in chunks of chunkSize, one transaction per
+    chunk. Returns the number of entries added.
+    '''
+    if chunkSize is None:
+      chunkSize = self.ingestChunkSize
     session = self.sessionmaker()
     n = 0
+    chunk = []
+    pending = set()
     self._log.info("Paging through object list...")
     for o in objectList:
       pid = o.identifier.value()
-      #if not models.PIDexists(session, pid):
-      if not pid in self._pidlist:
-        self._log.debug("Adding PID: %s" % pid)
+      #PIDs already in the cache are dropped by a primary key lookup when the 
+      #chunk is written, so only the PIDs of the open chunk are held here.
+      if not pid in pending:
+        pending.add(pid)
         tmod = mjd.dateTime2MJD( o.dateSysMetadataModified )
-        res = models.addObjectCacheEntry(session, 
-                                         pid, 
-                                         o.formatId,
-                                         o.size,
-                                         tmod)
-        if res is None:
-          self._log.error("Could not add PID: %s" % pid)
-        else:
-          self._log.info("Added PID: %s" % pid)
-          n += 1
+        chunk.append((pid, o.formatId, o.size, tmod))
+        if len(chunk) >= chunkSize:
+          with span(self.instrument, "db.insert"):
+            n += self._addObjectChunk(session, chunk)
+          chunk = []
+          pending.clear()
+          self._log.info("Added %d PIDs" % n)
           if self.instrument is not None:
             self.instrument.gauge("PIDs", n)
+    if len(chunk) > 0:
+      with span(self.instrument, "db.insert"):
+        n += self._addObjectChunk(session, chunk)
+      if self.instrument is not None:
+        self.instrument.gauge("PIDs", n)
     session.close()
     return n
     
@@ -282,237 +789,889 @@ class ObjectCache():
       session.close()
 
 
+  def countByTypeOverTime(self, bins, otypes=("DATA", "METADATA", "RESOURCE"),
+                          asArrays=False):
+    '''Returns cumulative counts of objects of each type uploaded on or before
+    each of the MJD values in bins, as {otype: [count, ...]}. This is 
+    equivalent to calling countByTypeDateUploaded for every type and bin, but 
+    reads the (uploaded, formatType) columns in a single pass, then sorts the
+    upload dates and bisects them for each bin. Entries without an upload date
+    are not counted.
+
+    If asArrays is True the counts are returned as NumPy arrays, which requires
+    NumPy to be installed. NumPy is used for the sort and search when 
+    available.
+    '''
+    if asArrays and numpy is None:
+      raise ValueError("NumPy is required for asArrays=True")
+    values = {}
+    for otype in otypes:
+      values[otype] = array('d')
+    session = self.sessionmaker()
+    try:
+      res = session.query(models.CacheEntry.uploaded,
+                          models.D1ObjectFormat.formatType)\
+                   .join(models.CacheEntry.format)\
+                   .filter(models.CacheEntry.uploaded != None)
+      for uploaded, otype in res.yield_per(10000):
+        if otype in values:
+          values[otype].append(uploaded)
+    finally:
+      session.close()
+    counts = {}
+    for otype in otypes:
+      if numpy is not None:
+        uploaded = numpy.frombuffer(values[otype], dtype=numpy.float64).copy()
+        uploaded.sort()
+        counts[otype] = numpy.searchsorted(uploaded, 
+                                           numpy.asarray(bins, dtype=float),
+                                           side='right')
+        if not asArrays:
+          counts[otype] = counts[otype].tolist()
+      else:
+        uploaded = sorted(values[otype])
+        counts[otype] = [bisect.bisect_right(uploaded, b) for b in bins]
+      values[otype] = None
+    return counts
+    
+
+  def summary(self, useCounters=None):
+    '''Returns a dictionary summarizing the content of the cache:
+
+      count: total number of entries
+      lasttimestamp: newest entry timestamp (MJD)
+      newestobject: most recent system metadata modification date (MJD)
+      types: {formatType: {'count': n,
+                           'sysmstatus': {status: n, ...},
+                           'contentstatus': {status: n, ...}}}
+
+    Entries without a known format are reported under the formatType None.
+    The counts come from the maintained counters if useCounters is True, or 
+    from a single grouped query over the cache entries otherwise. By default
+    the counters are used when enabled.
+    '''
+    if useCounters is None:
+      useCounters = self.useCounters
+    session = self.sessionmaker()
+    try:
+      if useCounters:
+        rows = models.readCounters(session)
+      else:
+        rows = models.summarizeCacheEntries(session)
+      newest, modified = session.query(func.max(models.CacheEntry.tstamp),
+                                       func.max(models.CacheEntry.modified))\
+                                .one()
+    finally:
+      session.close()
+    types = {}
+    total = 0
+    for formatType, sysmstatus, contentstatus, n in rows:
+      entry = types.setdefault(formatType, {'count': 0,
+                                            'sysmstatus': {},
+                                            'contentstatus': {}})
+      entry['count'] += n
+      entry['sysmstatus'][sysmstatus] = \
+        entry['sysmstatus'].get(sysmstatus, 0) + n
+      entry['contentstatus'][contentstatus] = \
+        entry['contentstatus'].get(contentstatus, 0) + n
+      total += n
+    return {'count': total,
+            'lasttimestamp': newest,
+            'newestobject': modified,
+            'types': types}
+
+
+  @property
+  def useCounters(self):
+    '''True if the entry counters are maintained for this cache.
+    '''
+    return self.config.get('counters', False)
+
+
+  def enableCounters(self):
+    '''Rebuilds the entry counters from the cache entries and maintains them
+    from now on, so that summary() can be served from the counter table.
+    '''
+    session = self.sessionmaker()
+    models.rebuildCounters(session)
+    session.close()
+    self.config['counters'] = True
+    self.storeState()
+
+
+  def disableCounters(self):
+    self.config['counters'] = False
+    self.storeState()
+
+
   def __str__(self):
     '''Return a string representation of self
     '''
+    summary = self.summary()
     res = {}
     res["baseURL"] = self.baseUrl
-    res["count"] = self.pidcount
-    res["lasttimestamp"] = self.newestEntry
-    res["newestobject"] = self.lastModified
+    res["count"] = summary['count']
+    res["lasttimestamp"] = summary['lasttimestamp']
+    res["newestobject"] = summary['newestobject']
     res['numzerostatus'] = 0
-    counts = {}
-    for otype in ["DATA", "METADATA", "RESOURCE"]:
-      counts[otype] = self.countByType(otype=otype, status=None)
-    res['counts'] = counts
-    counts = {}
+    for key in ['counts', 'zcounts', 'okcounts', 'cokcounts']:
+      res[key] = {}
     for otype in ["DATA", "METADATA", "RESOURCE"]:
-      counts[otype] = self.countByType(otype=otype, status=0)
-    res['zcounts'] = counts
-    counts = {}
-    for otype in ["DATA", "METADATA", "RESOURCE"]:
-      counts[otype] = self.countByType(otype=otype, status=200)
-    res['okcounts'] = counts
-    counts = {}
-    for otype in ["DATA", "METADATA", "RESOURCE"]:
-      counts[otype] = self.countByType(otype=otype, cstatus=200)
-    res['cokcounts'] = counts
+      entry = summary['types'].get(otype, {'count': 0,
+                                           'sysmstatus': {},
+                                           'contentstatus': {}})
+      res['counts'][otype] = entry['count']
+      res['zcounts'][otype] = entry['sysmstatus'].get(0, 0)
+      res['okcounts'][otype] = entry['sysmstatus'].get(200, 0)
+      res['cokcounts'][otype] = entry['contentstatus'].get(200, 0)
     return yaml.dump(res)
     
 
-  def loadSystemMetadata(self, withstatus=0):
-    #Queue to hold the tasks that need to be processed
-    Q = Queue.Queue()
+  def _applySysmetaResult(self, session, result):
+    '''Records a (pid, stored, status, columns) system metadata fetch result,
+    where stored is the storage.Stored of the document and columns are the 
+    values derived from it, or None. Called by the result writer.
+    '''
+    pid, stored, status, columns = result
+    wo = session.query(models.CacheEntry).get(pid)
+    wo.sysmeta = stored.location
+    wo.sysmeta_md5 = stored.digest
+    wo.sysmeta_size = stored.size
+    wo.sysmeta_mtime = stored.mtime
+    if columns is not None:
+      for k, v in columns.iteritems():
+        setattr(wo, k, v)
+    models.setEntryStatus(session, wo, sysmstatus=status,
+                          counters=self.useCounters)
+
+
+  def _applyContentResult(self, session, result):
+    '''Records a (pid, stored, status) content fetch result. Called by the 
+    result writer.
+    '''
+    pid, stored, status = result
+    wo = session.query(models.CacheEntry).get(pid)
+    wo.content = stored.location
+    wo.content_md5 = stored.digest
+    wo.content_size = stored.size
+    wo.content_mtime = stored.mtime
+    models.setEntryStatus(session, wo, contentstatus=status,
+                          counters=self.useCounters)
+
+
+  def _keysetBatches(self, session, query):
+    '''Yields the rows of query, whose first column must be the PID, in 
+    lists of up to workBatchSize rows read in PID order with keyset queries.
+    Only one batch is held in memory and no cursor is kept open while the 
+    rows are processed, so work can be dispatched as soon as the first batch
+    is read and the result writer is not blocked by a long running read.
+    '''
+    last = None
+    while True:
+      q = query
+      if last is not None:
+        q = q.filter(models.CacheEntry.pid > last)
+      rows = q.order_by(models.CacheEntry.pid).limit(self.workBatchSize).all()
+      session.commit()
+      if len(rows) == 0:
+        break
+      last = rows[-1][0]
+      yield rows
+
+
+  def _keysetWork(self, session, query):
+    '''Yields the rows of query read in batches by _keysetBatches.
+    '''
+    for rows in self._keysetBatches(session, query):
+      for row in rows:
+        yield row
+
+
+  def _sysmetaWork(self, session, withstatus=0, first=None):
+    '''Yields (pid, suid) for entries with the given system metadata status,
+    read in keyset batches. Entries for PIDs listed in first are yielded
+    before the others.
+    '''
+    work = session.query(models.CacheEntry.pid, models.CacheEntry.suid_id)\
+                  .filter(models.CacheEntry.sysmstatus==withstatus)
+    encode_id = shortUidgen.encode_id
+    done = set()
+    if first:
+      for i in xrange(0, len(first), models.MAX_IN_PARAMETERS):
+        pids = first[i:i+models.MAX_IN_PARAMETERS]
+        for pid, suid_id in work.filter(models.CacheEntry.pid.in_(pids)).all():
+          done.add(pid)
+          yield pid, encode_id(suid_id)
+    for pid, suid_id in self._keysetWork(session, work):
+      if not pid in done:
+        yield pid, encode_id(suid_id)
+
+
+  def _contentWork(self, session):
+    '''Yields (pid, suid) for science metadata and resource map entries 
+    whose content has not been retrieved, read in keyset batches. 
+
+    If the cache is content addressed, yields (pid, (suid, blob)) instead, 
+    where blob is the storage.blobName of the checksum. Entries whose 
+    checksum has already been stored are skipped, they are linked to that 
+    content by _linkKnownContent.
+    '''
+    E = models.CacheEntry
+    columns = [E.pid, E.suid_id]
+    if self.contentAddressed:
+      columns += [E.checksum_algorithm, E.checksum]
+    work = session.query(*columns)\
+                  .join(E.format)\
+                  .filter(or_(models.D1ObjectFormat.formatType=="METADATA", 
+                              models.D1ObjectFormat.formatType=="RESOURCE"))\
+                  .filter(E.contentstatus==0)
+    encode_id = shortUidgen.encode_id
+    if not self.contentAddressed:
+      for pid, suid_id in self._keysetWork(session, work):
+        yield pid, encode_id(suid_id)
+      return
+    #Checksums already stored, e.g. by an earlier batch. The content is 
+    #linked by _linkKnownContent.
+    K = aliased(models.CacheEntry)
+    stored = session.query(K.pid)\
+               .filter(K.checksum==E.checksum)\
+               .filter(K.checksum_algorithm==E.checksum_algorithm)\
+               .filter(K.contentstatus==200)\
+               .filter(K.content.like(self.blobRoot + "%"))
+    work = work.filter(not_(stored.exists()))
+    for rows in self._keysetBatches(session, work):
+      #Only the first entry for a checksum in a batch is fetched. If it fails
+      #the others are selected again by the next run.
+      seen = set()
+      for pid, suid_id, algorithm, checksum in rows:
+        blob = storage.blobName(algorithm, checksum)
+        if blob is not None:
+          if blob in seen:
+            continue
+          seen.add(blob)
+        yield pid, (encode_id(suid_id), blob)
+
+
+  def _linkKnownContent(self, session):
+    '''Points science metadata and resource map entries whose content has 
+    not been retrieved at the content addressed file of another entry with 
+    the same checksum, so the content is not downloaded again. Returns the 
+    number of entries linked.
+    '''
+    known = ("SELECT k.%s FROM cacheentry k "
+             "WHERE k.checksum = cacheentry.checksum "
+             "AND k.checksum_algorithm = cacheentry.checksum_algorithm "
+             "AND k.contentstatus = 200 AND k.content LIKE :blobs "
+             "LIMIT 1")
+    pending = ("cacheentry.contentstatus = 0 "
+               "AND cacheentry.checksum IS NOT NULL "
+               "AND cacheentry.format_id IN (SELECT formatId FROM formatid "
+               "WHERE formatType IN ('METADATA', 'RESOURCE')) "
+               "AND EXISTS (%s)" % (known % "content"))
+    params = {'blobs': self.blobRoot + "%"}
+    try:
+      if self.useCounters:
+        counts = session.execute(text(
+                   "SELECT formatid.formatType, cacheentry.sysmstatus, "
+                   "count(*) FROM cacheentry LEFT OUTER JOIN formatid "
+                   "ON cacheentry.format_id = formatid.formatId "
+                   "WHERE %s GROUP BY 1, 2" % pending), params).fetchall()
+        for formatType, sysmstatus, n in counts:
+          models.adjustCounter(session, formatType, sysmstatus, 0, -n)
+          models.adjustCounter(session, formatType, sysmstatus, 200, n)
+      columns = ["content", "content_md5", "content_size", "content_mtime"]
+      assignments = ", ".join(["%s = (%s)" % (column, known % column) 
+                               for column in columns])
+      res = session.execute(text(
+              "UPDATE cacheentry SET %s, contentstatus = 200 "
+              "WHERE %s" % (assignments, pending)), params)
+      session.commit()
+    except:
+      session.rollback()
+      raise
+    if res.rowcount > 0:
+      self._log.info("Linked %d entries to known content", res.rowcount)
+    return res.rowcount
+
+
+  def _newClient(self):
+    return d1baseclient.DataONEBaseClient(self.baseUrl,
+                                          cert_path=self._certificate)
+
+
+  def loadSystemMetadata(self, withstatus=0, nworkers=None, tracker=None,
+                         beforeCommit=None):
+    '''Downloads system metadata for entries with sysmstatus == withstatus 
+    using nworkers threads, by default self.nworkers.
+
+    If a workers.InflightTracker is provided, PIDs already in flight in it are
+    fetched first and every PID is tracked from dispatch until its result is 
+    applied or its fetch fails. beforeCommit(session) is passed on to the 
+    result writer.
+    '''
+    if nworkers is None:
+      nworkers = self.nworkers
     CQ = deque([],100)
     
-    def worker():
-      '''Pulls PIDs off the queue and downloads the associated system metadata,
-      updates the cache database.
+    def apply(session, result):
+      self._applySysmetaResult(session, result)
+      if tracker is not None:
+        tracker.done(result[0])
+    
+    writer = workers.ResultWriter(self.sessionmaker, apply,
+                                  batchSize=self.writeBatchSize,
+                                  interval=self.writeInterval,
+                                  name="loadSysmeta.writer",
+                                  beforeCommit=beforeCommit,
+                                  instrument=self.instrument)
+    
+    def process(client, item):
+      '''Downloads the system metadata for a PID and passes the result to 
+      the writer to update the cache database.
       '''
-      _log = logging.getLogger("loadSysmeta.worker.%s" % str(threading.current_thread().ident))
-      client = d1baseclient.DataONEBaseClient(self.baseUrl, 
-                                              cert_path=self._certificate)
-      tsession = self.sessionmaker()
-      moreWork = True
-      while moreWork:
-        idx, pid = Q.get()
-        _log.info( "Loading system metadata for %s" % pid )
-        try:
-          wo = tsession.query(models.CacheEntry).get(pid)
+      pid, suid = item
+      _log = logging.getLogger("loadSysmeta.worker.%s" % \
+                               str(threading.current_thread().ident))
+      _log.info( "Loading system metadata for %s" % pid )
+      queued = False
+      try:
+        with span(self.instrument, "sysm.request"):
           sysmeta = client.getSystemMetadataResponse(pid)
-          #sysmeta.read()
-          #sysmeta.close()
-          spath = self.getObjectPath(wo.suid.uid, isSystemMetadata=True)
-          wo.sysmeta = spath
-          fdest = open(os.path.abspath(spath), "wb")
-          shutil.copyfileobj(sysmeta, fdest)
-          fdest.close()
-          wo.sysmstatus = sysmeta.status
-          tsession.commit()
-          CQ.append(time.time())
-        except d1_common.types.exceptions.DataONEException as e:
-          _log.error(e)
-        except Exception as e:
-          _log.warn("Unanticipated exception for pid: %s" % pid)
-          _log.error(e)
-        finally:
-          pass
-        Q.task_done()
-        moreWork = not Q.empty()
+        #Derived columns are parsed from the stream as it is written
+        source = sysmeta
+        if sysmeta.status == 200:
+          source = sysmparse.ParsingReader(sysmeta)
+        with span(self.instrument, "sysm.store"):
+          stored = self.sysmetaStore.store(suid, source)
+        columns = None
+        if source is not sysmeta:
+          columns = source.columns()
         if self.instrument is not None:
-          self.instrument.gauge("QSize", Q.qsize())
-          if (len(CQ) == CQ.maxlen):
-            try:
-              dt = CQ.maxlen / ((CQ[CQ.maxlen-1] - CQ[0]))
-              self.instrument.gauge('sysm.sec-1', "{:.3f}".format(dt))
-            except Exception as e:
-              _log.error(e)
-      tsession.close()
-      _log.debug("Thread %s terminated." % str(threading.current_thread().ident))
-
-    #20 seems about right
-    nworkers = self._maxthreads - 1 
-    #stage the workers
-    for i in range(nworkers):
-      wt = threading.Thread(target = worker)
-      wt.daemon = True
-      wt.start()
-      self._log.debug("Thread %d as %s started" % (i, str(wt.ident)))
-    
-    #Get the list of PIDs to work with
+          self.instrument.histogram("sysm.bytes", stored.size)
+        writer.put((pid, stored, sysmeta.status, columns))
+        queued = True
+        CQ.append(time.time())
+      except d1_common.types.exceptions.DataONEException as e:
+        _log.error(e)
+      finally:
+        #A failed PID is no longer in flight. Its status is unchanged, so it 
+        #is selected again on the next run.
+        if tracker is not None and not queued:
+          tracker.done(pid)
+      if self.instrument is not None:
+        self.instrument.increment("sysm.fetched")
+        self.instrument.gauge("QSize", pool.qsize())
+        if (len(CQ) == CQ.maxlen):
+          try:
+            dt = CQ.maxlen / ((CQ[CQ.maxlen-1] - CQ[0]))
+            self.instrument.gauge('sysm.sec-1', "{:.3f}".format(dt))
+          except Exception as e:
+            _log.error(e)
+
+    pool = workers.WorkerPool(process, nworkers, setup=self._newClient,
+                              name="loadSysmeta.worker")
+    writer.start()
     session = self.sessionmaker()
-    #work = session.query(models.CacheEntry).join(models.D1ObjectFormat)\
-    #              .filter( or_( models.D1ObjectFormat.formatType=="METADATA", 
-    #                            models.D1ObjectFormat.formatType=="RESOURCE"))\
-    #              .filter(models.CacheEntry.sysmstatus==0)
-    #Load system metadata for everything
-    work = session.query(models.CacheEntry)\
-                  .filter(models.CacheEntry.sysmstatus==withstatus)
-    i=0
-    for o in work:
-      Q.put( [i, o.pid] )
-      i += 1
-    session.close()
-    Q.join()
+    try:
+      if tracker is None:
+        pool.run(self._sysmetaWork(session, withstatus))
+      else:
+        pool.run(tracker.dispatch(
+                   self._sysmetaWork(session, withstatus, 
+                                     first=tracker.snapshot())))
+    finally:
+      session.close()
+      writer.close()
   
   
-  def loadContent(self, nthreads=1):
-    work_queue = Queue.Queue()
+  def loadContent(self, nworkers=None):
+    '''Downloads the content of science metadata and resource map entries 
+    using nworkers threads, by default self.nworkers.
+    '''
+    if nworkers is None:
+      nworkers = self.nworkers
+    writer = workers.ResultWriter(self.sessionmaker, self._applyContentResult,
+                                  batchSize=self.writeBatchSize,
+                                  interval=self.writeInterval,
+                                  name="loadContent.writer",
+                                  instrument=self.instrument)
     
-    #++++++++++++++++++++++++++++++++++
-    def worker():
-      _log = logging.getLogger("loadContent.worker.%s" % str(threading.current_thread().ident))
-      client = d1baseclient.DataONEBaseClient(self.baseUrl,
-                                              cert_path=self._certificate)
-      tsession = self.sessionmaker()
-      moreWork = True
-      while moreWork:
-        idx, pid = work_queue.get()
-        _log.info( "Loading content for %s" % pid )
-        try:
-          wo = tsession.query(models.CacheEntry).get(pid)
+    def process(client, item):
+      pid, suid = item
+      _log = logging.getLogger("loadContent.worker.%s" % \
+                               str(threading.current_thread().ident))
+      _log.info( "Loading content for %s" % pid )
+      try:
+        with span(self.instrument, "content.request"):
           content = client.getResponse(pid)
-          cpath = self.getObjectPath(wo.suid.uid, isSystemMetadata=False)
-          wo.content = cpath
-          fdest = open(os.path.abspath(cpath), "wb")
-          shutil.copyfileobj(content, fdest)
-          fdest.close()
-          wo.contentstatus = content.status
-          tsession.commit()
-        except d1_common.types.exceptions.DataONEException as e:
-          _log.error(e)
-        except Exception as e:
-          _log.warn("Unanticipated exception for pid: %s" % pid)
-          _log.error(e)
-        finally:
-          pass
-        work_queue.task_done()
-        moreWork = not work_queue.empty()
-      tsession.close()
-    #----------------------------------
-    
-    nworkers = self._maxthreads - 1
-    #stage the workers
-    for i in range(nworkers):
-      wt = threading.Thread(target = worker)
-      wt.daemon = True
-      wt.start()
-      self._log.debug("Thread %d as %s started" % (i, str(wt.ident)))
-      
+        with span(self.instrument, "content.store"):
+          stored = self.contentStore.store(suid, content)
+        writer.put((pid, stored, content.status))
+        if self.instrument is not None:
+          self.instrument.histogram("content.bytes", stored.size)
+          self.instrument.increment("content.fetched")
+      except d1_common.types.exceptions.DataONEException as e:
+        _log.error(e)
+
+    pool = workers.WorkerPool(process, nworkers, setup=self._newClient,
+                              name="loadContent.worker")
     session = self.sessionmaker()
-    work = session.query(models.CacheEntry).join(models.D1ObjectFormat)\
-                  .filter( or_( models.D1ObjectFormat.formatType=="METADATA", 
-                                models.D1ObjectFormat.formatType=="RESOURCE"))\
-                  .filter(models.CacheEntry.contentstatus==0)
-    #work = session.query(models.CacheEntry).join(models.D1ObjectFormat)\
-    #              .filter( models.D1ObjectFormat.formatType=="RESOURCE")\
-    #              .filter(models.CacheEntry.contentstatus==0)
-    i = 0
-    for o in work:
-      work_queue.put( [i, o.pid] )
-      i += 1
-    session.close()
-    work_queue.join()
+    if self.contentAddressed:
+      self._linkKnownContent(session)
+    writer.start()
+    try:
+      pool.run(self._contentWork(session))
+    finally:
+      session.close()
+      writer.close()
+    if self.contentAddressed:
+      session = self.sessionmaker()
+      self._linkKnownContent(session)
+      session.close()
+
+
+  def _fetchConcurrent(self, resource, work, apply, isSystemMetadata,
+                       concurrency, name):
+    store = self.contentStore
+    prefix = "content"
+    if isSystemMetadata:
+      store = self.sysmetaStore
+      prefix = "sysm"
+    writer = workers.ResultWriter(self.sessionmaker, apply,
+                                  batchSize=self.writeBatchSize,
+                                  interval=self.writeInterval,
+                                  name=name,
+                                  instrument=self.instrument)
+    writer.start()
+    client = fetcher.ConcurrentFetcher(self.baseUrl,
+                                       certificate=self._certificate,
+                                       concurrency=concurrency,
+                                       instrument=self.instrument)
+    try:
+      n = client.fetch(work, resource, store.store, writer.put,
+                       parse=isSystemMetadata, name=prefix)
+    finally:
+      writer.close()
+    self._log.info("Fetched %s for %d PIDs" % (resource, n))
+    return n
+
+
+  def fetchSystemMetadata(self, withstatus=0, 
+                          concurrency=fetcher.DEFAULT_CONCURRENCY):
+    '''Alternative to loadSystemMetadata that keeps up to concurrency 
+    requests in flight over a shared pool of keep-alive connections. Returns
+    the number of documents retrieved.
+    '''
+    session = self.sessionmaker()
+    try:
+      work = self._sysmetaWork(session, withstatus)
+      return self._fetchConcurrent(fetcher.RESOURCE_SYSTEMMETADATA, work,
+                                   self._applySysmetaResult, True,
+                                   concurrency, "fetchSysmeta.writer")
+    finally:
+      session.close()
+
+
+  def fetchContent(self, concurrency=fetcher.DEFAULT_CONCURRENCY):
+    '''Alternative to loadContent that keeps up to concurrency requests in 
+    flight over a shared pool of keep-alive connections. Returns the number of
+    objects retrieved.
+    '''
+    session = self.sessionmaker()
+    if self.contentAddressed:
+      self._linkKnownContent(session)
+    try:
+      work = self._contentWork(session)
+      n = self._fetchConcurrent(fetcher.RESOURCE_OBJECT, work,
+                                self._applyContentResult, False,
+                                concurrency, "fetchContent.writer")
+    finally:
+      session.close()
+    if self.contentAddressed:
+      session = self.sessionmaker()
+      self._linkKnownContent(session)
+      session.close()
+    return n
+
+
+  def _verifyStored(self, location, digest, size, mtime, isSystemMetadata,
+                    rehash=False):
+    '''Checks a stored copy against its recorded digest, size and mtime. A 
+    file whose size and mtime are unchanged is not hashed again unless rehash
+    is True. Returns one of the VERIFY_ outcomes and, for VERIFY_RECORDED, the
+    storage.Stored to record.
+    '''
+    if storage.isSegmentLocation(location):
+      try:
+        data = self.segments.read(location)
+      except (IOError, OSError, ValueError):
+        return VERIFY_MISSING, None
+      actual = storage.Stored(location, hashlib.md5(data).hexdigest(), 
+                              len(data), None)
+    else:
+      try:
+        st = os.stat(location)
+      except OSError:
+        return VERIFY_MISSING, None
+      if size is not None and st.st_size != size:
+        return VERIFY_CORRUPT, None
+      if not rehash and digest is not None and mtime == st.st_mtime:
+        return VERIFY_OK, None
+      actual = storage.Stored(location, storage.digestFile(location), 
+                              st.st_size, st.st_mtime)
+    if digest is None:
+      #Copies stored before digests were recorded. System metadata can at 
+      #least be checked for truncation by parsing it.
+      if isSystemMetadata:
+        try:
+          stream = self.openLocation(location)
+          try:
+            sysmparse.parseStream(stream)
+          finally:
+            stream.close()
+        except Exception:
+          return VERIFY_CORRUPT, None
+      return VERIFY_RECORDED, actual
+    if actual.digest != digest:
+      return VERIFY_CORRUPT, None
+    if actual.mtime != mtime:
+      return VERIFY_RECORDED, actual
+    return VERIFY_OK, None
+
+
+  def _verifyWork(self, session, batchSize):
+    '''Yields (pid, isSystemMetadata, location, digest, size, mtime) for the
+    stored system metadata and content of retrieved entries, read in keyset 
+    batches of batchSize entries.
+    '''
+    E = models.CacheEntry
+    last = None
+    while True:
+      q = session.query(E.pid, 
+                        E.sysmstatus, E.sysmeta, E.sysmeta_md5, 
+                        E.sysmeta_size, E.sysmeta_mtime,
+                        E.contentstatus, E.content, E.content_md5,
+                        E.content_size, E.content_mtime)\
+                 .filter(or_(E.sysmstatus==200, E.contentstatus==200))
+      if last is not None:
+        q = q.filter(E.pid > last)
+      rows = q.order_by(E.pid).limit(batchSize).all()
+      session.commit()
+      if len(rows) == 0:
+        break
+      last = rows[-1][0]
+      for row in rows:
+        if row[1] == 200:
+          yield (row[0], True) + tuple(row[2:6])
+        if row[6] == 200:
+          yield (row[0], False) + tuple(row[7:11])
+
+
+  def _applyVerifyResult(self, session, result):
+    '''Records a (pid, isSystemMetadata, outcome, stored) verify result. 
+    Missing and corrupt copies are queued to be retrieved again by resetting
+    their status to 0. Called by the result writer.
+    '''
+    pid, isSystemMetadata, outcome, stored = result
+    prefix = "content"
+    if isSystemMetadata:
+      prefix = "sysmeta"
+    wo = session.query(models.CacheEntry).get(pid)
+    if outcome == VERIFY_RECORDED:
+      setattr(wo, prefix + "_md5", stored.digest)
+      setattr(wo, prefix + "_size", stored.size)
+      setattr(wo, prefix + "_mtime", stored.mtime)
+      return
+    setattr(wo, prefix, None)
+    for suffix in ("_md5", "_size", "_mtime"):
+      setattr(wo, prefix + suffix, None)
+    if isSystemMetadata:
+      models.setEntryStatus(session, wo, sysmstatus=0, 
+                            counters=self.useCounters)
+    else:
+      models.setEntryStatus(session, wo, contentstatus=0, 
+                            counters=self.useCounters)
+
+
+  def verify(self, nworkers=None, rehash=False, requeue=True, batchSize=1000):
+    '''Checks the stored system metadata and content of retrieved entries 
+    using nworkers threads, by default self.nworkers. Copies are compared with
+    the digest recorded when they were stored, skipping files whose size and
+    mtime are unchanged unless rehash is True. If requeue is True, missing and
+    corrupt copies are queued to be retrieved again by the next 
+    loadSystemMetadata or loadContent. Returns a dictionary of the number of
+    copies with each VERIFY_ outcome.
+    '''
+    if nworkers is None:
+      nworkers = self.nworkers
+    counts = {VERIFY_OK: 0, VERIFY_RECORDED: 0, VERIFY_MISSING: 0, 
+              VERIFY_CORRUPT: 0}
+    lock = threading.Lock()
+    writer = workers.ResultWriter(self.sessionmaker, self._applyVerifyResult,
+                                  batchSize=self.writeBatchSize,
+                                  interval=self.writeInterval,
+                                  name="verify.writer",
+                                  instrument=self.instrument)
+
+    def process(context, item):
+      pid, isSystemMetadata, location, digest, size, mtime = item
+      outcome, stored = self._verifyStored(location, digest, size, mtime,
+                                           isSystemMetadata, rehash=rehash)
+      with lock:
+        counts[outcome] += 1
+      if outcome == VERIFY_OK:
+        return
+      if outcome != VERIFY_RECORDED:
+        self._log.warn("Stored %s of %s is %s: %s", 
+                       "sysmeta" if isSystemMetadata else "content",
+                       pid, outcome, location)
+        if not requeue:
+          return
+      writer.put((pid, isSystemMetadata, outcome, stored))
+
+    pool = workers.WorkerPool(process, nworkers, name="verify.worker")
+    session = self.sessionmaker()
+    writer.start()
+    try:
+      pool.run(self._verifyWork(session, batchSize))
+    finally:
+      session.close()
+      writer.close()
+    self._log.info("Verify: %s", str(counts))
+    return counts
 
     
+  @property
+  def syncState(self):
+    '''The checkpoint of the current or last sync, or None if the cache has 
+    never been synchronized. A dictionary with:
+
+      fromDate, toDate: MJD bounds of the object listing. fromDate is None for
+        a full harvest.
+      windows: list of {fromDate, toDate, start, done} for the date ranges
+        listed in parallel, where start is the offset of the next page of the
+        window to load
+      listed: True once all pages have been loaded
+      inflight: PIDs dispatched for system metadata retrieval whose results 
+        had not been committed
+      complete: True once the sync has finished
+    '''
+    return self.config.get('sync')
+
+
+  def _storeSyncState(self, sync, session=None):
+    '''Records the sync checkpoint in the meta table. If session is provided
+    the checkpoint is committed with the session's transaction.
+    '''
+    self.config['sync'] = sync
+    commit = session is None
+    if session is None:
+      session = self.sessionmaker()
+    conf = models.PersistedDictionary(session, flushInterval=None)
+    conf['sync'] = sync
+    conf.flush(commit=commit)
+
+
   def loadSysmetaContent(self, startTime=None, startFrom=None,
-                         onNextPage=None):
-    maxtoload = -1
-    pagesize = 1000
-    start = startFrom
-    if startFrom is None:
-      start = self.pidcount-1
-    if isinstance(startTime, float):
-      #Assume the provided startTime is a MJD
-      startTime = date_time.to_xsd_datetime( mjd.MJD2dateTime( startTime ))
-    self._log.info("Starting PID load from: %d" % start)
-    if start < 0:
-      start = 0;
+                         onNextPage=None, restart=False, windows=1,
+                         prefetch=lister.DEFAULT_PREFETCH,
+                         overlap=DEFAULT_SYNC_OVERLAP):
+    '''Adds entries for objects listed by the node then retrieves their 
+    system metadata.
+
+    Progress is checkpointed in the meta table (see syncState) after every 
+    page of the listing and every result batch, so an interrupted sync 
+    resumes where it stopped without re-listing pages or re-downloading 
+    completed work. A new sync lists objects modified from startTime (MJD or
+    datetime), by default overlap seconds before the newest modification 
+    date in the cache. The node reports the modification dates, so objects 
+    that appear in the listing some time after they were modified, e.g. 
+    because of indexing or replication lag, are picked up by the next sync 
+    as long as the lag is within overlap. Entries listed again are skipped. 
+    startFrom is the offset of the first page. Set restart to True to discard
+    an interrupted sync and start a new one.
+
+    The listing is split into windows date ranges that are listed in 
+    parallel, each requesting up to prefetch pages ahead of the inserts, with
+    page sizes adapted to the response time of the node.
+
+    onNextPage(total, start, pagesize, begin) is called before and after each
+    page is loaded.
+    '''
+    sync = self.syncState
+    if restart or sync is None or sync['complete']:
+      if isinstance(startTime, datetime.datetime):
+        startTime = mjd.dateTime2MJD(startTime)
+      if startTime is None:
+        startTime = self.lastModified
+        if startTime is not None:
+          startTime -= overlap / 86400.0
+      if startFrom is None:
+        startFrom = 0
+      #Whole seconds, since mjd.dateTime2MJD is not exact for microseconds
+      toDate = datetime.datetime.utcnow().replace(microsecond=0)
+      toDate = mjd.dateTime2MJD(toDate)
+      sync = {'fromDate': startTime,
+              'toDate': toDate,
+              'windows': [],
+              'listed': False,
+              'inflight': [],
+              'complete': False}
+      for wfrom, wto in lister.splitWindows(startTime, toDate, windows):
+        sync['windows'].append({'fromDate': wfrom,
+                                'toDate': wto,
+                                'start': 0,
+                                'done': False})
+      sync['windows'][0]['start'] = startFrom
+      self._storeSyncState(sync)
+      self._log.info("Starting sync from: %s" % str(startTime))
+    else:
+      if not 'windows' in sync:
+        #Checkpoint of a single window sync
+        sync['windows'] = [{'fromDate': sync['fromDate'],
+                            'toDate': sync['toDate'],
+                            'start': sync.pop('start'),
+                            'done': sync['listed']}]
+      self._log.info("Resuming sync from: %s" % str(sync['fromDate']))
     self.lastLoaded = mjd.now()
-    client = d1baseclient.DataONEBaseClient(self.baseUrl, 
-                                            cert_path=self._certificate)
-    self._log.info( "Loading identifiers..." )
-#    objects = objectlistiterator.ObjectListIterator(client, start=start,
-#                            pagesize=pagesize,
-#                            max=maxtoload,
-#                            fromDate=startTime,
-#                            pagecallback=onNextPage)
-    objects = objectlistiterator.ObjectListIterator(client, start=start,
-                            pagesize=pagesize,
-                            max=maxtoload,
-                            fromDate=startTime)
-    n = self.loadObjectList(objects)
-    self._log.info( "Added %d identifiers" % n )
+    if not sync['listed']:
+      self._log.info( "Loading identifiers..." )
+      listers = []
+      indexes = []
+      for i, window in enumerate(sync['windows']):
+        if window['done']:
+          continue
+        listers.append(lister.PipelinedLister(self._newClient,
+                                              fromDate=window['fromDate'],
+                                              toDate=window['toDate'],
+                                              start=window['start'],
+                                              prefetch=prefetch,
+                                              instrument=self.instrument))
+        indexes.append(i)
+      n = 0
+      for j, start, olist in lister.mergePages(listers):
+        if onNextPage is not None:
+          onNextPage(olist.total, start, len(olist.objectInfo), True)
+        n += self.loadObjectList(olist.objectInfo)
+        sync = copy.deepcopy(sync)
+        sync['windows'][indexes[j]]['start'] = start + len(olist.objectInfo)
+        self._storeSyncState(sync)
+        if onNextPage is not None:
+          onNextPage(olist.total, start, len(olist.objectInfo), False)
+      self._log.info( "Added %d identifiers" % n )
+      sync = copy.deepcopy(sync)
+      for window in sync['windows']:
+        window['done'] = True
+      sync['listed'] = True
+      self._storeSyncState(sync)
     self._log.info( "Loading System Metadata..." )
-    self.loadSystemMetadata()
+    tracker = workers.InflightTracker(sync['inflight'])
+    
+    def checkpoint(session):
+      state = copy.deepcopy(self.syncState)
+      state['inflight'] = tracker.snapshot()
+      self._storeSyncState(state, session=session)
+    
+    self.loadSystemMetadata(tracker=tracker, beforeCommit=checkpoint)
     #self._log.info( "Loading content..." )
     #self.loadContent()
+    sync = copy.deepcopy(self.syncState)
+    sync['inflight'] = []
+    sync['complete'] = True
+    self._storeSyncState(sync)
     self.storeState()
     self._log.info( "Done." )
     
     
   
-  def adjustSysMetaentries(self):
-    '''Iterate through all system metadata entries and:
+  def adjustSysMetaentries(self, nprocesses=None, chunkSize=1000):
+    '''Iterate through all system metadata entries without a dateUploaded or
+    checksum and populate the columns derived from the cached system metadata:
     
-    1. adjust the path to be relative 
-    2. populate a new column for the dateUploaded
-    3. populate a new column for the originMemberNode
-    4. populate a new column for archived
-    5. populate a new column for obsoletedBy
+    1. dateUploaded
+    2. originMemberNode
+    3. archived
+    4. obsoletes and obsoletedBy
+    5. checksum and its algorithm
+
+    The entries are taken in ranges of chunkSize PIDs and the documents are
+    parsed by a pool of nprocesses worker processes (default one per CPU). 
+    The extracted values are applied with bulk UPDATE statements, one 
+    transaction per range. Returns the number of entries updated.
+
+    System metadata fetched by loadSystemMetadata is parsed as it is 
+    downloaded, so this is only needed for entries cached before that.
     '''
+    if nprocesses is None:
+      nprocesses = multiprocessing.cpu_count()
+    pool = None
+    if nprocesses > 1:
+      pool = multiprocessing.Pool(nprocesses)
     session = self.sessionmaker()
-    work = session.query(models.CacheEntry)\
-                  .filter(models.CacheEntry.uploaded==0)
-    counter = 0
-    total = 0                  
-    for o in work:
-      self._log.info("{0:s} : {1:s}".format(o.suid.uid, o.pid))
-      sysm = self.getSystemMetadata(o.suid.uid)
-      
-      o.uploaded = mjd.dateTime2MJD(sysm.dateUploaded)
-      o.archived = sysm.archived
-      o.origin = sysm.originMemberNode.value()
-      if sysm.obsoletes is not None:
-        o.obsoletes = sysm.obsoletes.value()
-      if sysm.obsoletedBy is not None:
-        o.obsoleted_by = sysm.obsoletedBy.value()
-      counter += 1
-      total += 1
-      if counter > 1000:
+    outstanding = deque()
+    total = 0
+    
+    def applyChunk(results):
+      rows = []
+      for result in results:
+        if len(result) == 1:
+          self._log.error("Could not parse system metadata for %s" % \
+                          result[0])
+          continue
+        columns = dict(zip(sysmparse.DERIVED_COLUMNS, result[1:]))
+        columns['pid'] = result[0]
+        rows.append(columns)
+      with span(self.instrument, "backfill.update"):
+        models.updateCacheEntries(session, rows)
         session.commit()
-        counter = 0
-      self.instrument.gauge('sysm.fix', total)
-    session.commit()
-      
+      if self.instrument is not None:
+        self.instrument.gauge('sysm.fix', total + len(rows))
+      return len(rows)
+    
+    try:
+      for chunk in self._backfillRanges(session, chunkSize):
+        self._log.info("Adjusting %d entries from %s" % (len(chunk), 
+                                                        chunk[0][0]))
+        if pool is None:
+          with span(self.instrument, "backfill.parse"):
+            results = sysmparse.extractDerivedValues(chunk, self.openLocation)
+          total += applyChunk(results)
+          continue
+        outstanding.append(pool.apply_async(sysmparse.extractDerivedValues,
+                                            (chunk, self.openLocation)))
+        #Bound the number of ranges in flight
+        if len(outstanding) >= 2 * nprocesses:
+          total += applyChunk(outstanding.popleft().get())
+      while len(outstanding) > 0:
+        total += applyChunk(outstanding.popleft().get())
+    finally:
+      if pool is not None:
+        pool.terminate()
+        pool.join()
+      session.close()
+    return total
+
 
+  def _backfillRanges(self, session, chunkSize):
+    '''Yields successive lists of up to chunkSize (pid, sysmeta location) for
+    retrieved entries that lack a dateUploaded or checksum, in PID order. 
+    Each list is read with its own keyset query so no cursor is held open 
+    while the previous ranges are updated.
+    '''
+    last = None
+    while True:
+      q = session.query(models.CacheEntry.pid, models.CacheEntry.suid_id,
+                        models.CacheEntry.sysmeta)\
+                 .filter(models.CacheEntry.sysmstatus==200)\
+                 .filter(or_(models.CacheEntry.uploaded==None,
+                             models.CacheEntry.uploaded==0,
+                             models.CacheEntry.checksum==None))
+      if last is not None:
+        q = q.filter(models.CacheEntry.pid > last)
+      rows = q.order_by(models.CacheEntry.pid).limit(chunkSize).all()
+      if len(rows) == 0:
+        break
+      last = rows[-1][0]
+      yield [(pid, spath or os.path.abspath(self._locateObjectPath(
+                                             shortUidgen.encode_id(suid_id))))
+             for pid, suid_id, spath in rows]
@@ -0,0 +1,585 @@
+'''
+Created on Oct 17, 2026
+
+Storage backends for the documents held by the object cache.
+
+A backend stores a document read from a stream and returns a Stored tuple. Its
+location string is recorded in the sysmeta or content column of the cache 
+entry, along with the MD5 digest and size of the stored bytes and, for files,
+the modification time, which are used to verify the cached copy. The location
+identifies the backend, so a cache may hold documents written by either 
+backend and readers do not need to know which was used.
+
+FileStore writes each document to its own file. The document is written to a
+temporary file which is synced and renamed into place, so a file at a stored
+path is always complete. The location is the path of the file.
+
+SegmentStore appends documents to large segment files, which avoids an inode
+and a directory entry per document for the millions of small system metadata
+documents. The location is "seg:<segment>:<offset>:<length>", so the offset
+index is the cache database itself. Segments are read through mmap. Replaced
+documents are left in their segment until the segment is compacted, which
+copies the documents still referenced to the active segment so the old
+segment file can be removed. Appends are serialized across processes with an
+flock on a lock file in the segment directory, so an update and a compaction
+may write to the same store.
+
+ContentAddressedStore is a FileStore that writes documents with a known 
+checksum once, to a file named by the checksum, so entries with identical 
+content share a single file.
+
+Either backend may compress documents as they are stored (see 
+compression.py). Documents are opened through a LocationOpener, which 
+decompresses them as needed.
+'''
+
+import os
+import re
+import errno
+import fcntl
+import mmap
+import shutil
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from cStringIO import StringIO
+from d1_local_cache.ocache import compression
+
+STORAGE_FILE = "file"
+STORAGE_SEGMENT = "segment"
+
+SEGMENT_PREFIX = "seg:"
+#Segments are sealed once they reach this size
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+
+#Lock file held while appending to the segments
+_SEGMENT_LOCK = "segments.lock"
+_SEGMENT_NAME = re.compile(r"^seg_(\d{6})\.dat$")
+_HEX_DIGEST = re.compile(r"^[0-9a-f]+$")
+
+#A stored document: location, MD5 hex digest and size of the stored bytes, and
+#the modification time of a file (None for segments)
+Stored = namedtuple("Stored", ["location", "digest", "size", "mtime"])
+
+
+def isSegmentLocation(location):
+  return location is not None and location.startswith(SEGMENT_PREFIX)
+
+
+def segmentLocation(segment, offset, length):
+  return "%s%d:%d:%d" % (SEGMENT_PREFIX, segment, offset, length)
+
+
+def parseSegmentLocation(location):
+  '''Returns (segment, offset, length) of a segment location.
+  '''
+  location = compression.plainLocation(location)
+  segment, offset, length = location[len(SEGMENT_PREFIX):].split(":")
+  return int(segment), long(offset), long(length)
+
+
+def blobName(algorithm, checksum):
+  '''Returns the name of the content addressed file for a checksum, e.g. 
+  "md5/d41d8cd98f00b204e9800998ecf8427e", or None if the checksum can not be
+  used as a file name.
+  '''
+  if algorithm is None or checksum is None:
+    return None
+  algorithm = algorithm.lower().replace("-", "")
+  checksum = checksum.strip().lower()
+  if not algorithm.isalnum() or _HEX_DIGEST.match(checksum) is None:
+    return None
+  return "%s/%s" % (algorithm, checksum)
+
+
+def digestFile(fpath, blockSize=1048576):
+  '''Returns the MD5 hex digest of the file at fpath.
+  '''
+  md5 = hashlib.md5()
+  with open(fpath, "rb") as f:
+    while True:
+      data = f.read(blockSize)
+      if not data:
+        break
+      md5.update(data)
+  return md5.hexdigest()
+
+
+class _DigestWriter(object):
+  '''Passes writes to a file while computing the digest and size of the 
+  bytes written.
+  '''
+
+  def __init__(self, fdest):
+    self.fdest = fdest
+    self.md5 = hashlib.md5()
+    self.size = 0
+
+  def write(self, data):
+    self.md5.update(data)
+    self.size += len(data)
+    self.fdest.write(data)
+
+
+class _HashingReader(object):
+  '''Passes reads from a stream while computing the hashlib digest named 
+  algorithm of the bytes read.
+  '''
+
+  def __init__(self, source, algorithm):
+    self.source = source
+    self.hash = hashlib.new(algorithm)
+
+  def read(self, size=-1):
+    data = self.source.read(size)
+    self.hash.update(data)
+    return data
+
+
+class FileStore(object):
+  '''Stores each document in its own file at pathFor(suid), compressed with
+  compressor if provided. The file name of a compressed document has the 
+  extension of the compression method appended.
+  '''
+
+  def __init__(self, pathFor, compressor=None):
+    self.pathFor = pathFor
+    self.compressor = compressor
+
+
+  def store(self, suid, source):
+    '''Copies the stream source to the file for suid and returns its Stored.
+    '''
+    fpath = self.pathFor(suid)
+    stored = self._write(fpath, source)
+    #A copy stored before the compression method was changed is stale
+    for other in [fpath] + [fpath + e for e in compression.EXTENSIONS.values()]:
+      if other != stored.location:
+        try:
+          os.remove(other)
+        except OSError as e:
+          if e.errno != errno.ENOENT:
+            raise
+    return stored
+
+
+  def _write(self, fpath, source, relocate=None):
+    '''Writes source to a temporary file that is synced and renamed to fpath.
+    The temporary file is unique to the process and thread, so concurrent 
+    writers of the same path do not interfere. If relocate is provided it is
+    called once source has been copied and may return another path to rename
+    the file to.
+    '''
+    tmp = "%s.%d.%d.tmp" % (fpath, os.getpid(), 
+                            threading.current_thread().ident)
+    try:
+      fdest = open(tmp, "wb")
+      try:
+        writer = _DigestWriter(fdest)
+        if self.compressor is None:
+          shutil.copyfileobj(source, writer)
+        else:
+          self.compressor.copy(source, writer)
+        fdest.flush()
+        os.fsync(fdest.fileno())
+      finally:
+        fdest.close()
+      if relocate is not None:
+        fpath = relocate() or fpath
+      if self.compressor is not None:
+        fpath += self.compressor.extension
+      os.rename(tmp, fpath)
+    except:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+      raise
+    return Stored(fpath, writer.md5.hexdigest(), writer.size, 
+                  os.stat(fpath).st_mtime)
+
+
+  def open(self, location):
+    return open(location, "rb")
+
+
+class ContentAddressedStore(FileStore):
+  '''FileStore that stores documents under their checksum. Documents are 
+  stored with a key of (suid, blob) where blob is a blobName, or None if the 
+  checksum is not known. Successful responses with a blob name are written to
+  the file blobPathFor(blob), other documents to pathFor(suid). 
+
+  The bytes of a blob are hashed as they are written, and are stored at 
+  pathFor(suid) instead if they do not match the checksum, or if the 
+  algorithm is not supported by hashlib, so an incorrect checksum can not 
+  change the content of other entries sharing the blob.
+  '''
+
+  def __init__(self, pathFor, blobPathFor, compressor=None):
+    FileStore.__init__(self, pathFor, compressor=compressor)
+    self._log = logging.getLogger("ContentAddressedStore")
+    self.blobPathFor = blobPathFor
+
+
+  def store(self, key, source):
+    '''Copies the stream source to the file for key and returns its Stored.
+    '''
+    suid, blob = key
+    if blob is None or getattr(source, "status", 200) != 200:
+      return FileStore.store(self, suid, source)
+    algorithm, checksum = blob.split("/")
+    try:
+      reader = _HashingReader(source, algorithm)
+    except ValueError:
+      return FileStore.store(self, suid, source)
+
+    def relocate():
+      if reader.hash.hexdigest() == checksum:
+        return None
+      self._log.warn("Content of %s does not match checksum %s", suid, blob)
+      return self.pathFor(suid)
+
+    return self._write(self.blobPathFor(blob), reader, relocate=relocate)
+
+
+class SegmentStore(object):
+  '''Append only store of documents packed into segment files under root,
+  compressed with compressor if provided. The location of a compressed 
+  document has the extension of the compression method appended.
+  '''
+
+  def __init__(self, root, maxSegmentSize=DEFAULT_SEGMENT_SIZE, 
+               compressor=None):
+    self._log = logging.getLogger("SegmentStore")
+    self.root = root
+    self.maxSegmentSize = maxSegmentSize
+    self.compressor = compressor
+    self._lock = threading.Lock()
+    self._lockFile = None
+    self._active = None
+    self._activeFile = None
+    #segment -> (mmap, mapped length)
+    self._maps = {}
+
+
+  def segmentPath(self, segment):
+    return os.path.join(self.root, "seg_%06d.dat" % segment)
+
+
+  def segments(self):
+    '''Returns the sorted list of segment numbers on disk.
+    '''
+    if not os.path.exists(self.root):
+      return []
+    res = []
+    for fname in os.listdir(self.root):
+      match = _SEGMENT_NAME.match(fname)
+      if match is not None:
+        res.append(int(match.group(1)))
+    res.sort()
+    return res
+
+
+  def _lockSegments(self):
+    '''Takes the lock that serializes appends across processes. Called with
+    the thread lock held.
+    '''
+    if self._lockFile is None:
+      if not os.path.exists(self.root):
+        os.makedirs(self.root)
+      self._lockFile = open(os.path.join(self.root, _SEGMENT_LOCK), "a")
+    fcntl.flock(self._lockFile.fileno(), fcntl.LOCK_EX)
+
+
+  def _unlockSegments(self):
+    fcntl.flock(self._lockFile.fileno(), fcntl.LOCK_UN)
+
+
+  def _openActive(self):
+    '''Opens the segment being appended to and positions it at the end, 
+    moving on to a new segment when it is full. Another process may have 
+    appended to the segment, or started a new one, since the last call. 
+    Called with both locks held.
+    '''
+    if self._active is None:
+      existing = self.segments()
+      self._active = 1
+      if len(existing) > 0:
+        self._active = existing[-1]
+    while True:
+      if self._activeFile is None:
+        self._activeFile = open(self.segmentPath(self._active), "ab")
+      #Append mode does not position the file at the end until the first 
+      #write, and other processes may have written since
+      self._activeFile.seek(0, os.SEEK_END)
+      if self._activeFile.tell() < self.maxSegmentSize:
+        return
+      self._activeFile.close()
+      self._activeFile = None
+      self._active += 1
+
+
+  def append(self, data):
+    '''Appends the document data and returns its location. A document is 
+    only referenced once its location is recorded, so a partial append left
+    by a crash is never read.
+    '''
+    with self._lock:
+      self._lockSegments()
+      try:
+        self._openActive()
+        offset = self._activeFile.tell()
+        self._activeFile.write(data)
+        #Flush so readers mapping the segment, and other processes, see the
+        #document
+        self._activeFile.flush()
+        return segmentLocation(self._active, offset, len(data))
+      finally:
+        self._unlockSegments()
+
+
+  def store(self, suid, source):
+    '''Appends the document read from the stream source and returns its
+    Stored. The document is read before the store is locked, so a slow
+    source does not hold up the other writers.
+    '''
+    data = source.read()
+    if self.compressor is None:
+      location = self.append(data)
+    else:
+      data = self.compressor.compress(data)
+      location = self.append(data) + self.compressor.extension
+    return Stored(location, hashlib.md5(data).hexdigest(), len(data), None)
+
+
+  def activeSegment(self):
+    '''Returns the number of the segment being appended to, opening it if 
+    necessary.
+    '''
+    with self._lock:
+      self._lockSegments()
+      try:
+        self._openActive()
+        return self._active
+      finally:
+        self._unlockSegments()
+
+
+  def segmentSize(self, segment):
+    return os.path.getsize(self.segmentPath(segment))
+
+
+  def _map(self, segment, end):
+    '''Returns a read only map of segment covering at least end bytes.
+    '''
+    with self._lock:
+      entry = self._maps.get(segment)
+      if entry is not None and entry[1] >= end:
+        return entry[0]
+      f = open(self.segmentPath(segment), "rb")
+      try:
+        size = os.fstat(f.fileno()).st_size
+        if size < end:
+          raise IOError("Segment %d is shorter than %d bytes" % (segment, end))
+        mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+      finally:
+        f.close()
+      #A replaced map is not closed, buffers handed out by read() may still
+      #refer to it. It is unmapped when no longer referenced.
+      self._maps[segment] = (mm, size)
+      return mm
+
+
+  def read(self, location):
+    '''Returns a buffer on the document at location, as stored, without 
+    copying it.
+    '''
+    segment, offset, length = parseSegmentLocation(location)
+    mm = self._map(segment, offset + length)
+    return buffer(mm, offset, length)
+
+
+  def open(self, location):
+    return StringIO(self.read(location))
+
+
+  def drop(self, segment):
+    '''Removes a segment that is no longer referenced.
+    '''
+    with self._lock:
+      if segment == self._active:
+        raise ValueError("Can not drop the active segment %d" % segment)
+      self._maps.pop(segment, None)
+      os.remove(self.segmentPath(segment))
+
+
+  def close(self):
+    with self._lock:
+      if self._activeFile is not None:
+        self._activeFile.close()
+        self._activeFile = None
+      if self._lockFile is not None:
+        self._lockFile.close()
+        self._lockFile = None
+      for mm, size in self._maps.values():
+        mm.close()
+      self._maps = {}
+
+
+class LocationOpener(object):
+  '''Opens the document at a location written by either backend, 
+  decompressed if the location records a compression method. zstd 
+  dictionaries are looked up under dictionaryRoot. Instances may be passed to
+  worker processes, where segments are mapped again as needed.
+  '''
+
+  def __init__(self, segmentRoot, segments=None, dictionaryRoot=None):
+    self.segmentRoot = segmentRoot
+    self.dictionaryRoot = dictionaryRoot
+    self._segments = segments
+    self._dictionaries = None
+
+
+  def __getstate__(self):
+    return {'segmentRoot': self.segmentRoot,
+            'dictionaryRoot': self.dictionaryRoot}
+
+
+  def __setstate__(self, state):
+    self.segmentRoot = state['segmentRoot']
+    self.dictionaryRoot = state['dictionaryRoot']
+    self._segments = None
+    self._dictionaries = None
+
+
+  @property
+  def dictionaries(self):
+    if self._dictionaries is None and self.dictionaryRoot is not None:
+      self._dictionaries = compression.Dictionaries(self.dictionaryRoot)
+    return self._dictionaries
+
+
+  def openRaw(self, location):
+    '''Opens the document at location as stored.
+    '''
+    if isSegmentLocation(location):
+      if self._segments is None:
+        self._segments = SegmentStore(self.segmentRoot)
+      return self._segments.open(location)
+    return open(location, "rb")
+
+
+  def __call__(self, location):
+    return compression.openDocument(self.openRaw(location), 
+                                    compression.locationMethod(location),
+                                    self.dictionaries)
+
+
+
+if __name__ == "__main__":
+  import unittest
+  import tempfile
+  import pickle
+
+  class TestSegmentStore(unittest.TestCase):
+
+    def setUp(self):
+      self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+      shutil.rmtree(self.root)
+
+    def test_roundtrip(self):
+      store = SegmentStore(self.root, maxSegmentSize=64)
+      locations = []
+      for i in xrange(20):
+        locations.append(store.store("s%d" % i, 
+                                     StringIO("document %d" % i)).location)
+      self.assertTrue(len(store.segments()) > 1)
+      for i, location in enumerate(locations):
+        self.assertEqual("document %d" % i, str(store.read(location)))
+        self.assertEqual("document %d" % i, store.open(location).read())
+      store.close()
+      #Reopened store continues the last segment
+      store = SegmentStore(self.root, maxSegmentSize=64)
+      location = store.store("x", StringIO("more")).location
+      self.assertEqual(store.segments()[-1],
+                       parseSegmentLocation(location)[0])
+      store.close()
+
+    def test_shared(self):
+      #Stores of two processes appending to the same segments
+      first = SegmentStore(self.root, maxSegmentSize=64)
+      second = SegmentStore(self.root, maxSegmentSize=64)
+      locations = []
+      for i in xrange(20):
+        store = (first, second)[i % 2]
+        locations.append(store.store("s%d" % i, 
+                                     StringIO("document %d" % i)).location)
+      self.assertEqual(len(set(locations)), len(locations))
+      for i, location in enumerate(locations):
+        self.assertEqual("document %d" % i, str(first.read(location)))
+      first.close()
+      second.close()
+
+    def test_opener(self):
+      store = SegmentStore(self.root)
+      location = store.store("a", StringIO("abc")).location
+      opener = pickle.loads(pickle.dumps(LocationOpener(self.root, store)))
+      self.assertEqual("abc", opener(location).read())
+      fpath = os.path.join(self.root, "a.xml")
+      FileStore(lambda suid: fpath).store("a", StringIO("def"))
+      self.assertEqual("def", opener(fpath).read())
+      store.close()
+
+    def test_blob(self):
+      store = ContentAddressedStore(
+        lambda suid: os.path.join(self.root, suid),
+        lambda blob: os.path.join(self.root, blob.replace("/", "_")))
+      self.assertEqual("md5/abcdef", blobName("MD5", "ABCDEF"))
+      self.assertEqual(None, blobName("MD5", "../x"))
+      name = blobName("MD5", hashlib.md5("same").hexdigest())
+      a = store.store(("a", name), StringIO("same"))
+      b = store.store(("b", name), StringIO("same"))
+      c = store.store(("c", None), StringIO("other"))
+      self.assertEqual(a.location, b.location)
+      self.assertEqual(os.path.join(self.root, "c"), c.location)
+      self.assertEqual("same", open(a.location).read())
+      self.assertEqual(hashlib.md5("same").hexdigest(), a.digest)
+      self.assertEqual(a.digest, digestFile(a.location))
+      self.assertEqual(4, a.size)
+      #Content that does not match the checksum is not stored in the blob
+      d = store.store(("d", name), StringIO("different"))
+      self.assertEqual(os.path.join(self.root, "d"), d.location)
+      self.assertEqual("same", open(a.location).read())
+      e = store.store(("e", blobName("SHA-256", "abcdef")), StringIO("x"))
+      self.assertEqual(os.path.join(self.root, "e"), e.location)
+      f = store.store(("f", blobName("X-1", "abcdef")), StringIO("x"))
+      self.assertEqual(os.path.join(self.root, "f"), f.location)
+      self.assertEqual([], [f for f in os.listdir(self.root) 
+                            if f.endswith(".tmp")])
+
+    def test_compressed(self):
+      compressor = compression.Compressor(compression.COMPRESSION_GZIP)
+      store = SegmentStore(self.root, compressor=compressor)
+      location = store.store("a", StringIO("abc" * 100)).location
+      self.assertTrue(location.endswith(".gz"))
+      fpath = os.path.join(self.root, "a.xml")
+      stored = FileStore(lambda suid: fpath, compressor).store("a", 
+                                                          StringIO("def"))
+      self.assertEqual(fpath + ".gz", stored.location)
+      opener = LocationOpener(self.root, store)
+      self.assertEqual("abc" * 100, opener(location).read())
+      self.assertEqual("def", opener(stored.location).read())
+      #Content that is itself compressed is read as it was stored
+      packed = compressor.compress("ghi")
+      fpath = os.path.join(self.root, "b_content.xml")
+      stored = FileStore(lambda suid: fpath).store("b", StringIO(packed))
+      self.assertEqual(packed, opener(stored.location).read())
+      #Storing it compressed replaces the uncompressed copy
+      stored = FileStore(lambda suid: fpath, compressor).store("b", 
+                                                          StringIO(packed))
+      self.assertFalse(os.path.exists(fpath))
+      self.assertEqual(packed, opener(stored.location).read())
+      store.close()
+
+  unittest.main()
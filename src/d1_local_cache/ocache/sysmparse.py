@@ -0,0 +1,348 @@
+'''
+Created on Oct 17, 2026
+
+Implements a lightweight streaming parser for DataONE system metadata 
+documents.
+
+Only the top level system metadata elements used by the cache are extracted,
+without building the full PyXB object model and without validation, so 
+documents with empty elements such as <accessPolicy/> need no clean up. The
+parser can be fed incrementally, for example while a response is being 
+written to disk.
+'''
+
+import re
+import datetime
+import xml.etree.cElementTree as ElementTree
+import pytz
+from d1_local_cache.util import mjd
+
+READ_BLOCK_SIZE = 65536
+
+#Top level elements extracted from the document
+ELEMENTS = ('identifier',
+            'formatId',
+            'size',
+            'checksum',
+            'rightsHolder',
+            'archived',
+            'dateUploaded',
+            'dateSysMetadataModified',
+            'originMemberNode',
+            'obsoletes',
+            'obsoletedBy',
+            )
+
+#CacheEntry columns derived from system metadata, in the order of the values
+#returned by derivedValues
+DERIVED_COLUMNS = ('uploaded',
+                   'archived',
+                   'origin',
+                   'obsoletes',
+                   'obsoleted_by',
+                   'checksum',
+                   'checksum_algorithm',
+                   )
+
+_XSD_DATETIME = re.compile(r"^\s*(\d{4,})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)"
+                           r"(\.\d+)?(Z|[+-]\d\d:\d\d)?\s*$")
+
+
+def parseDateTime(value):
+  '''Returns a datetime for an xs:dateTime string. Values with a time zone are
+  converted to UTC, as PyXB does, and returned with tzinfo UTC. Values without
+  a time zone are returned naive.
+  '''
+  match = _XSD_DATETIME.match(value)
+  if match is None:
+    raise ValueError("Invalid xs:dateTime: %s" % value)
+  year, month, day, hour, minute, second, fraction, tz = match.groups()
+  microsecond = 0
+  if fraction is not None:
+    microsecond = int(round(float(fraction) * 1000000))
+    if microsecond > 999999:
+      microsecond = 999999
+  dt = datetime.datetime(int(year), int(month), int(day), int(hour), 
+                         int(minute), int(second), microsecond)
+  if tz is None:
+    return dt
+  if tz != "Z":
+    offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[4:6]))
+    if tz[0] == "+":
+      dt = dt - offset
+    else:
+      dt = dt + offset
+  return dt.replace(tzinfo=pytz.utc)
+
+
+class SystemMetadataFields(object):
+  '''The system metadata values used by the cache. Attributes are named after
+  the system metadata elements and are None if the element is absent. 
+  checksumAlgorithm holds the algorithm attribute of checksum.
+  '''
+  __slots__ = ELEMENTS + ('checksumAlgorithm', )
+
+  def __init__(self, values):
+    for name in self.__slots__:
+      setattr(self, name, values.get(name))
+    if self.size is not None:
+      self.size = long(self.size)
+    if self.archived is not None:
+      self.archived = self.archived in ("true", "1")
+    for name in ('dateUploaded', 'dateSysMetadataModified'):
+      value = getattr(self, name)
+      if value is not None:
+        setattr(self, name, parseDateTime(value))
+
+  def __repr__(self):
+    return u"<SystemMetadataFields('%s')>" % self.identifier
+
+
+class _FieldTarget(object):
+  '''ElementTree parser target that collects the text of the top level 
+  elements listed in ELEMENTS.
+  '''
+
+  def __init__(self):
+    self.depth = 0
+    self.values = {}
+    self._name = None
+    self._text = []
+
+  def start(self, tag, attrib):
+    self.depth += 1
+    if self.depth == 2:
+      name = tag.rsplit("}", 1)[-1]
+      if name in ELEMENTS:
+        self._name = name
+        self._text = []
+        if name == 'checksum':
+          self.values['checksumAlgorithm'] = attrib.get('algorithm')
+
+  def end(self, tag):
+    if self.depth == 2 and self._name is not None:
+      self.values[self._name] = "".join(self._text).strip()
+      self._name = None
+    self.depth -= 1
+
+  def data(self, data):
+    if self._name is not None:
+      self._text.append(data)
+
+  def close(self):
+    return self.values
+
+
+class SystemMetadataParser(object):
+  '''Incremental parser. Call feed() with successive blocks of the document,
+  then close() to obtain the SystemMetadataFields.
+  '''
+
+  def __init__(self):
+    self._parser = ElementTree.XMLParser(target=_FieldTarget())
+
+  def feed(self, data):
+    self._parser.feed(data)
+
+  def close(self):
+    return SystemMetadataFields(self._parser.close())
+
+
+class ParsingReader(object):
+  '''File-like wrapper for a system metadata stream that feeds everything 
+  read through it to a SystemMetadataParser, so a document can be parsed 
+  while it is copied elsewhere.
+  '''
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.parser = SystemMetadataParser()
+    self.error = None
+
+  def read(self, size=-1):
+    data = self.stream.read(size)
+    if data and self.error is None:
+      try:
+        self.parser.feed(data)
+      except Exception as e:
+        self.error = e
+    return data
+
+  def fields(self):
+    '''Returns the SystemMetadataFields of the document read, or None if it 
+    could not be parsed.
+    '''
+    if self.error is not None:
+      return None
+    try:
+      return self.parser.close()
+    except Exception as e:
+      self.error = e
+    return None
+
+  def columns(self):
+    '''Returns the derivedColumns of the document read, or None if it could 
+    not be parsed.
+    '''
+    fields = self.fields()
+    if fields is None:
+      return None
+    try:
+      return derivedColumns(fields)
+    except Exception as e:
+      self.error = e
+    return None
+
+
+def parseStream(stream):
+  '''Returns the SystemMetadataFields of the document read from stream.
+  '''
+  parser = SystemMetadataParser()
+  while True:
+    data = stream.read(READ_BLOCK_SIZE)
+    if not data:
+      break
+    parser.feed(data)
+  return parser.close()
+
+
+def parseFile(fpath):
+  '''Returns the SystemMetadataFields of the document at fpath.
+  '''
+  with open(fpath, "rb") as stream:
+    return parseStream(stream)
+
+
+def derivedValues(fields):
+  '''Returns a tuple of the CacheEntry column values derived from 
+  SystemMetadataFields, in the order of DERIVED_COLUMNS.
+  '''
+  uploaded = None
+  if fields.dateUploaded is not None:
+    uploaded = mjd.dateTime2MJD(fields.dateUploaded)
+  archived = None
+  if fields.archived is not None:
+    archived = int(fields.archived)
+  return (uploaded,
+          archived,
+          fields.originMemberNode,
+          fields.obsoletes,
+          fields.obsoletedBy,
+          fields.checksum,
+          fields.checksumAlgorithm)
+
+
+def derivedColumns(fields):
+  '''Returns a dictionary of the CacheEntry column values derived from 
+  SystemMetadataFields.
+  '''
+  return dict(zip(DERIVED_COLUMNS, derivedValues(fields)))
+
+
+def extractDerivedValues(items, opener=None):
+  '''Parses the document of each (pid, location) in items and returns a list
+  of (pid, value, ...) tuples with the derivedValues of the document, or 
+  (pid, ) if the document could not be parsed. Documents are read from 
+  opener(location), by default the file at location. Used in worker 
+  processes, so the results are kept compact for returning to the parent.
+  '''
+  if opener is None:
+    opener = lambda location: open(location, "rb")
+  res = []
+  for pid, location in items:
+    try:
+      stream = opener(location)
+      try:
+        res.append((pid, ) + derivedValues(parseStream(stream)))
+      finally:
+        stream.close()
+    except Exception:
+      res.append((pid, ))
+  return res
+
+
+if __name__ == "__main__":
+  import unittest
+  from StringIO import StringIO
+
+  DOCUMENT = '''<?xml version="1.0" encoding="UTF-8"?>
+<d1:systemMetadata xmlns:d1="http://ns.dataone.org/service/types/v1">
+  <serialVersion>1</serialVersion>
+  <identifier>doi:10.5063/AA/test.1</identifier>
+  <formatId>eml://ecoinformatics.org/eml-2.1.0</formatId>
+  <size>1234</size>
+  <checksum algorithm="MD5">d41d8cd98f00b204e9800998ecf8427e</checksum>
+  <submitter>CN=submitter</submitter>
+  <rightsHolder>CN=owner</rightsHolder>
+  <accessPolicy/>
+  <replicationPolicy replicationAllowed="false">
+    <preferredMemberNode/>
+    <blockedMemberNode></blockedMemberNode>
+  </replicationPolicy>
+  <obsoletes>test.0</obsoletes>
+  <archived>true</archived>
+  <dateUploaded>2013-05-02T03:04:05.678+02:00</dateUploaded>
+  <dateSysMetadataModified>2013-05-02T03:04:05Z</dateSysMetadataModified>
+  <originMemberNode>urn:node:TEST</originMemberNode>
+</d1:systemMetadata>'''
+
+  class TestSysmParse(unittest.TestCase):
+
+    def test_parseDateTime(self):
+      self.assertEqual(datetime.datetime(2013, 5, 2, 1, 4, 5, 678000, pytz.utc),
+                       parseDateTime("2013-05-02T03:04:05.678+02:00"))
+      self.assertEqual(datetime.datetime(2013, 5, 2, 8, 4, 5, 0, pytz.utc),
+                       parseDateTime("2013-05-02T03:04:05-05:00"))
+      self.assertEqual(datetime.datetime(2013, 5, 2, 3, 4, 5, 0, pytz.utc),
+                       parseDateTime("2013-05-02T03:04:05Z"))
+      dt = parseDateTime("2013-05-02T03:04:05.5")
+      self.assertEqual(datetime.datetime(2013, 5, 2, 3, 4, 5, 500000), dt)
+      self.assertEqual(None, dt.tzinfo)
+      self.assertRaises(ValueError, parseDateTime, "2013-05-02")
+
+    def test_emptyElements(self):
+      fields = parseStream(StringIO(DOCUMENT))
+      self.assertEqual("doi:10.5063/AA/test.1", fields.identifier)
+      self.assertEqual(1234L, fields.size)
+      self.assertEqual("MD5", fields.checksumAlgorithm)
+      self.assertEqual("test.0", fields.obsoletes)
+      self.assertEqual(None, fields.obsoletedBy)
+      self.assertEqual(True, fields.archived)
+
+    def test_parsingReader(self):
+      reader = ParsingReader(StringIO(DOCUMENT))
+      data = []
+      while True:
+        block = reader.read(100)
+        if not block:
+          break
+        data.append(block)
+      self.assertEqual(DOCUMENT, "".join(data))
+      columns = reader.columns()
+      self.assertEqual("urn:node:TEST", columns['origin'])
+      self.assertEqual(1, columns['archived'])
+      self.assertEqual("test.0", columns['obsoletes'])
+      self.assertEqual(None, columns['obsoleted_by'])
+      self.assertEqual("d41d8cd98f00b204e9800998ecf8427e", columns['checksum'])
+      self.assertEqual(
+        mjd.dateTime2MJD(datetime.datetime(2013, 5, 2, 1, 4, 5, 678000, 
+                                           pytz.utc)),
+        columns['uploaded'])
+
+    def test_extractDerivedValues(self):
+      documents = {"a": DOCUMENT, "b": "<systemMetadata>"}
+      res = extractDerivedValues([("A", "a"), ("B", "b")], 
+                                 lambda location: StringIO(documents[location]))
+      self.assertEqual(("B", ), res[1])
+      self.assertEqual(1 + len(DERIVED_COLUMNS), len(res[0]))
+      self.assertEqual(derivedColumns(parseStream(StringIO(DOCUMENT))),
+                       dict(zip(DERIVED_COLUMNS, res[0][1:])))
+
+    def test_invalidDocument(self):
+      reader = ParsingReader(StringIO("<systemMetadata><identifier>"))
+      self.assertEqual("<systemMetadata>", reader.read(16))
+      reader.read()
+      self.assertEqual(None, reader.columns())
+      self.assertNotEqual(None, reader.error)
+
+  unittest.main()
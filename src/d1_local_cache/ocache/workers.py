@@ -0,0 +1,379 @@
+'''
+Created on Oct 17, 2026
+
+Support for the threaded fetch operations of the object cache.
+
+Fetch work is run by a WorkerPool. SQLite allows a single writer at a time, 
+so the workers do not write to the cache database themselves. Instead they 
+hand their results to a ResultWriter, which applies them from a single thread 
+in batched transactions.
+'''
+
+import logging
+import threading
+import time
+import Queue
+from d1_local_cache.util.instrument import span
+
+#Maximum number of results applied in a single transaction
+DEFAULT_WRITE_BATCH_SIZE = 500
+#Maximum number of seconds a result waits before its batch is committed
+DEFAULT_WRITE_INTERVAL = 5.0
+
+#Placed on a queue to stop the thread consuming it
+_STOP = object()
+
+
+class ResultWriter(threading.Thread):
+  '''Applies results to the cache database from a single thread. 
+
+  Results are collected from an unbounded queue and applied by calling 
+  apply(session, result) for each. A batch is committed when it reaches 
+  batchSize results or when interval seconds have passed since the batch was 
+  started, whichever comes first. If a batch fails it is retried one result
+  at a time so that a single bad result does not discard the rest.
+
+  If provided, beforeCommit(session) is called before every commit so that
+  state depending on the applied results can be recorded in the same 
+  transaction.
+
+  If an instrument is provided the size of each batch and the time taken to
+  commit it are recorded as <name>.batch and <name>.commit.
+  '''
+  
+  def __init__(self, sessionmaker, apply,
+               batchSize=DEFAULT_WRITE_BATCH_SIZE,
+               interval=DEFAULT_WRITE_INTERVAL,
+               name="ResultWriter",
+               beforeCommit=None,
+               instrument=None):
+    threading.Thread.__init__(self, name=name)
+    self.daemon = True
+    self._log = logging.getLogger(name)
+    self.sessionmaker = sessionmaker
+    self.apply = apply
+    self.beforeCommit = beforeCommit
+    self.instrument = instrument
+    self.batchSize = batchSize
+    self.interval = interval
+    self.queue = Queue.Queue()
+    self.applied = 0
+
+
+  def put(self, result):
+    self.queue.put(result)
+
+
+  def close(self):
+    '''Applies all queued results, then stops the writer thread.
+    '''
+    self.queue.put(_STOP)
+    self.join()
+
+
+  def run(self):
+    session = self.sessionmaker()
+    running = True
+    while running:
+      batch = []
+      started = time.time()
+      while len(batch) < self.batchSize:
+        timeout = started + self.interval - time.time()
+        if timeout <= 0:
+          break
+        try:
+          result = self.queue.get(True, timeout)
+        except Queue.Empty:
+          break
+        if result is _STOP:
+          running = False
+          break
+        batch.append(result)
+      if len(batch) > 0:
+        self._write(session, batch)
+    session.close()
+    self._log.debug("Writer terminated after %d results." % self.applied)
+
+
+  def _commit(self, session):
+    with span(self.instrument, self.name + ".commit"):
+      if self.beforeCommit is not None:
+        self.beforeCommit(session)
+      session.commit()
+
+
+  def _write(self, session, batch):
+    if self.instrument is not None:
+      self.instrument.histogram(self.name + ".batch", len(batch))
+    try:
+      for result in batch:
+        self.apply(session, result)
+      self._commit(session)
+      self.applied += len(batch)
+      return
+    except Exception as e:
+      session.rollback()
+      self._log.warn("Batch of %d results failed, applying individually" % \
+                     len(batch))
+      self._log.error(e)
+    for result in batch:
+      try:
+        self.apply(session, result)
+        self._commit(session)
+        self.applied += 1
+      except Exception as e:
+        session.rollback()
+        self._log.warn("Could not apply result: %s" % str(result))
+        self._log.error(e)
+
+
+class WorkerPool(object):
+  '''Processes a stream of work items on a fixed number of threads.
+
+  Items are read from the work iterable into a bounded queue, so the producer
+  never runs more than queueSize items ahead of the workers and work can be 
+  streamed from a database query. Each worker calls setup() once to create its
+  own context (e.g. a client connection) then process(context, item) for every
+  item it takes. Workers keep taking items until they receive a sentinel, 
+  which is only queued after the producer is exhausted, so no worker exits 
+  while there is still work to do.
+  '''
+
+  def __init__(self, process, nworkers, setup=None, queueSize=None,
+               name="worker"):
+    self._log = logging.getLogger(name)
+    self.process = process
+    self.setup = setup
+    self.nworkers = max(1, nworkers)
+    if queueSize is None:
+      queueSize = self.nworkers * 4
+    self.name = name
+    self.queue = Queue.Queue(queueSize)
+
+
+  def qsize(self):
+    return self.queue.qsize()
+
+
+  def _worker(self):
+    _log = logging.getLogger("%s.%s" % (self.name, 
+                                        str(threading.current_thread().ident)))
+    context = None
+    if self.setup is not None:
+      context = self.setup()
+    while True:
+      item = self.queue.get()
+      if item is _STOP:
+        break
+      try:
+        self.process(context, item)
+      except Exception as e:
+        _log.warn("Unanticipated exception for item: %s" % str(item))
+        _log.error(e)
+    _log.debug("Thread %s terminated." % str(threading.current_thread().ident))
+
+
+  def run(self, work):
+    '''Processes every item from work and returns when all of them have been
+    processed. Returns the number of items queued.
+    '''
+    threads = []
+    for i in xrange(self.nworkers):
+      wt = threading.Thread(target=self._worker, name="%s.%d" % (self.name, i))
+      wt.daemon = True
+      wt.start()
+      threads.append(wt)
+      self._log.debug("Thread %d as %s started" % (i, str(wt.ident)))
+    n = 0
+    try:
+      for item in work:
+        self.queue.put(item)
+        n += 1
+    finally:
+      for wt in threads:
+        self.queue.put(_STOP)
+      for wt in threads:
+        wt.join()
+    return n
+
+
+class InflightTracker(object):
+  '''Tracks the PIDs of work items that have been handed to workers but whose
+  results have not yet been committed.
+  '''
+
+  def __init__(self, pids=None):
+    self._pids = set()
+    if pids is not None:
+      self._pids.update(pids)
+    self._lock = threading.Lock()
+
+
+  def dispatch(self, work):
+    '''Yields the (pid, ...) items of work, recording each PID as in flight.
+    '''
+    for item in work:
+      with self._lock:
+        self._pids.add(item[0])
+      yield item
+
+
+  def done(self, pid):
+    with self._lock:
+      self._pids.discard(pid)
+
+
+  def snapshot(self):
+    '''Returns a sorted list of the PIDs currently in flight.
+    '''
+    with self._lock:
+      return sorted(self._pids)
+
+
+if __name__ == "__main__":
+  import unittest
+
+  class FakeSession(object):
+    '''Records applied results, which are committed or rolled back.
+    '''
+
+    def __init__(self):
+      self.pending = []
+      self.committed = []
+      self.commits = 0
+      self.closed = False
+
+    def commit(self):
+      self.committed.extend(self.pending)
+      self.pending = []
+      self.commits += 1
+
+    def rollback(self):
+      self.pending = []
+
+    def close(self):
+      self.closed = True
+
+  def apply(session, result):
+    if result == "bad":
+      raise ValueError("bad result")
+    session.pending.append(result)
+
+  class TestResultWriter(unittest.TestCase):
+
+    def setUp(self):
+      self.session = FakeSession()
+      self.checkpoints = []
+
+    def beforeCommit(self, session):
+      self.checkpoints.append(len(session.pending))
+
+    def writer(self, **kw):
+      writer = ResultWriter(lambda: self.session, apply, 
+                            beforeCommit=self.beforeCommit, **kw)
+      writer.start()
+      return writer
+
+    def test_batches(self):
+      writer = self.writer(batchSize=3, interval=60.0)
+      for i in xrange(7):
+        writer.put(i)
+      writer.close()
+      self.assertEqual(range(7), self.session.committed)
+      self.assertEqual(7, writer.applied)
+      self.assertEqual([3, 3, 1], self.checkpoints)
+      self.assertTrue(self.session.closed)
+
+    def test_interval(self):
+      writer = self.writer(batchSize=100, interval=0.05)
+      writer.put(1)
+      deadline = time.time() + 5.0
+      while self.session.committed == [] and time.time() < deadline:
+        time.sleep(0.01)
+      self.assertEqual([1], self.session.committed)
+      writer.close()
+
+    def test_failedBatch(self):
+      writer = self.writer(batchSize=5, interval=60.0)
+      for result in [1, 2, "bad", 3, 4]:
+        writer.put(result)
+      writer.close()
+      #Only the bad result is dropped
+      self.assertEqual([1, 2, 3, 4], self.session.committed)
+      self.assertEqual(4, writer.applied)
+      #The failed batch is not committed, its results are one at a time
+      self.assertEqual([1, 1, 1, 1], self.checkpoints)
+
+  class TestInflightTracker(unittest.TestCase):
+
+    def test_tracking(self):
+      tracker = InflightTracker(["c"])
+      work = tracker.dispatch(iter([("b", 1), ("a", 2)]))
+      self.assertEqual(("b", 1), work.next())
+      self.assertEqual(["b", "c"], tracker.snapshot())
+      self.assertEqual(("a", 2), work.next())
+      tracker.done("b")
+      tracker.done("x")
+      self.assertEqual(["a", "c"], tracker.snapshot())
+
+  class TestWorkerPool(unittest.TestCase):
+
+    def test_run(self):
+      processed = []
+      lock = threading.Lock()
+      contexts = []
+
+      def setup():
+        context = object()
+        with lock:
+          contexts.append(context)
+        return context
+
+      def process(context, item):
+        self.assertTrue(context in contexts)
+        with lock:
+          processed.append(item)
+
+      pool = WorkerPool(process, 4, setup=setup, name="test.run")
+      self.assertEqual(100, pool.run(iter(xrange(100))))
+      self.assertEqual(range(100), sorted(processed))
+      self.assertEqual(4, len(contexts))
+      #Every worker received its sentinel and exited
+      self.assertEqual([], [t for t in threading.enumerate() 
+                            if t.name.startswith("test.run.")])
+
+    def test_bounded(self):
+      release = threading.Event()
+      produced = []
+
+      def work():
+        for i in xrange(100):
+          produced.append(i)
+          yield i
+
+      pool = WorkerPool(lambda context, item: release.wait(), 2, queueSize=3,
+                        name="test.bounded")
+      runner = threading.Thread(target=pool.run, args=(work(), ))
+      runner.start()
+      time.sleep(0.2)
+      #The workers hold one item each, the queue holds queueSize and the 
+      #producer is blocked putting the next one
+      self.assertEqual(2 + 3 + 1, len(produced))
+      release.set()
+      runner.join()
+      self.assertEqual(100, len(produced))
+
+    def test_exception(self):
+      processed = []
+
+      def process(context, item):
+        if item % 10 == 0:
+          raise ValueError("failed %d" % item)
+        processed.append(item)
+
+      pool = WorkerPool(process, 3, name="test.exception")
+      self.assertEqual(50, pool.run(iter(xrange(50))))
+      self.assertEqual([i for i in xrange(50) if i % 10 != 0], 
+                       sorted(processed))
+
+  unittest.main()
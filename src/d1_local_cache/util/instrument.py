@@ -8,13 +8,34 @@ Values may be monitored by watching:
 where
   ?f=PREFIX* is an optional filter to limit the instruments to those with 
     names that start with PREFIX  
+
+StatsdClient sends a datagram for every measurement. BufferedStatsdClient
+collects measurements and sends them from a background thread as multi-line
+packets of up to maxPacketSize bytes. Between flushes only the last value of
+each gauge is kept and counters are summed, so hot loops may record a
+measurement for every item at the cost of a dictionary update.
+
+Any object with the gauge, increment, timing and histogram methods of
+StatsdClient can be used as an instrument. SpanRecorder keeps the timings of
+a run in memory for a summary at its end, and MultiSink sends measurements to
+several instruments. span() times a block on an instrument, which may be None
+when measurements are not wanted.
 '''
 import socket
 import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
 
 STATSD_HOST = "statsd.dataone.org"
 STATSD_PORT = 8125
 
+#Largest payload that fits an ethernet frame without IP fragmentation
+DEFAULT_PACKET_SIZE = 1432
+#Seconds between flushes of a BufferedStatsdClient
+DEFAULT_FLUSH_INTERVAL = 1.0
+
 
 class StatsdClient(object):
   
@@ -41,9 +62,46 @@ class StatsdClient(object):
     except Exception as e:
       logging.error("Bummer: %s" % str(e))
 
+  def _metric(self, name, value, mtype, rate=None):
+    msg = "%s%s:%s|%s" % (self._prefix, name, str(value), mtype)
+    if rate is not None and rate < 1.0:
+      msg += "|@%s" % str(rate)
+    return msg
+
+  def _sampled(self, rate):
+    return rate is None or rate >= 1.0 or random.random() < rate
+
   def gauge(self, name, value):
-    msg = "%s%s:%s|g" % (self._prefix, name, str(value))
-    self.send(msg)
+    self.send(self._metric(name, value, "g"))
+
+  def increment(self, name, value=1, rate=None):
+    '''Adds value to the counter name. If rate is less than 1 only that
+    fraction of calls is sent, and the server scales the count accordingly.
+    '''
+    if self._sampled(rate):
+      self.send(self._metric(name, value, "c", rate))
+
+  def timing(self, name, ms, rate=None):
+    '''Records a duration of ms milliseconds for the timer name.
+    '''
+    if self._sampled(rate):
+      self.send(self._metric(name, "%.3f" % ms, "ms", rate))
+
+  def histogram(self, name, value, rate=None):
+    '''Records a value of a distribution, such as a response size.
+    '''
+    if self._sampled(rate):
+      self.send(self._metric(name, value, "h", rate))
+
+  @contextmanager
+  def timer(self, name, rate=None):
+    '''Context manager recording the duration of its block with timing().
+    '''
+    t0 = time.time()
+    try:
+      yield
+    finally:
+      self.timing(name, (time.time() - t0) * 1000.0, rate=rate)
 
   def sendMeasurements(self, measurements):
     sout = []
@@ -52,3 +110,286 @@ class StatsdClient(object):
       self.gauge(k, measurements[k])
     print ", ".join(sout)
 
+
+class BufferedStatsdClient(StatsdClient):
+  '''StatsdClient that buffers measurements and sends them in packets of up to
+  maxPacketSize bytes every flushInterval seconds. Gauges keep their last
+  value and counters their sum between flushes. Timer and histogram values
+  are all sent, use a rate to sample them in hot loops.
+  '''
+
+  def __init__(self,
+               host=STATSD_HOST,
+               port=STATSD_PORT,
+               prefix="",
+               maxPacketSize=DEFAULT_PACKET_SIZE,
+               flushInterval=DEFAULT_FLUSH_INTERVAL):
+    StatsdClient.__init__(self, host=host, port=port, prefix=prefix)
+    self.maxPacketSize = maxPacketSize
+    self.flushInterval = flushInterval
+    self._lock = threading.Lock()
+    self._gauges = {}
+    self._counters = {}
+    self._lines = []
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run, name="statsd.flush")
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def _run(self):
+    while not self._stop.wait(self.flushInterval):
+      self.flush()
+
+
+  def close(self):
+    '''Stops the flush thread, sends any buffered measurements and closes the
+    socket.
+    '''
+    self._stop.set()
+    self._thread.join()
+    self.flush()
+    StatsdClient.close(self)
+
+
+  def gauge(self, name, value):
+    with self._lock:
+      self._gauges[name] = value
+
+
+  def increment(self, name, value=1, rate=None):
+    #Counts are aggregated locally, so every call is counted
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + value
+
+
+  def send(self, message):
+    with self._lock:
+      self._lines.append(message)
+
+
+  def _packets(self, lines):
+    '''Yields the lines joined into packets of up to maxPacketSize bytes. A
+    line longer than that is sent on its own.
+    '''
+    packet = []
+    size = 0
+    for line in lines:
+      if len(packet) > 0 and size + 1 + len(line) > self.maxPacketSize:
+        yield "\n".join(packet)
+        packet = []
+        size = 0
+      if len(packet) > 0:
+        size += 1
+      packet.append(line)
+      size += len(line)
+    if len(packet) > 0:
+      yield "\n".join(packet)
+
+
+  def flush(self):
+    '''Sends the buffered measurements.
+    '''
+    with self._lock:
+      gauges, self._gauges = self._gauges, {}
+      counters, self._counters = self._counters, {}
+      lines, self._lines = self._lines, []
+    for name, value in gauges.iteritems():
+      lines.append(self._metric(name, value, "g"))
+    for name, value in counters.iteritems():
+      lines.append(self._metric(name, value, "c"))
+    for packet in self._packets(lines):
+      StatsdClient.send(self, packet)
+
+
+class SpanRecorder(object):
+  '''Instrument that keeps the count, total, minimum and maximum of the
+  timings and histogram values recorded for each name, and the last value of
+  gauges and sum of counters.
+  '''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._stats = {}
+    self.gauges = {}
+    self.counters = {}
+
+
+  def _record(self, name, value):
+    with self._lock:
+      stat = self._stats.get(name)
+      if stat is None:
+        self._stats[name] = [1, value, value, value]
+        return
+      stat[0] += 1
+      stat[1] += value
+      if value < stat[2]:
+        stat[2] = value
+      if value > stat[3]:
+        stat[3] = value
+
+
+  def gauge(self, name, value):
+    with self._lock:
+      self.gauges[name] = value
+
+
+  def increment(self, name, value=1, rate=None):
+    with self._lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+
+  def timing(self, name, ms, rate=None):
+    self._record(name, ms)
+
+
+  def histogram(self, name, value, rate=None):
+    self._record(name, value)
+
+
+  def close(self):
+    pass
+
+
+  def summary(self):
+    '''Returns a dictionary of name: dict(count, total, min, max, mean).
+    '''
+    res = {}
+    with self._lock:
+      for name, (count, total, vmin, vmax) in self._stats.iteritems():
+        res[name] = {'count': count,
+                     'total': total,
+                     'min': vmin,
+                     'max': vmax,
+                     'mean': float(total) / count}
+    return res
+
+
+  def report(self):
+    '''Returns the summary as lines of text, one per name.
+    '''
+    lines = []
+    summary = self.summary()
+    for name in sorted(summary.keys()):
+      s = summary[name]
+      lines.append("%s: n=%d total=%.1f mean=%.3f min=%.3f max=%.3f" % \
+                   (name, s['count'], s['total'], s['mean'], s['min'],
+                    s['max']))
+    for name in sorted(self.counters.keys()):
+      lines.append("%s: %s" % (name, str(self.counters[name])))
+    return "\n".join(lines)
+
+
+class MultiSink(object):
+  '''Instrument that sends every measurement to each of sinks.
+  '''
+
+  def __init__(self, *sinks):
+    self.sinks = [s for s in sinks if s is not None]
+
+
+  def gauge(self, name, value):
+    for sink in self.sinks:
+      sink.gauge(name, value)
+
+
+  def increment(self, name, value=1, rate=None):
+    for sink in self.sinks:
+      sink.increment(name, value, rate=rate)
+
+
+  def timing(self, name, ms, rate=None):
+    for sink in self.sinks:
+      sink.timing(name, ms, rate=rate)
+
+
+  def histogram(self, name, value, rate=None):
+    for sink in self.sinks:
+      sink.histogram(name, value, rate=rate)
+
+
+  def close(self):
+    for sink in self.sinks:
+      sink.close()
+
+
+@contextmanager
+def span(instrument, name, rate=None):
+  '''Context manager recording the duration of its block in milliseconds as
+  the timing name on instrument. Nothing is recorded if instrument is None.
+  '''
+  if instrument is None:
+    yield
+    return
+  t0 = time.time()
+  try:
+    yield
+  finally:
+    instrument.timing(name, (time.time() - t0) * 1000.0, rate=rate)
+
+
+
+if __name__ == "__main__":
+  import unittest
+
+  class TestBufferedStatsdClient(unittest.TestCase):
+
+    def setUp(self):
+      self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self.server.bind(("127.0.0.1", 0))
+      self.server.settimeout(2)
+      self.client = BufferedStatsdClient(host="127.0.0.1",
+                                         port=self.server.getsockname()[1],
+                                         prefix="t", maxPacketSize=100,
+                                         flushInterval=60)
+
+    def tearDown(self):
+      self.server.close()
+
+    def receive(self):
+      lines = []
+      self.server.settimeout(0.5)
+      try:
+        while True:
+          packet = self.server.recv(65536)
+          self.assertTrue(len(packet) <= 100)
+          lines.extend(packet.split("\n"))
+      except socket.timeout:
+        pass
+      return lines
+
+    def test_aggregate(self):
+      for i in xrange(1000):
+        self.client.gauge("QSize", i)
+        self.client.increment("PIDs")
+      for i in xrange(20):
+        self.client.timing("get", i)
+      with self.client.timer("block"):
+        pass
+      self.client.close()
+      lines = self.receive()
+      self.assertTrue("t.QSize:999|g" in lines)
+      self.assertTrue("t.PIDs:1000|c" in lines)
+      self.assertEqual(20, len([l for l in lines if l.startswith("t.get:")]))
+      self.assertEqual(1, len([l for l in lines if l.startswith("t.block:")]))
+
+  class TestSpans(unittest.TestCase):
+
+    def test_recorder(self):
+      recorder = SpanRecorder()
+      sink = MultiSink(recorder, None)
+      for i in xrange(1, 5):
+        sink.histogram("bytes", i)
+      with span(sink, "block"):
+        pass
+      with span(None, "ignored"):
+        pass
+      summary = recorder.summary()
+      self.assertEqual(4, summary["bytes"]['count'])
+      self.assertEqual(10, summary["bytes"]['total'])
+      self.assertEqual(1, summary["bytes"]['min'])
+      self.assertEqual(4, summary["bytes"]['max'])
+      self.assertEqual(1, summary["block"]['count'])
+      self.assertFalse("ignored" in summary)
+
+  unittest.main()
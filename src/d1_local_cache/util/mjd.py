@@ -5,11 +5,27 @@ Created on May 29, 2013
 
 Copied directly from:
   http://asimpleweblog.wordpress.com/2010/06/20/julian-date-calculator/
+
+julian_date and caldate have since been reduced to plain arithmetic, and 
+datetimes_to_mjd and mjd_to_datetimes convert whole sequences with numpy.
+All of them give exactly the same values as the original implementation,
+including its quirks, so that MJD values already stored in a cache database
+compare equal to newly computed ones:
+
+  - dateTime2MJD adds microsecond / 1000.0 to the seconds.
+  - julian_date passes the seconds through str(), which keeps 12 significant
+    digits, before adding them to the fraction of the day.
+  - The fraction of the day is added to MJD0 + the day number before MJD0 is
+    subtracted again.
 '''
 
 import math
 import datetime
 import pytz
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 MJD0 = 2400000.5 # 1858 November 17, 00:00:00 hours 
 
@@ -67,37 +83,48 @@ def decimal_to_base60(deci,precision=1e-8):
   return (sign,num,frac1,frac2)
 
 
-def julian_date(year,month,day,hour,minute,second):
-  """Given year, month, day, hour, minute and second return JD.
-
- ``year``, ``month``, ``day``, ``hour`` and ``minute`` are integers,
- truncates fractional part; ``second`` is a floating point number.
- For BC year: use -(year-1). Example: 1 BC = 0, 1000 BC = -999.
- """
-  MJD0 = 2400000.5 # 1858 November 17, 00:00:00 hours 
+def _fracofday(hour, minute, second):
+  '''Fraction of the day as computed by base60_to_decimal from the string
+  "hour minute second", where second has already been rounded to the 12 
+  significant digits of str().
+  '''
+  sign = -1 if hour < 0 else 1
+  value = ((0 + abs(float(hour))) + abs(float(minute))/60.0) + \
+          abs(second)/3600.0
+  if sign == -1:
+    value = -value
+  return value / 24.0
 
-  year, month, day, hour, minute =\
-  int(year),int(month),int(day),int(hour),int(minute)
 
+def _mjdmidnight(year, month, day):
   if month <= 2:
     month +=12
     year -= 1 
 
-  modf = math.modf
   # Julian calendar on or before 1582 October 4 and Gregorian calendar
   # afterwards.
-  if ((10000L*year+100L*month+day) <= 15821004L):
-    b = -2 + int(modf((year+4716)/4)[1]) - 1179
+  if ((10000*year+100*month+day) <= 15821004):
+    b = -2 + (year+4716)//4 - 1179
   else:
-    b = int(modf(year/400)[1])-int(modf(year/100)[1])+\
-        int(modf(year/4)[1]) 
+    b = year//400 - year//100 + year//4
+
+  return 365*year - 679004 + b + int(30.6001*(month+1)) + day
+
+
+def julian_date(year,month,day,hour,minute,second):
+  """Given year, month, day, hour, minute and second return JD.
 
-  mjdmidnight = 365L*year - 679004L + b + int(30.6001*(month+1)) + day
+ ``year``, ``month``, ``day``, ``hour`` and ``minute`` are integers,
+ truncates fractional part; ``second`` is a floating point number.
+ For BC year: use -(year-1). Example: 1 BC = 0, 1000 BC = -999.
+ """
+  year, month, day, hour, minute =\
+  int(year),int(month),int(day),int(hour),int(minute)
 
-  fracofday = base60_to_decimal(\
-    " ".join([str(hour),str(minute),str(second)])) / 24.0 
+  #str(second) keeps 12 significant digits
+  fracofday = _fracofday(hour, minute, float('%.12g' % second))
 
-  return MJD0 + mjdmidnight + fracofday
+  return MJD0 + _mjdmidnight(year, month, day) + fracofday
 
 
 def caldate(mjd):
@@ -110,26 +137,23 @@ def caldate(mjd):
  To convert jd to mjd use jd - 2400000.5. In this module 2400000.5 is
  stored in MJD0.
  """
-  MJD0 = 2400000.5 # 1858 November 17, 00:00:00 hours 
-
-  modf = math.modf
-  a = long(mjd+MJD0+0.5)
+  a = int(mjd+MJD0+0.5)
   # Julian calendar on or before 1582 October 4 and Gregorian calendar
   # afterwards.
   if a < 2299161:
     b = 0
     c = a + 1524
   else:
-    b = long((a-1867216.25)/36524.25)
-    c = a+ b - long(modf(b/4)[1]) + 1525 
+    b = int((a-1867216.25)/36524.25)
+    c = a + b - b//4 + 1525 
 
-  d = long((c-122.1)/365.25)
-  e = 365*d + long(modf(d/4)[1])
-  f = long((c-e)/30.6001)
+  d = int((c-122.1)/365.25)
+  e = 365*d + d//4
+  f = int((c-e)/30.6001)
 
   day = c - e - int(30.6001*f)
-  month = f - 1 - 12*int(modf(f/14)[1])
-  year = d - 4715 - int(modf((7+month)/10)[1])
+  month = f - 1 - 12*(f//14)
+  year = d - 4715 - (7+month)//10
   fracofday = mjd - math.floor(mjd)
   hours = fracofday * 24.0 
 
@@ -139,25 +163,108 @@ def caldate(mjd):
 
 
 def dateTime2MJD(dt):
-  sec = dt.second + dt.microsecond / 1000.0
-  jnow = julian_date(dt.year, dt.month, dt.day, 
-                     dt.hour, dt.minute, sec)
-  return jnow - MJD0 
+  #Equal to float(str(dt.second + dt.microsecond / 1000.0)) as computed by 
+  #julian_date: the sum has at most seven significant digits, which str() 
+  #restores exactly
+  second = (dt.second * 1000 + dt.microsecond) / 1000.0
+  fracofday = ((0 + float(dt.hour)) + dt.minute/60.0 + second/3600.0) / 24.0
+  return MJD0 + _mjdmidnight(dt.year, dt.month, dt.day) + fracofday - MJD0
   
 
 def MJD2dateTime(mjd):
   dt = caldate(mjd)
-  return datetime.datetime(int(dt[0]), int(dt[1]), int(dt[2]), int(dt[3]), int(dt[4]), int(dt[5]), 0, pytz.utc)  
+  return datetime.datetime(int(dt[0]), int(dt[1]), int(dt[2]), 
+                           int(dt[3]), int(dt[4]), int(dt[5]), 0, pytz.utc)
 
 
 def now():
   '''Returns MJD for right now, UTC
   '''
-  dnow = datetime.datetime.utcnow()
-  sec = dnow.second + dnow.microsecond / 1000.0
-  jnow = julian_date(dnow.year, dnow.month, dnow.day, 
-                     dnow.hour, dnow.minute, sec)
-  return jnow - MJD0 
+  return dateTime2MJD(datetime.datetime.utcnow())
+
+
+def _requireNumpy():
+  if numpy is None:
+    raise ImportError("numpy is required for array conversions")
+
+
+def _fields(dts):
+  '''Returns int64 arrays of the year, month, day, hour, minute, second and
+  microsecond of dts, a numpy datetime64 array or a sequence of datetimes. 
+  The fields of datetimes are used as is, like dateTime2MJD, without 
+  conversion to UTC.
+  '''
+  if isinstance(dts, numpy.ndarray) and dts.dtype.kind == "M":
+    us = dts.astype("M8[us]")
+    days = us.astype("M8[D]")
+    months = us.astype("M8[M]")
+    year = us.astype("M8[Y]").astype(numpy.int64) + 1970
+    month = months.astype(numpy.int64) % 12 + 1
+    day = (days - months.astype("M8[D]")).astype(numpy.int64) + 1
+    tod = (us - days.astype("M8[us]")).astype(numpy.int64)
+    return (year, month, day, tod // 3600000000, tod // 60000000 % 60,
+            tod // 1000000 % 60, tod % 1000000)
+  rows = [(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, 
+           dt.microsecond) for dt in dts]
+  fields = numpy.array(rows, dtype=numpy.int64).reshape(len(rows), 7)
+  return [fields[:, i] for i in xrange(7)]
+
+
+def datetimes_to_mjd(dts):
+  '''Returns a float64 array of the MJD of each of dts, a numpy datetime64
+  array or a sequence of datetimes. Each value equals dateTime2MJD of the 
+  corresponding datetime.
+  '''
+  _requireNumpy()
+  year, month, day, hour, minute, second, microsecond = _fields(dts)
+  early = month <= 2
+  month = numpy.where(early, month + 12, month)
+  year = numpy.where(early, year - 1, year)
+  julian = (10000*year + 100*month + day) <= 15821004
+  b = numpy.where(julian, -2 + (year+4716)//4 - 1179,
+                  year//400 - year//100 + year//4)
+  mjdmidnight = 365*year - 679004 + b + \
+                (30.6001*(month+1)).astype(numpy.int64) + day
+  seconds = (second*1000 + microsecond) / 1000.0
+  fracofday = ((hour.astype(numpy.float64) + minute/60.0) + 
+               seconds/3600.0) / 24.0
+  return ((MJD0 + mjdmidnight) + fracofday) - MJD0
+
+
+def mjd_to_datetimes(mjds):
+  '''Returns a list of the UTC datetimes of each of mjds, equal to 
+  MJD2dateTime of each value.
+  '''
+  _requireNumpy()
+  mjds = numpy.asarray(mjds, dtype=numpy.float64)
+  a = (mjds + MJD0 + 0.5).astype(numpy.int64)
+  b = ((a - 1867216.25)/36524.25).astype(numpy.int64)
+  gregorian = a >= 2299161
+  c = numpy.where(gregorian, a + b - b//4 + 1525, a + 1524)
+  d = ((c - 122.1)/365.25).astype(numpy.int64)
+  e = 365*d + d//4
+  f = ((c - e)/30.6001).astype(numpy.int64)
+  day = c - e - (30.6001*f).astype(numpy.int64)
+  month = f - 1 - 12*(f//14)
+  year = d - 4715 - (7 + month)//10
+  #decimal_to_base60 of the hours
+  hours = (mjds - numpy.floor(mjds)) * 24.0
+  frac, hour = numpy.modf(hours)
+  hour = hour.astype(numpy.int64)
+  seconds, minute = numpy.modf(frac * 60.0)
+  minute = minute.astype(numpy.int64)
+  seconds = seconds * 60.0
+  carry = numpy.abs(seconds - 60.0) < 1e-8
+  seconds = numpy.where(carry, 0.0, seconds)
+  minute = numpy.where(carry, minute + 1, minute)
+  carry = numpy.abs(minute - 60.0) < 1e-8
+  minute = numpy.where(carry, 0, minute)
+  hour = numpy.where(carry, hour + 1, hour)
+  seconds = seconds.astype(numpy.int64)
+  return [datetime.datetime(*(fields + (0, pytz.utc)))
+          for fields in zip(year.tolist(), month.tolist(), day.tolist(),
+                            hour.tolist(), minute.tolist(), 
+                            seconds.tolist())]
 
 
 
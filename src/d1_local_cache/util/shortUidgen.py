@@ -4,6 +4,11 @@ Created on May 30, 2013
 @author: vieglais
 
 Copied from: http://code.activestate.com/recipes/576918-python-short-url-generator/
+
+The bit permutation is applied a byte at a time with lookup tables built from
+the mapping, and the base conversion is iterative. encode_ids and decode_ids 
+convert a sequence of ids or short uids in one call for bulk ingest. The 
+output is the same as that of the original recipe.
 '''
 
 DEFAULT_ALPHABET = 'mn6j2c4rv8bpygw95z7hsdaetxuk3fq'
@@ -17,6 +22,28 @@ class ShortIdGenerator(object):
     self.mask = (1 << block_size) - 1
     self.mapping = range(block_size)
     self.mapping.reverse()
+    self._digits = dict((c, i) for i, c in enumerate(alphabet))
+    self._encodeTables = self._permutationTables(self.mapping)
+    inverse = [0] * block_size
+    for i, b in enumerate(self.mapping):
+      inverse[b] = i
+    self._decodeTables = self._permutationTables(inverse)
+
+  def _permutationTables(self, mapping):
+    '''Returns a list with, for each byte of the block, a table of the 
+    permuted bits of every value of that byte.
+    '''
+    tables = []
+    for shift in xrange(0, self.block_size, 8):
+      table = []
+      for v in xrange(256):
+        result = 0
+        for j in xrange(8):
+          if v & (1 << j) and shift + j < self.block_size:
+            result |= (1 << mapping[shift + j])
+        table.append(result)
+      tables.append(table)
+    return tables
 
   def encode_id(self, n, min_length=MIN_LENGTH):
     return self.enbase(self.encode(n), min_length)
@@ -24,24 +51,37 @@ class ShortIdGenerator(object):
   def decode_id(self, n):
     return self.decode(self.debase(n))
 
+  def encode_ids(self, ids, min_length=MIN_LENGTH):
+    '''Returns the list of encode_id of each of ids, e.g. an xrange.
+    '''
+    encode = self.encode
+    enbase = self.enbase
+    return [enbase(encode(int(n)), min_length) for n in ids]
+
+  def decode_ids(self, uids):
+    '''Returns the list of decode_id of each of uids.
+    '''
+    decode = self.decode
+    debase = self.debase
+    return [decode(debase(x)) for x in uids]
+
   def encode(self, n):
     return (n & ~self.mask) | self._encode(n & self.mask)
 
   def _encode(self, n):
-    result = 0
-    for i, b in enumerate(self.mapping):
-      if n & (1 << i):
-        result |= (1 << b)
-    return result
+    return self._permute(self._encodeTables, n)
 
   def decode(self, n):
     return (n & ~self.mask) | self._decode(n & self.mask)
 
   def _decode(self, n):
+    return self._permute(self._decodeTables, n)
+
+  def _permute(self, tables, n):
     result = 0
-    for i, b in enumerate(self.mapping):
-      if n & (1 << b):
-        result |= (1 << i)
+    for table in tables:
+      result |= table[n & 0xff]
+      n >>= 8
     return result
 
   def enbase(self, x, min_length=MIN_LENGTH):
@@ -50,16 +90,26 @@ class ShortIdGenerator(object):
     return '%s%s' % (padding, result)
 
   def _enbase(self, x):
-    n = len(self.alphabet)
+    alphabet = self.alphabet
+    n = len(alphabet)
     if x < n:
-      return self.alphabet[x]
-    return self._enbase(x / n) + self.alphabet[x % n]
+      return alphabet[x]
+    digits = []
+    while x > 0:
+      x, r = divmod(x, n)
+      digits.append(alphabet[r])
+    digits.reverse()
+    return ''.join(digits)
 
   def debase(self, x):
     n = len(self.alphabet)
+    digits = self._digits
     result = 0
-    for i, c in enumerate(reversed(x)):
-      result += self.alphabet.index(c) * (n ** i)
+    for c in x:
+      try:
+        result = result * n + digits[c]
+      except KeyError:
+        raise ValueError("Invalid short uid character: %r" % c)
     return result
 
 
@@ -83,6 +133,12 @@ def encode_id(n, min_length=MIN_LENGTH):
 def decode_id(n):
     return DEFAULT_ID_GENERATOR.decode_id(n)
 
+def encode_ids(ids, min_length=MIN_LENGTH):
+    return DEFAULT_ID_GENERATOR.encode_ids(ids, min_length)
+
+def decode_ids(uids):
+    return DEFAULT_ID_GENERATOR.decode_ids(uids)
+
 if __name__ == '__main__':
     for a in range(0, 200000, 37):
         b = encode(a)
@@ -54,83 +54,150 @@ def onNextPage(total, start, pagesize, begin):
                  % (start, total, pagesize))
 
 
-def countObjectTypes(cache):
+def countObjectTypes(cache, start="2012-07-01", end="2014-03-23", days=30):
+  '''Prints a CSV of the cumulative number of objects of each type uploaded
+  on or before each date from start to end (inclusive, YYYY-MM-DD) stepping 
+  by days.
+  '''
   def mkdate(sdate):
     dt = datetime.datetime.strptime(sdate, "%Y-%m-%d")
     return dt
   
-  session = cache.sessionmaker()
-  dates = [mkdate("2012-07-01"),
-           mkdate("2012-07-31"),
-           mkdate("2012-08-30"),
-           mkdate("2012-09-29"),
-           mkdate("2012-10-29"),
-           mkdate("2012-11-28"),
-           mkdate("2012-12-28"),
-           mkdate("2013-01-27"),
-           mkdate("2013-02-26"),
-           mkdate("2013-03-28"),
-           mkdate("2013-04-27"),
-           mkdate("2013-05-27"),
-           mkdate("2013-06-26"),
-           mkdate("2013-07-26"),
-           mkdate("2013-08-25"),
-           mkdate("2013-09-24"),
-           mkdate("2013-10-24"),
-           mkdate("2013-11-23"),
-           mkdate("2013-12-23"),
-           mkdate("2014-01-22"),
-           mkdate("2014-02-21"),
-           mkdate("2014-03-23"),
-           ]
+  dates = []
+  cdate = mkdate(start)
+  while cdate <= mkdate(end):
+    dates.append(cdate)
+    cdate += datetime.timedelta(days=days)
+  otypes = ["DATA", "METADATA", "RESOURCE"]
+  counts = cache.countByTypeOverTime([mjd.dateTime2MJD(d) for d in dates],
+                                     otypes=otypes)
   print ("Date,Data,Metadata,ResourceMap")
-  for cdate in dates:
-    res = [cdate.strftime("%Y-%m-%d"), "0","0","0"]
-    adate = mjd.dateTime2MJD(cdate) 
-    res[1] = str(cache.countByTypeDateUploaded(otype="DATA", mjd_uploaded=adate))
-    res[2] = str(cache.countByTypeDateUploaded(otype="METADATA", mjd_uploaded=adate))
-    res[3] = str(cache.countByTypeDateUploaded(otype="RESOURCE", mjd_uploaded=adate))
+  for i, cdate in enumerate(dates):
+    res = [cdate.strftime("%Y-%m-%d")]
+    for otype in otypes:
+      res.append(str(counts[otype][i]))
     print (",".join(res))
 
 
 OP_STATE="state"
 OP_UPDATE="update"
 OP_COUNT="count"
+OP_RELAYOUT="relayout"
+OP_COMPACT="compact"
+OP_VERIFY="verify"
 
-def main(operation=OP_STATE, configfile=CONFIGFILE):
-  conf = readConfiguration(configfile=configfile)
-  #setupEnvironment(conf['python']['path'])
-  from d1_local_cache.ocache.object_cache_manager import ObjectCache
-  from d1_local_cache.util import instrument
-  
-  instrument = instrument.StatsdClient(prefix=conf['sysmcache']['instrument'])
-  
-  cache = ObjectCache(cachePath=conf['sysmcache']['path'],
-                    dbname=conf['sysmcache']['database'],
-                    baseUrl = conf['environment']['baseurl'],
-                    instrument=instrument,
-                    certificate=conf['sysmcache']['cert'])
-
+def runOperation(operation, cache, conf):
   if operation == OP_STATE:
     print str(cache)
     return
   
   if operation == OP_UPDATE:
-    newest = cache.lastModified
     #newest = "2013-05-20T17:42:54.000000+00:00"
-    logging.info("Start date is: %s" % newest)
+    logging.info("Sync checkpoint is: %s" % str(cache.syncState))
     #purgeEverything(cache)
     #cache.populateObjectFormats()
-    cache.loadSysmetaContent(startTime=newest, startFrom=0, onNextPage=onNextPage)
+    #Resumes an interrupted sync, otherwise lists from the last sync watermark
+    cache.loadSysmetaContent(onNextPage=onNextPage)
     #cache.loadSystemMetadata(withstatus=404)
     return
 
   if operation == OP_COUNT:
     countObjectTypes(cache)
     return
+
+  if operation == OP_RELAYOUT:
+    #Moves the cached files to the layout given in the configuration, e.g.
+    #layout: {levels: 2, width: 2, scheme: md5}
+    from d1_local_cache.ocache import layout
+    target = conf['sysmcache'].get('layout', layout.DEFAULT_LAYOUT.toDict())
+    logging.info("Moving cache from %s to %s" % (str(cache.layout), target))
+    moved = cache.relayout(target)
+    logging.info("Moved %d files" % moved)
+    return
+
+  if operation == OP_VERIFY:
+    #Missing and corrupt copies are retrieved again by the next update
+    counts = cache.verify()
+    logging.info("Verified cache: %s" % str(counts))
+    return
+
+  if operation == OP_COMPACT:
+    reclaimed = cache.compactSegments()
+    logging.info("Reclaimed %d bytes from sysmeta segments" % reclaimed)
+    return
+
+
+def runProfiled(profilePath, operation, cache, conf):
+  '''Runs operation under cProfile and writes the profile to 
+  profilePath/<operation>-<timestamp>.prof, for reading with pstats or a 
+  profile viewer. Threads started by the operation, such as the fetch workers
+  and result writers, get a profiler each and are merged into the same file.
+  '''
+  import cProfile
+  import pstats
+  import threading
+  if not os.path.exists(profilePath):
+    os.makedirs(profilePath)
+  fname = os.path.join(profilePath, "%s-%s.prof" % \
+              (operation, datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")))
+  profilers = []
+
+  def profileThread(frame, event, arg):
+    #Called on the first event of each new thread, replaces itself with a
+    #profiler for that thread
+    profiler = cProfile.Profile()
+    profilers.append(profiler)
+    profiler.enable()
+
+  profiler = cProfile.Profile()
+  threading.setprofile(profileThread)
+  try:
+    profiler.runcall(runOperation, operation, cache, conf)
+  finally:
+    threading.setprofile(None)
+    stats = pstats.Stats(profiler)
+    for threadProfiler in profilers:
+      stats.add(threadProfiler)
+    stats.dump_stats(fname)
+    logging.info("Wrote profile to %s (%d threads)" % (fname, 
+                                                        len(profilers) + 1))
+
+
+def main(operation=OP_STATE, configfile=CONFIGFILE):
+  conf = readConfiguration(configfile=configfile)
+  #setupEnvironment(conf['python']['path'])
+  from d1_local_cache.ocache.object_cache_manager import ObjectCache
+  from d1_local_cache.util import instrument as instruments
   
+  statsd = instruments.BufferedStatsdClient(
+                                       prefix=conf['sysmcache']['instrument'])
+  #Per-phase timings are also kept for a summary at the end of the run
+  spans = instruments.SpanRecorder()
+  instrument = instruments.MultiSink(statsd, spans)
   
-  
+  cache = ObjectCache(cachePath=conf['sysmcache']['path'],
+                    dbname=conf['sysmcache']['database'],
+                    baseUrl = conf['environment']['baseurl'],
+                    instrument=instrument,
+                    certificate=conf['sysmcache']['cert'],
+                    sysmetaStorage=conf['sysmcache'].get('storage'),
+                    compression=conf['sysmcache'].get('compression'),
+                    contentAddressed=conf['sysmcache'].get('contentAddressed'))
+
+  #Set profile: <directory> in the configuration to profile updates
+  profilePath = conf['sysmcache'].get('profile')
+  try:
+    if operation == OP_UPDATE and profilePath is not None:
+      runProfiled(profilePath, operation, cache, conf)
+    else:
+      runOperation(operation, cache, conf)
+  finally:
+    #Sends any buffered measurements
+    instrument.close()
+    report = spans.report()
+    if report != "":
+      logging.info("Timings (ms) for %s:\n%s" % (operation, report))
+
 
 if __name__ == "__main__":
   try: